@@ -6,6 +6,7 @@ from flask_sqlalchemy import SQLAlchemy
 from config import config
 from flask_login import LoginManager
 from flask_pagedown import PageDown
+from flask_sock import Sock
 from flask import url_for, redirect, flash, current_app
 from flask_login.utils import login_url as make_login_url, make_next_param
 
@@ -52,6 +53,7 @@ def unauthorized():
 
 
 pagedown = PageDown()
+sock = Sock()
 
 
 def create_app(config_name):
@@ -62,6 +64,9 @@ def create_app(config_name):
     if app.config['SSL_REDIRECT']:
         from flask_sslify import SSLify
         sslify = SSLify(app)
+    if app.config['FLASKY_JSON_PROVIDER'] == 'orjson':
+        from .json_provider import OrjsonProvider
+        app.json = OrjsonProvider(app)
     bootstrap.init_app(app)
     mail.init_app(app)
     moment.init_app(app)
@@ -69,6 +74,20 @@ def create_app(config_name):
     login_manager.init_app(app)
     pagedown.init_app(app)
 
+    from . import instrumentation
+    instrumentation.init_app(app)
+    from . import activity
+    activity.init_app(app)
+    from . import email
+    email.init_app(app)
+    from . import follow_graph
+    follow_graph.init_app(app)
+    from . import response_cache
+    response_cache.init_app(app)
+    from . import live
+    live.init_app(app)
+    sock.init_app(app)
+
     # attach routes
     from .main import main as main_blueprint
     app.register_blueprint(main_blueprint)
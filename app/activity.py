@@ -0,0 +1,100 @@
+import atexit
+import datetime
+import threading
+import time
+import weakref
+from flask import current_app
+from sqlalchemy.exc import SQLAlchemyError
+from . import db
+from .models import User, new_version
+
+_trackers = weakref.WeakSet()
+
+
+class LastSeenTracker:
+    '''Coalesces `last_seen` updates in memory and writes them in batches.
+
+    Requests only record the time a user was seen, the pending times are
+    written with a single UPDATE once `interval` seconds have passed since the
+    last flush, by the next request or by a timer thread if none comes, and
+    when the process exits. Users seen less than `min_delta`
+    seconds after their stored `last_seen` aren't recorded at all.
+    '''
+    def __init__(self, app, interval, min_delta):
+        self.app = app
+        self.interval = interval
+        self.min_delta = datetime.timedelta(seconds=min_delta)
+        self.pending = {}
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
+        self.flusher = None
+
+    def touch(self, user, now=None):
+        now = now or datetime.datetime.utcnow()
+        if user.last_seen is not None and now - user.last_seen < self.min_delta:
+            return
+        with self.lock:
+            self.pending[user.id] = now
+            due = time.monotonic() - self.last_flush >= self.interval
+            if not due and self.flusher is None:
+                self.flusher = threading.Thread(target=self._flush_later, daemon=True)
+                self.flusher.start()
+        if due:
+            self.flush()
+
+    def _flush_later(self):
+        # runs while anything is pending, a flush by a request meanwhile
+        # pushes the next one back
+        while True:
+            with self.lock:
+                if not self.pending:
+                    self.flusher = None
+                    return
+                wait = self.last_flush + self.interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+                continue
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('Writing last_seen failed')
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.last_flush = time.monotonic()
+        if not pending:
+            return 0
+        table = User.__table__
+        with self.app.app_context():
+            try:
+                with db.engine.begin() as connection:
+                    connection.execute(table.update()
+                                       .where(table.c.id.in_(pending.keys()))
+                                       .values(last_seen=db.case(pending, value=table.c.id),
+                                               **new_version(table)))
+            except SQLAlchemyError:
+                self.app.logger.exception('Could not write last_seen for %d users', len(pending))
+                return 0
+        return len(pending)
+
+
+def touch(user):
+    current_app.extensions['last_seen'].touch(user)
+
+
+def flush():
+    return current_app.extensions['last_seen'].flush()
+
+
+@atexit.register
+def _flush_all():
+    for tracker in list(_trackers):
+        tracker.flush()
+
+
+def init_app(app):
+    tracker = LastSeenTracker(app, app.config['FLASKY_LAST_SEEN_INTERVAL'],
+                              app.config['FLASKY_LAST_SEEN_MIN_DELTA'])
+    app.extensions['last_seen'] = tracker
+    _trackers.add(tracker)
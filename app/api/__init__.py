@@ -2,4 +2,4 @@ from flask import Blueprint
 
 api = Blueprint('api', __name__)
 
-from . import authentication, posts, comments, users, errors, followers
+from . import authentication, posts, comments, users, errors, followers, votes
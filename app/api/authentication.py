@@ -1,26 +1,152 @@
-from flask import g, jsonify
+import hashlib
+import hmac
+import time
+from flask import g, jsonify, current_app, has_app_context
 from flask_httpauth import HTTPBasicAuth
-from ..models import User
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from .. import db
+from ..cache import TTLCache
+from ..models import User, Role
 from .errors import unauthorized, forbidden
 from . import api
 
 auth = HTTPBasicAuth()
 
+# counters and last_seen are updated behind the ORM's back, along with the row
+# version. They are left out of the cached snapshots and loaded from the
+# database if something reads them
+_VOLATILE = {'post_count', 'follower_count', 'following_count', 'last_seen',
+             'version', 'updated_at'}
+# changing any of the other columns drops the cached snapshot of the user: it
+# is what the request's user is rendered from, when an API page embeds them
+_SNAPSHOT = [attr.key for attr in db.inspect(User).column_attrs
+             if attr.key not in _VOLATILE] + ['role']
+
+
+def _columns(obj, exclude=()):
+    return {attr.key: getattr(obj, attr.key)
+            for attr in db.inspect(type(obj)).column_attrs if attr.key not in exclude}
+
+
+def _snapshot(user):
+    return _columns(user, _VOLATILE), user.role and _columns(user.role)
+
+
+def _detached(model, columns):
+    obj = model.__mapper__.class_manager.new_instance()
+    for key, value in columns.items():
+        set_committed_value(obj, key, value)
+    make_transient_to_detached(obj)
+    return obj
+
+
+def _restore(snapshot):
+    '''Attach a copy of a cached user and its role to the session, without a query.'''
+    columns, role_columns = snapshot
+    user = _detached(User, columns)
+    set_committed_value(user, 'role', role_columns and _detached(Role, role_columns))
+    user = db.session.merge(user, load=False)
+    db.session.expire(user, _VOLATILE)
+    db.session.info.setdefault('auth_snapshots', set()).add(user.id)
+    return user
+
+
+def refresh_snapshots(users):
+    '''Reload the users among `users` that were restored from a snapshot.
+
+    The version and updated_at of a restored user come from the database,
+    the rest from a snapshot that can be older. A document built from it
+    needs the row the version belongs to.
+    '''
+    restored = db.session.info.get('auth_snapshots')
+    if not restored:
+        return
+    for user in users:
+        if isinstance(user, User) and user.id in restored:
+            restored.discard(user.id)
+            db.session.refresh(user)
+
+
+def _credentials_key(email, password):
+    # keyed, so the cache never holds anything a password could be guessed from
+    message = '{}\0{}'.format(email, password).encode('utf-8')
+    return 'password', hmac.new(current_app.config['SECRET_KEY'].encode('utf-8'),
+                                message, hashlib.sha256).digest()
+
+
+def _collect_changes(session, flush_context):
+    changed = session.info.setdefault('auth_cache_changes', set())
+    for obj in session.dirty | session.deleted:
+        state = db.inspect(obj)
+        if isinstance(obj, User) and (obj in session.deleted or any(
+                state.attrs[key].history.has_changes() for key in _SNAPSHOT)):
+            changed.add(obj.id)
+        elif isinstance(obj, Role) and state.attrs.permissions.history.has_changes():
+            changed.add(None)
+
+
+def _invalidate(session):
+    changed = session.info.pop('auth_cache_changes', None)
+    if not changed or not has_app_context():
+        return
+    cache = current_app.extensions.get('auth_cache')
+    if cache is None:
+        return
+    if None in changed:
+        cache.clear()
+    else:
+        cache.discard_where(lambda snapshot: snapshot[0]['id'] in changed)
+
+
+def _discard_changes(session):
+    session.info.pop('auth_cache_changes', None)
+
+
+db.event.listen(db.session, 'after_flush', _collect_changes)
+db.event.listen(db.session, 'after_commit', _invalidate)
+db.event.listen(db.session, 'after_rollback', _discard_changes)
+
+
+@api.record_once
+def init_cache(state):
+    config = state.app.config
+    state.app.extensions['auth_cache'] = TTLCache(config['FLASKY_AUTH_CACHE_SIZE'],
+                                                  config['FLASKY_AUTH_CACHE_TTL'])
+
 
 @auth.verify_password
 def verify_password(email_or_token, password):
     if email_or_token == '':
         return False
+    cache = current_app.extensions['auth_cache']
     if password == '':
-        g.current_user = User.verify_auth_token(email_or_token)
         g.token_used = True
-        return g.current_user is not None
+        key = 'token', email_or_token
+        snapshot = cache.get(key)
+        if snapshot is not None:
+            g.current_user = _restore(snapshot)
+            return True
+        data = User.auth_token_data(email_or_token)
+        g.current_user = data and User.query.get(data['id'])
+        if g.current_user is None:
+            return False
+        cache.set(key, _snapshot(g.current_user), ttl=data['exp'] - time.time())
+        return True
+    g.token_used = False
+    key = _credentials_key(email_or_token, password)
+    snapshot = cache.get(key)
+    if snapshot is not None:
+        g.current_user = _restore(snapshot)
+        return True
     user = User.query.filter_by(email=email_or_token).first()
     if not user or user.server_own:
         return False
     g.current_user = user
-    g.token_used = False
-    return user.verify_password(password)
+    if not user.verify_password(password):
+        return False
+    cache.set(key, _snapshot(user))
+    return True
 
 
 @auth.error_handler
@@ -0,0 +1,59 @@
+'''Helpers of the batch endpoints, which handle many items in one request.
+
+A batch is checked as a whole (it has to be a non-empty list of at most
+FLASKY_API_BATCH_SIZE items), then every item gets a result of its own with
+an HTTP status, so one missing post doesn't fail the others.
+'''
+from flask import current_app, request
+from ..exceptions import ValidationError
+from . import serializers
+from .conditional import conditional_json, page_etag
+
+
+def _checked(entries):
+    if not entries:
+        raise ValidationError('the batch is empty')
+    limit = current_app.config['FLASKY_API_BATCH_SIZE']
+    if len(entries) > limit:
+        raise ValidationError(f'a batch has at most {limit} items')
+    return entries
+
+
+def ids_argument():
+    '''The ids of `?ids=1,2,3`, None if the request has no ids argument.'''
+    value = request.args.get('ids')
+    if value is None:
+        return None
+    try:
+        ids = [int(id) for id in value.split(',') if id.strip()]
+    except ValueError:
+        raise ValidationError('ids must be a comma separated list of integers')
+    return _checked(ids)
+
+
+def items(key):
+    '''The list of objects under `key` in the JSON body.'''
+    json = request.get_json(silent=True)
+    entries = json.get(key) if isinstance(json, dict) else None
+    if not isinstance(entries, list) or \
+            not all(isinstance(entry, dict) for entry in entries):
+        raise ValidationError(f'{key} must be a list of objects')
+    return _checked(entries)
+
+
+def read(kind, model, query, ids):
+    '''The resources of `kind` with `ids`, in one query, as one result per id.
+
+    Ids `query` doesn't find are a 404. `fields` and `expand` work as on the
+    other GET endpoints.
+    '''
+    found = {obj.id: obj for obj in query.filter(model.id.in_(set(ids)))}
+    objects = list(found.values())
+    page = serializers.Page(kind, objects)
+    name = kind[:-1]
+
+    def build():
+        documents = dict(zip(found, page.build()))
+        return {kind: [{'id': id, 'status': 200, name: documents[id]} if id in documents
+                       else {'id': id, 'status': 404} for id in ids]}
+    return conditional_json(page_etag(objects + page.related, len(objects), tuple(ids)), build)
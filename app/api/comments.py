@@ -1,29 +1,34 @@
 from flask import jsonify, current_app, url_for, request, g
 from .. import db
 from ..models import Post, Comment, Permission
-from . import api
+from ..pagination import paginate
+from . import api, serializers
 from .decorators import permission_required
 from .errors import forbidden
+from .conditional import conditional_json, page_etag, resource_json
 
 
 @api.route('/posts/<int:id>/comments/')
 def get_post_comments(id):
-    page = request.args.get('page', 1, type=int)
     post = Post.query.get_or_404(id)
-    pagination = post.comments.order_by(Comment.timestamp.asc()).paginate(
-        page=page, per_page=current_app.config['FLASKY_COMMENTS_PER_PAGE'],
-        error_out=False)
+    pagination = paginate(post.comments, (Comment.timestamp, Comment.id), descending=False,
+                          per_page=current_app.config['FLASKY_COMMENTS_PER_PAGE'])
     comments = pagination.items
     prev = None
-    if pagination.has_prev:
-        prev = url_for('api.get_post_comments', id=id, page=page-1)
+    if pagination.prev_cursor:
+        prev = url_for('api.get_post_comments', id=id, cursor=pagination.prev_cursor)
     next = None
-    if pagination.has_next:
-        next = url_for('api.get_post_comments', id=id, page=page+1)
-    return jsonify({
-        'comments': [comment.to_json() for comment in comments],
+    if pagination.next_cursor:
+        next = url_for('api.get_post_comments', id=id, cursor=pagination.next_cursor)
+    page = serializers.Page('comments', comments)
+    etag = page_etag(comments + page.related, pagination.total,
+                     pagination.prev_cursor, pagination.next_cursor)
+    return conditional_json(etag, lambda: {
+        'comments': page.build(),
         'prev_url': prev,
         'next_url': next,
+        'prev_cursor': pagination.prev_cursor,
+        'next_cursor': pagination.next_cursor,
         'count': pagination.total})
 
 
@@ -36,33 +41,36 @@ def new_comment(id):
     comment.post = post
     db.session.add(comment)
     db.session.commit()
-    return jsonify(comment.to_json()), 201, \
+    return jsonify(serializers.comment(comment)), 201, \
             {'Location': url_for('api.get_comment', id=comment.id)}
 
 
 @api.route('/comments/<int:id>')
 def get_comment(id):
     comment = Comment.query.get_or_404(id)
-    return jsonify(comment.to_json())
+    return resource_json(comment, 'comments')
 
 
 @api.route('/comments/')
 def get_comments():
-    page = request.args.get('page', 1, type=int)
-    pagination = Comment.query.order_by(Comment.timestamp.desc()).paginate(
-            page=page, per_page=current_app.config['FLASKY_COMMENTS_PER_PAGE'],
-            error_out=False)
+    pagination = paginate(Comment.query, (Comment.timestamp, Comment.id),
+                          per_page=current_app.config['FLASKY_COMMENTS_PER_PAGE'])
     comments = pagination.items
     prev = None
-    if pagination.has_prev:
-        prev = url_for('api.get_comments', page=page-1)
+    if pagination.prev_cursor:
+        prev = url_for('api.get_comments', cursor=pagination.prev_cursor)
     next = None
-    if pagination.has_next:
-        next = url_for('api.get_comments', page=page+1)
-    return jsonify({
-        'comments': [comment.to_json() for comment in comments],
+    if pagination.next_cursor:
+        next = url_for('api.get_comments', cursor=pagination.next_cursor)
+    page = serializers.Page('comments', comments)
+    etag = page_etag(comments + page.related, pagination.total,
+                     pagination.prev_cursor, pagination.next_cursor)
+    return conditional_json(etag, lambda: {
+        'comments': page.build(),
         'prev_url': prev,
         'next_url': next,
+        'prev_cursor': pagination.prev_cursor,
+        'next_cursor': pagination.next_cursor,
         'count': pagination.total})
         
 
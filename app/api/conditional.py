@@ -0,0 +1,49 @@
+import datetime
+import hashlib
+from flask import current_app, jsonify, request
+from .serializers import Page
+
+
+def resource_etag(obj):
+    return f'{obj.__tablename__}-{obj.id}-{obj.version}'
+
+
+def page_etag(items, total, *extra):
+    '''A page changes when any of its rows does, or rows come and go.'''
+    key = repr(([(type(item).__tablename__, item.id, item.version) for item in items],
+                total) + extra)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _not_modified(etag, last_modified):
+    # If-None-Match wins over If-Modified-Since when a client sends both
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and last_modified:
+        last_modified = last_modified.replace(microsecond=0, tzinfo=datetime.timezone.utc)
+        return last_modified <= request.if_modified_since
+    return False
+
+
+def conditional_json(etag, build, last_modified=None):
+    '''jsonify(build()) with a strong ETag, or a 304 if the client's copy is current.
+
+    `build` is only called when the body is going to be sent.
+    '''
+    if _not_modified(etag, last_modified):
+        response = current_app.response_class(status=304)
+    else:
+        response = jsonify(build())
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified.replace(tzinfo=datetime.timezone.utc)
+    return response
+
+
+def resource_json(obj, kind):
+    '''The document of `obj` as a resource of `kind`, see serializers.Page.'''
+    page = Page(kind, [obj])
+    objects = [obj] + page.related
+    etag = page_etag(objects, 1) if page.related else resource_etag(obj)
+    last_modified = max((o.updated_at for o in objects if o.updated_at), default=None)
+    return conditional_json(etag, lambda: page.build()[0], last_modified)
@@ -2,27 +2,34 @@ from .. import db
 from ..models import User, Permission, Follow
 from flask import jsonify, g, request, url_for, current_app
 from .decorators import permission_required
-from . import api
+from ..pagination import paginate
+from . import api, serializers
 
 
 @api.route('/users/<int:id>/followers/')
 def get_user_followers(id):
-    page = request.args.get('page', 1, type=int)
     user = User.query.get_or_404(id)
-    pagination = user.followers.order_by(Follow.timestamp.desc()).paginate(
-        page=page, per_page=current_app.config['FLASKY_FOLLOWERS_PER_PAGE'],
-        error_out=False)
+    pagination = paginate(user.followers, (Follow.timestamp, Follow.follower_id),
+                          per_page=current_app.config['FLASKY_FOLLOWERS_PER_PAGE'])
     followers = pagination.items
+    page = serializers.Page('follows', followers, extra_fields=['following'])
+    entries = page.build()
+    if page.wants('following'):
+        relationships = g.current_user.relationships(f.follower_id for f in followers)
+        for entry, follow in zip(entries, followers):
+            entry['following'] = relationships[follow.follower_id][0]
     prev = None
-    if pagination.has_prev:
-        prev = url_for('api.get_user_followers', id=id, page=page-1)
+    if pagination.prev_cursor:
+        prev = url_for('api.get_user_followers', id=id, cursor=pagination.prev_cursor)
     next = None
-    if pagination.has_next:
-        next = url_for('api.get_user_followers', id=id, page=page+1)
+    if pagination.next_cursor:
+        next = url_for('api.get_user_followers', id=id, cursor=pagination.next_cursor)
     return jsonify({
-        'followers': [Follow.to_json(follower) for follower in followers],
+        'followers': entries,
         'prev_url': prev,
         'next_url': next,
+        'prev_cursor': pagination.prev_cursor,
+        'next_cursor': pagination.next_cursor,
         'count': pagination.total})
 
 
@@ -32,7 +39,7 @@ def follow(id):
    u = User.query.get_or_404(id)
    g.current_user.follow(u)
    db.session.commit()
-   return jsonify(Follow.to_json(u.followers.filter_by(follower=g.current_user).first())), 201
+   return jsonify(serializers.follows([u.followers.filter_by(follower=g.current_user).first()])[0]), 201
 
 @api.route('/unfollow/<int:id>', methods=['DELETE'])
 @permission_required(Permission.FOLLOW)
@@ -1,36 +1,44 @@
-from . import api
+from . import api, batch, serializers
 from .. import db
 from ..models import Post, Permission
+from ..pagination import paginate
 from flask import jsonify, g, request, url_for, current_app
 from .decorators import permission_required
 from .errors import forbidden
+from app.exceptions import ValidationError
+from .conditional import conditional_json, page_etag, resource_json
 
 
 @api.route('/posts/')
 def get_posts():
-    page = request.args.get('page', 1, type=int)
-    pagination = Post.query.filter(Post.deleted != True).paginate(
-        page=page, per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
-        error_out=False)
+    ids = batch.ids_argument()
+    if ids is not None:
+        return batch.read('posts', Post, Post.query.filter(Post.deleted != True), ids)
+    pagination = paginate(Post.query.filter(Post.deleted != True), (Post.timestamp, Post.id),
+                          per_page=current_app.config['FLASKY_POSTS_PER_PAGE'])
     posts = pagination.items
     prev = None
-    if pagination.has_prev:
-        prev = url_for('api.get_posts', page=page-1)
+    if pagination.prev_cursor:
+        prev = url_for('api.get_posts', cursor=pagination.prev_cursor)
     next = None
-    if pagination.has_next:
-        next = url_for('api.get_posts', page=page+1)
-    return jsonify({
-        'posts': [post.to_json() for post in posts],
+    if pagination.next_cursor:
+        next = url_for('api.get_posts', cursor=pagination.next_cursor)
+    page = serializers.Page('posts', posts)
+    etag = page_etag(posts + page.related, pagination.total,
+                     pagination.prev_cursor, pagination.next_cursor)
+    return conditional_json(etag, lambda: {
+        'posts': page.build(),
         'prev_url': prev,
         'next_url': next,
-        'count': pagination.total
-    })
+        'prev_cursor': pagination.prev_cursor,
+        'next_cursor': pagination.next_cursor,
+        'count': pagination.total})
 
 
 @api.route('/posts/<int:id>')
 def get_post(id):
     post = Post.query.get_or_404(id)
-    return jsonify(post.to_json())
+    return resource_json(post, 'posts')
 
 
 @api.route('/posts/', methods=['POST'])
@@ -40,10 +48,40 @@ def new_post():
     post.author = g.current_user
     db.session.add(post)
     db.session.commit()
-    return jsonify(post.to_json()), 201, \
+    return jsonify(serializers.post(post)), 201, \
             {'Location': url_for('api.get_post', id=post.id)}
 
 
+@api.route('/posts/batch', methods=['POST'])
+@permission_required(Permission.WRITE)
+def new_posts():
+    '''Create the posts of {"posts": [...]} in one transaction.
+
+    Each post gets a result: 201 with the post, or 400 if it is invalid.
+    '''
+    results, created = [], []
+    for json_post in batch.items('posts'):
+        try:
+            post = Post.from_json(json_post)
+        except ValidationError as e:
+            results.append({'status': 400, 'message': e.args[0]})
+            continue
+        post.author = g.current_user
+        db.session.add(post)
+        results.append({'status': 201})
+        created.append(post)
+    db.session.flush()
+    ids = [post.id for post in created]
+    db.session.commit()
+    # reloads the committed posts in one query rather than one each
+    posts = {post.id: post for post in Post.query.filter(Post.id.in_(ids))}
+    documents = iter(serializers.posts([posts[id] for id in ids]))
+    for result in results:
+        if result['status'] == 201:
+            result['post'] = next(documents)
+    return jsonify({'posts': results})
+
+
 @api.route('/posts/<int:id>', methods=['PUT'])
 @permission_required(Permission.WRITE)
 def edit_post(id):
@@ -56,7 +94,7 @@ def edit_post(id):
     post.body = request.json.get('body', post.body)
     db.session.add(post)
     db.session.commit()
-    return jsonify(post.to_json())
+    return jsonify(serializers.post(post))
 
 
 @api.route('/delete/post/<int:id>', methods=['PUT'])
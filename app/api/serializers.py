@@ -0,0 +1,242 @@
+'''Plain dict serializers for whole pages of API resources.
+
+They produce the same documents as the models' to_json methods, but every
+URL comes from a template built once per app instead of a url_for call per
+link, and what a page needs from other tables is fetched in one query.
+
+Clients pick what they get with two query string arguments, on every GET
+endpoint: `fields=title,url` keeps only the listed fields, and
+`expand=author,comments` embeds related resources in the documents.
+'''
+from flask import current_app, request, url_for
+from .. import db
+from ..exceptions import ValidationError
+from ..models import User, Post, Comment
+from .authentication import refresh_snapshots
+
+# an id no row has, it is swapped for a format field in the built URL
+_MARKER = 2147483647
+
+
+def url_template(endpoint):
+    '''url_for(endpoint, id=...) as a format string.'''
+    templates = current_app.extensions.setdefault('url_templates', {})
+    key = endpoint, request.script_root
+    template = templates.get(key)
+    if template is None:
+        template = templates[key] = url_for(endpoint, id=_MARKER).replace(str(_MARKER), '{}')
+    return template
+
+
+def _urls(*endpoints):
+    return [url_template(endpoint).format for endpoint in endpoints]
+
+
+def _post_fields():
+    url, author_url, comments_url = _urls('api.get_post', 'api.get_user',
+                                          'api.get_post_comments')
+    return {
+        'url': lambda post: url(post.id),
+        'title': lambda post: post.title,
+        'body': lambda post: post.body,
+        'body_html': lambda post: post.body_html,
+        'timestamp': lambda post: post.timestamp,
+        'author_url': lambda post: author_url(post.author_id),
+        'comments_url': lambda post: comments_url(post.id),
+        'comments_count': lambda post: post.comment_count,
+        'vote_count': lambda post: post.vote_count}
+
+
+def _comment_fields():
+    url, post_url, author_url = _urls('api.get_comment', 'api.get_post', 'api.get_user')
+    return {
+        'url': lambda comment: url(comment.id),
+        'post_url': lambda comment: post_url(comment.post_id),
+        'body': lambda comment: comment.body,
+        'body_html': lambda comment: comment.body_html,
+        'timestamp': lambda comment: comment.timestamp,
+        'author_url': lambda comment: author_url(comment.author_id),
+        'vote_count': lambda comment: comment.vote_count}
+
+
+def _user_fields():
+    url, posts_url, timeline_url = _urls('api.get_user', 'api.get_user_posts',
+                                         'api.get_user_followed_posts')
+    return {
+        'url': lambda user: url(user.id),
+        'username': lambda user: user.username,
+        'member_since': lambda user: user.member_since,
+        'last_seen': lambda user: user.last_seen,
+        'posts_url': lambda user: posts_url(user.id),
+        'followed_posts_url': lambda user: timeline_url(user.id),
+        'post_count': lambda user: user.post_count}
+
+
+def _follow_fields():
+    url, = _urls('api.get_user')
+    return {
+        'follower': lambda follow: follow.follower.username,
+        'follower_url': lambda follow: url(follow.follower_id),
+        'follower_since': lambda follow: follow.timestamp}
+
+
+def _users_by_id(ids):
+    '''The users with `ids`, one query for those the session doesn't hold yet.'''
+    identity_map = db.session.identity_map
+    users = {}
+    for id in ids:
+        user = identity_map.get(db.inspect(User).identity_key_from_primary_key((id,)))
+        if user is not None and not db.inspect(user).unloaded:
+            users[id] = user
+    missing = set(ids) - users.keys()
+    if missing:
+        users.update((user.id, user) for user in User.query.filter(User.id.in_(missing)))
+    refresh_snapshots(users.values())
+    return users
+
+
+# an expansion loads the related rows of a page and returns them, with a
+# function giving the getter of the embedded documents once they're needed
+
+def _by_key(kind, rows, key):
+    def getter():
+        documents = dict(zip((row.id for row in rows), _build(kind, rows)))
+        return lambda item: documents.get(getattr(item, key))
+    return getter
+
+
+def _expand_users(key):
+    def expand(items):
+        users = list(_users_by_id({getattr(item, key) for item in items}).values())
+        return users, _by_key('users', users, key)
+    return expand
+
+
+def _expand_post(items):
+    posts = Post.query.filter(Post.id.in_({item.post_id for item in items})).all()
+    return posts, _by_key('posts', posts, 'post_id')
+
+
+def _expand_comments(items):
+    '''The latest FLASKY_API_EXPAND_COMMENTS comments of each post, in one query.'''
+    limit = current_app.config['FLASKY_API_EXPAND_COMMENTS']
+    rank = db.func.row_number().over(partition_by=Comment.post_id,
+                                     order_by=(Comment.timestamp.desc(), Comment.id.desc()))
+    latest = db.select(Comment.id, rank.label('rank'))\
+        .where(Comment.post_id.in_({item.id for item in items})).subquery()
+    comments = Comment.query.join(latest, latest.c.id == Comment.id)\
+        .filter(latest.c.rank <= limit)\
+        .order_by(Comment.post_id, Comment.timestamp.desc(), Comment.id.desc()).all()
+
+    def getter():
+        by_post = {}
+        for comment, document in zip(comments, _build('comments', comments)):
+            by_post.setdefault(comment.post_id, []).append(document)
+        return lambda item: by_post.get(item.id, [])
+    return comments, getter
+
+
+def _load_followers(items):
+    _users_by_id({item.follower_id for item in items})
+
+
+# for each kind of resource: its fields, what `expand` can embed in it and
+# what to load for a whole page before building its documents
+KINDS = {
+    'posts': (_post_fields, {'author': _expand_users('author_id'),
+                             'comments': _expand_comments}, None),
+    'comments': (_comment_fields, {'author': _expand_users('author_id'),
+                                   'post': _expand_post}, None),
+    'users': (_user_fields, {}, None),
+    'follows': (_follow_fields, {'follower': _expand_users('follower_id')}, _load_followers),
+}
+
+
+def _names(argument, allowed):
+    value = request.args.get(argument)
+    if not value:
+        return None
+    names = [name.strip() for name in value.split(',') if name.strip()]
+    unknown = set(names) - set(allowed)
+    if unknown:
+        raise ValidationError(f'unknown {argument}: {", ".join(sorted(unknown))}')
+    return names
+
+
+def options(kind, extra_fields=()):
+    '''The `fields` and `expand` the request asks for, checked against `kind`.'''
+    fields, expansions, _ = KINDS[kind]
+    return (_names('fields', list(fields()) + list(extra_fields)),
+            _names('expand', expansions))
+
+
+def _build(kind, items, fields=None, expanded=()):
+    getters, _, prefetch = KINDS[kind]
+    getters = getters()
+    if fields is not None:
+        getters = {name: getter for name, getter in getters.items() if name in fields}
+    getters.update(expanded)
+    if prefetch is not None and items:
+        prefetch(items)
+    return [{name: getter(item) for name, getter in getters.items()} for item in items]
+
+
+class Page:
+    '''Serializes a page of `kind` the way the request asks for.
+
+    Expanded resources are loaded up front, so `related` can go into the
+    page's ETag, and the documents are only built by build().
+    '''
+    def __init__(self, kind, items, extra_fields=()):
+        self.kind = kind
+        self.items = items
+        self.fields, expand = options(kind, extra_fields)
+        self.expansions, self.related = {}, []
+        expansions = KINDS[kind][1]
+        for name in expand or ():
+            related, self.expansions[name] = expansions[name](items)
+            self.related.extend(related)
+        refresh_snapshots(list(items) + self.related)
+
+    def wants(self, field):
+        return self.fields is None or field in self.fields
+
+    def build(self):
+        expanded = {name: getter() for name, getter in self.expansions.items()}
+        return _build(self.kind, self.items, self.fields, expanded)
+
+
+def posts(items):
+    return _build('posts', items)
+
+
+def comments(items):
+    return _build('comments', items)
+
+
+def users(items):
+    return _build('users', items)
+
+
+def follows(items, following=None):
+    '''Follows as followers, with a 'following' flag from `following` if given.
+
+    Followers the query didn't load already are looked up in one query.
+    '''
+    result = _build('follows', items)
+    if following is not None:
+        for entry, item in zip(result, items):
+            entry['following'] = following[item.follower_id]
+    return result
+
+
+def post(item):
+    return posts([item])[0]
+
+
+def comment(item):
+    return comments([item])[0]
+
+
+def user(item):
+    return users([item])[0]
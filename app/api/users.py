@@ -1,51 +1,85 @@
 from flask import jsonify, current_app, url_for, request
-from ..models import User, Post
-from . import api
+from ..models import User, Post, Suggestion
+from ..pagination import paginate
+from . import api, batch, serializers
+from .conditional import conditional_json, page_etag, resource_json
+from app.exceptions import ValidationError
+
+
+@api.route('/users/')
+def get_users():
+    ids = batch.ids_argument()
+    if ids is None:
+        raise ValidationError('ids of the users were not given')
+    return batch.read('users', User, User.query, ids)
 
 
 @api.route('/users/<int:id>')
 def get_user(id):
     user = User.query.get_or_404(id)
-    return jsonify(user.to_json())
+    return resource_json(user, 'users')
+
+
+@api.route('/users/<int:id>/suggestions/')
+def get_user_suggestions(id):
+    user = User.query.get_or_404(id)
+    top = current_app.config['FLASKY_SUGGESTIONS_TOP']
+    limit = min(max(request.args.get('limit', top, type=int), 1), top)
+    suggestions = Suggestion.for_user(user.id, limit)
+    page = serializers.Page('users', [suggested for suggested, _ in suggestions],
+                            extra_fields=['score'])
+    entries = page.build()
+    if page.wants('score'):
+        for entry, (_, score) in zip(entries, suggestions):
+            entry['score'] = score
+    return jsonify({
+        'suggestions': entries,
+        'count': len(suggestions)})
 
 
 @api.route('/users/<int:id>/posts/')
 def get_user_posts(id):
     user = User.query.get_or_404(id)
-    page = request.args.get('page', 1, type=int)
-    pagination = user.posts.order_by(Post.timestamp.desc()).paginate(
-        page=page, per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
-        error_out=False)
+    pagination = paginate(user.posts, (Post.timestamp, Post.id),
+                          per_page=current_app.config['FLASKY_POSTS_PER_PAGE'])
     posts = pagination.items
     prev = None
-    if pagination.has_prev:
-        prev = url_for('api.get_user_posts', id=id, page=page-1)
+    if pagination.prev_cursor:
+        prev = url_for('api.get_user_posts', id=id, cursor=pagination.prev_cursor)
     next = None
-    if pagination.has_next:
-        next = url_for('api.get_user_posts', id=id, page=page+1)
-    return jsonify({
-        'posts': [post.to_json() for post in user.posts],
+    if pagination.next_cursor:
+        next = url_for('api.get_user_posts', id=id, cursor=pagination.next_cursor)
+    page = serializers.Page('posts', posts)
+    etag = page_etag(posts + page.related, pagination.total,
+                     pagination.prev_cursor, pagination.next_cursor)
+    return conditional_json(etag, lambda: {
+        'posts': page.build(),
         'prev_url': prev,
         'next_url': next,
+        'prev_cursor': pagination.prev_cursor,
+        'next_cursor': pagination.next_cursor,
         'count': pagination.total})
 
 
 @api.route('/users/<int:id>/timeline/')
 def get_user_followed_posts(id):
     user = User.query.get_or_404(id)
-    page = request.args.get('page', 1, type=int)
-    pagination = user.followed_posts.order_by(Post.timestamp.desc()).paginate(
-        page=page, per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
-        error_out=False)
+    pagination = paginate(user.timeline(), (Post.timestamp, Post.id),
+                          per_page=current_app.config['FLASKY_POSTS_PER_PAGE'])
     posts = pagination.items
     prev = None
-    if pagination.has_prev:
-        prev = url_for('api.get_user_followed_posts', id=id, page=page-1)
+    if pagination.prev_cursor:
+        prev = url_for('api.get_user_followed_posts', id=id, cursor=pagination.prev_cursor)
     next = None
-    if pagination.has_next:
-        next = url_for('get_user_followed_posts', id=id, page=page+1)
-    return jsonify({
-        'posts': [post.to_json() for post in user.posts],
+    if pagination.next_cursor:
+        next = url_for('api.get_user_followed_posts', id=id, cursor=pagination.next_cursor)
+    page = serializers.Page('posts', posts)
+    etag = page_etag(posts + page.related, pagination.total,
+                     pagination.prev_cursor, pagination.next_cursor)
+    return conditional_json(etag, lambda: {
+        'posts': page.build(),
         'prev_url': prev,
         'next_url': next,
+        'prev_cursor': pagination.prev_cursor,
+        'next_cursor': pagination.next_cursor,
         'count': pagination.total})
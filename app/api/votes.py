@@ -1,40 +1,118 @@
 from flask import jsonify, request, g
-from ..models import Post, Comment
-from . import api
+from .. import db
+from ..models import Post, Comment, Vote
+from . import api, batch, serializers
+from .errors import forbidden
 from app.exceptions import ValidationError
 
+_MODELS = {'post': Post, 'comment': Comment}
+_ACTIONS = {'up': 'UP', 'down': 'DOWN', 'remove': None}
+
+
+def _obj_type(json):
+    obj_type = json.get('obj_type') if isinstance(json, dict) else None
+    if obj_type is None:
+        raise ValidationError('obj_type was not given. post or comment?')
+    if obj_type not in _MODELS:
+        raise ValidationError('obj_type must be either "post" or "comment".')
+    return obj_type
+
+
+def _apply(obj, action):
+    '''Cast or remove the vote of the current user, returns their vote afterwards.'''
+    status = _ACTIONS[action]
+    if status is None:
+        Vote.remove(g.current_user, obj)
+    else:
+        Vote.cast(g.current_user, obj, status)
+    return status
+
+
+def _vote(id, action):
+    obj_type = _obj_type(request.get_json(silent=True))
+    obj = _MODELS[obj_type].query.get_or_404(id)
+    if not obj.editable:
+        return forbidden(f'{obj_type} is not editable.')
+    _apply(obj, action)
+    db.session.commit()
+    if action == 'remove':
+        return '', 204
+    return jsonify(getattr(serializers, obj_type)(obj)), 201
+
 
 @api.route('/upvote/<int:id>', methods=['POST'])
 def upvote(id):
-    obj_type = request.json.get('obj_type',
-                                exec("raise ValidationError('obj_type was not given. post or comment?')"))
-    if obj_type not in ['comment', 'post']:
-        raise ValidationError('obj_type must be either "post" or "comment".')
-    table = Post if obj_type == 'post' else Comment
-    obj = table.query.get_or_404()
-    g.current_user.upvote(obj_type, obj)
-    return jsonify(obj.to_json()), 201
+    return _vote(id, 'up')
 
 
 @api.route('/downvote/<int:id>', methods=['POST'])
 def downvote(id):
-    obj_type = request.json.get('obj_type',
-                                exec("raise ValidationError('obj_type was not given. post or comment?')"))
-    if obj_type not in ['comment', 'post']:
-        raise ValidationError('obj_type must be either "post" or "comment".')
-    table = Post if obj_type == 'post' else Comment
-    obj = table.query.get_or_404()
-    g.current_user.downvote(obj_type, obj)
-    return jsonify(obj.to_json()), 201
+    return _vote(id, 'down')
 
 
 @api.route('/remove-vote/<int:id>', methods=['DELETE'])
 def remove_vote(id):
-    obj_type = request.json.get('obj_type',
-                                exec("raise ValidationError('obj_type was not given. post or comment?')"))
-    if obj_type not in ['comment', 'post']:
-        raise ValidationError('obj_type must be either "post" or "comment".')
-    table = Post if obj_type == 'post' else Comment
-    obj = table.query.get_or_404()
-    g.current_user.remove_vote(obj)
-    return '', 204
+    return _vote(id, 'remove')
+
+
+def _entry(entry):
+    obj_type = _obj_type(entry)
+    id = entry.get('id')
+    if not isinstance(id, int) or isinstance(id, bool):
+        raise ValidationError('id must be an integer')
+    action = entry.get('action')
+    if action not in _ACTIONS:
+        raise ValidationError('action must be "up", "down" or "remove".')
+    return obj_type, id, action
+
+
+@api.route('/votes/batch', methods=['POST'])
+def vote_batch():
+    '''Apply {"obj_type", "id", "action"} votes in order, in one transaction.
+
+    Each vote gets a result with a status: 200 with the new vote_count of
+    the object, 400 for a malformed vote, 404 or 403 if the object can't
+    be voted on.
+    '''
+    entries = batch.items('votes')
+    parsed = []
+    for entry in entries:
+        try:
+            parsed.append(_entry(entry))
+        except ValidationError as e:
+            parsed.append(e)
+    objects = {}
+    for obj_type, model in _MODELS.items():
+        ids = {p[1] for p in parsed if isinstance(p, tuple) and p[0] == obj_type}
+        if ids:
+            objects.update(((obj_type, obj.id), obj)
+                           for obj in model.query.filter(model.id.in_(ids)))
+
+    results = []
+    for entry in parsed:
+        if isinstance(entry, ValidationError):
+            results.append({'status': 400, 'message': entry.args[0]})
+            continue
+        obj_type, id, action = entry
+        result = {'obj_type': obj_type, 'id': id, 'action': action}
+        obj = objects.get((obj_type, id))
+        if obj is None:
+            result['status'] = 404
+        elif not obj.editable:
+            result['status'] = 403
+        else:
+            result.update(status=200, vote=_apply(obj, action))
+        results.append(result)
+    db.session.commit()
+
+    # the counts of everything voted on, in one query per table
+    counts = {}
+    for obj_type, model in _MODELS.items():
+        ids = {r['id'] for r in results if r['status'] == 200 and r['obj_type'] == obj_type}
+        if ids:
+            counts.update(((obj_type, id), vote_count) for id, vote_count in
+                          db.session.query(model.id, model.vote_count).filter(model.id.in_(ids)))
+    for result in results:
+        if result['status'] == 200:
+            result['vote_count'] = counts[result['obj_type'], result['id']]
+    return jsonify({'votes': results})
@@ -4,7 +4,7 @@ from .forms import LoginForm, RegistrationForm, ChangePassword, ResetPasswordFor
 from .forms import ChangeEmailForm
 from ..models import User
 from flask_login import login_user, login_required, logout_user
-from .. import db
+from .. import db, activity
 from ..email import send_email
 from flask_login import current_user
 
@@ -63,8 +63,10 @@ def confirm(token):
 
 @auth.before_app_request
 def before_request():
+    if request.endpoint == 'static':
+        return
     if current_user.is_authenticated:
-        current_user.ping()
+        activity.touch(current_user)
         if not current_user.confirmed \
                 and request.endpoint \
                 and request.blueprint != 'auth' \
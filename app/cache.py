@@ -0,0 +1,56 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    '''A thread safe LRU mapping whose entries also expire after `ttl` seconds.
+
+    `on_evict(key, value)` is called, under the lock, for the least recently
+    used entries pushed out by set().
+    '''
+    def __init__(self, maxsize=1024, ttl=60, on_evict=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires <= time.monotonic():
+                del self.data[key]
+                return default
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        with self.lock:
+            self.data[key] = (value, time.monotonic() + ttl)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                key, (value, _) = self.data.popitem(last=False)
+                if self.on_evict is not None:
+                    self.on_evict(key, value)
+
+    def discard(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def discard_where(self, predicate):
+        '''Drop the entries whose value matches `predicate`.'''
+        with self.lock:
+            for key in [key for key, (value, _) in self.data.items() if predicate(value)]:
+                del self.data[key]
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
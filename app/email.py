@@ -1,12 +1,154 @@
-from threading import Thread
+import atexit
+import queue
+import smtplib
+import threading
+import time
+import weakref
 from flask import current_app, render_template
 from flask_mail import Message
 from . import mail
 
+_queues = weakref.WeakSet()
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+
+class MailQueue:
+    '''A bounded queue of messages sent by a fixed pool of worker threads.
+
+    A worker keeps its SMTP connection open while messages keep coming, it
+    closes it and exits after FLASKY_MAIL_IDLE seconds without any. A failed
+    send is retried on a new connection after FLASKY_MAIL_BACKOFF seconds,
+    doubled on every attempt, up to FLASKY_MAIL_RETRIES times.
+    '''
+    def __init__(self, app):
+        config = app.config
+        self.app = app
+        self.size = config['FLASKY_MAIL_QUEUE_SIZE']
+        self.workers = config['FLASKY_MAIL_WORKERS']
+        self.retries = config['FLASKY_MAIL_RETRIES']
+        self.backoff = config['FLASKY_MAIL_BACKOFF']
+        self.idle = config['FLASKY_MAIL_IDLE']
+        self.enqueue_timeout = config['FLASKY_MAIL_ENQUEUE_TIMEOUT']
+        self.queue = queue.Queue(self.size)
+        self.threads = []
+        self.lock = threading.Lock()
+        self.counts = {'sent': 0, 'retried': 0, 'failed': 0, 'dropped': 0}
+
+    def _count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def start(self):
+        '''Make sure the pool has its workers, they exit when there is no mail.'''
+        with self.lock:
+            # a worker that died without deregistering doesn't count
+            self.threads = [thread for thread in self.threads if thread.is_alive()]
+            for _ in range(self.workers - len(self.threads)):
+                thread = threading.Thread(target=self._work, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+        _queues.add(self)
+
+    def put(self, msg):
+        '''Queue `msg`, returns False if the queue stayed full for too long.'''
+        try:
+            self.queue.put((msg, 0), timeout=self.enqueue_timeout)
+        except queue.Full:
+            self._count('dropped')
+            self.app.logger.error('Mail queue full, dropped message to %s', msg.recipients)
+            return False
+        finally:
+            self.start()
+        return True
+
+    def metrics(self):
+        with self.lock:
+            return dict(self.counts, depth=self.queue.qsize(), capacity=self.size,
+                        workers=sum(thread.is_alive() for thread in self.threads))
+
+    def _work(self):
+        with self.app.app_context():
+            while True:
+                try:
+                    item = self.queue.get(timeout=self.idle)
+                except queue.Empty:
+                    # checked under the lock start() takes, so a message queued
+                    # meanwhile is either seen here or given a new worker
+                    with self.lock:
+                        if self.queue.empty():
+                            self.threads.remove(threading.current_thread())
+                            return
+                    continue
+                if item is None:
+                    self.queue.task_done()
+                if item is None or not self._deliver(item):
+                    with self.lock:
+                        self.threads.remove(threading.current_thread())
+                    return
+
+    def _deliver(self, item):
+        '''Send `item` and the messages that follow it on one connection.
+
+        Returns False once a shutdown sentinel was taken from the queue.
+        '''
+        pending, running = item, True
+        try:
+            with mail.connect() as connection:
+                while pending is not None:
+                    connection.send(pending[0])
+                    self._count('sent')
+                    self.queue.task_done()
+                    pending = None
+                    try:
+                        pending = self.queue.get(timeout=self.idle)
+                    except queue.Empty:
+                        break
+                    if pending is None:
+                        self.queue.task_done()
+                        running = False
+        except (smtplib.SMTPException, OSError) as e:
+            if pending is not None:
+                self._retry(*pending, e)
+                self.queue.task_done()
+        except Exception:
+            # a message that can never be sent, e.g. a bad header. it isn't
+            # retried and must not take the worker down with it
+            if pending is not None:
+                self._count('failed')
+                self.app.logger.exception('Could not send mail to %s', pending[0].recipients)
+                self.queue.task_done()
+        return running
+
+    def _retry(self, msg, attempt, error):
+        if attempt < self.retries:
+            time.sleep(self.backoff * 2 ** attempt)
+            try:
+                self.queue.put_nowait((msg, attempt + 1))
+                self._count('retried')
+                return
+            except queue.Full:
+                pass
+        self._count('failed')
+        self.app.logger.error('Could not send mail to %s: %s', msg.recipients, error)
+
+    def shutdown(self, timeout=None):
+        '''Send what is queued and stop the workers.'''
+        with self.lock:
+            threads = list(self.threads)
+        for _ in threads:
+            self.queue.put(None)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in threads:
+            thread.join(None if deadline is None else max(0, deadline - time.monotonic()))
+
+
+@atexit.register
+def _drain_all():
+    for mail_queue in list(_queues):
+        mail_queue.shutdown(mail_queue.app.config['FLASKY_MAIL_SHUTDOWN_TIMEOUT'])
+
+
+def init_app(app):
+    app.extensions['mail_queue'] = MailQueue(app)
 
 
 def send_email(to, subject, template, **kwargs):
@@ -15,6 +157,4 @@ def send_email(to, subject, template, **kwargs):
                   sender=app.config['FLASKY_MAIL_SENDER'], recipients=[to])
     msg.body = render_template(template + '.txt', **kwargs)
     msg.html = render_template(template + '.html', **kwargs)
-    thr = Thread(target=send_async_email, args=(app, msg))
-    thr.start()
-    return thr
+    return app.extensions['mail_queue'].put(msg)
@@ -1,3 +1,7 @@
 class ValidationError(ValueError):
     pass
 
+
+class QueryBudgetExceeded(RuntimeError):
+    pass
+
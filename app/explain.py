@@ -0,0 +1,72 @@
+from types import SimpleNamespace
+from flask import current_app
+from . import db
+from .models import User, Post, Comment, Follow, Vote
+
+
+def view_queries():
+    '''The main query of each hot view, built for a sample user and post.'''
+    user = User.query.filter(User.server_own != True).first() or \
+        SimpleNamespace(id=0, username='', email='')
+    post = Post.query.first()
+    post_id = post.id if post else 0
+    posts_per_page = current_app.config['FLASKY_POSTS_PER_PAGE']
+    comments_per_page = current_app.config['FLASKY_COMMENTS_PER_PAGE']
+    followers_per_page = current_app.config['FLASKY_FOLLOWERS_PER_PAGE']
+    live_posts = Post.query.filter(Post.deleted != True)\
+        .order_by(Post.timestamp.desc(), Post.id.desc())
+    comments = Comment.query.filter(Comment.post_id == post_id)
+    return [
+        ('main.index', live_posts.limit(posts_per_page)),
+        ('main.index (timeline)', User.timeline(user).filter(Post.deleted != True)
+            .page(True, None, False, posts_per_page)),
+        ('main.user', Post.query.filter(Post.author_id == user.id)
+            .order_by(Post.timestamp.desc(), Post.id.desc()).limit(posts_per_page)),
+        ('main.user (lookup)', User.query.filter(User.username == user.username)),
+        ('main.post (new comments)', comments.order_by(
+            Comment.timestamp.desc(), Comment.id.desc()).limit(comments_per_page)),
+        ('main.post (top comments)', comments.order_by(
+            Comment.vote_count.desc(), Comment.id.desc()).limit(comments_per_page)),
+        ('main.post (vote status)', Vote.query.filter(
+            Vote.user_id == user.id, Vote.post_id.in_([post_id]))),
+        ('main.followers', Follow.query.filter(Follow.followed_id == user.id)
+            .order_by(Follow.timestamp.desc(), Follow.follower_id.desc())
+            .limit(followers_per_page)),
+        ('main.followed_by', Follow.query.filter(Follow.follower_id == user.id)
+            .order_by(Follow.timestamp.desc(), Follow.followed_id.desc())
+            .limit(followers_per_page)),
+        ('moderate._moderate', Comment.query.order_by(
+            Comment.timestamp.desc(), Comment.id.desc()).limit(comments_per_page)),
+        ('auth.login', User.query.filter(User.email == user.email)),
+    ]
+
+
+def explain(query):
+    '''Run EXPLAIN on `query`, returns (plan lines, full table scans).'''
+    dialect = db.engine.dialect
+    compiled = query.statement.compile(
+        dialect=dialect, compile_kwargs={'render_postcompile': True})
+    params = compiled.params
+    if compiled.positional:
+        params = tuple(params[name] for name in compiled.positiontup)
+    prefix = 'EXPLAIN QUERY PLAN ' if dialect.name == 'sqlite' else 'EXPLAIN '
+    rows = db.session.connection().exec_driver_sql(prefix + str(compiled), params).fetchall()
+    lines, scans = [], []
+    for row in rows:
+        if dialect.name == 'sqlite':
+            line = row[-1]
+            # scans of subqueries, which are bounded by their own limits, are fine
+            if line.startswith('SCAN ') and ' USING ' not in line and \
+                    line.split()[1] in db.metadata.tables:
+                scans.append(line.split()[1])
+        elif dialect.name == 'mysql':
+            row = row._mapping
+            line = ' '.join(f'{key}={value}' for key, value in row.items())
+            if row.get('type') == 'ALL':
+                scans.append(row.get('table'))
+        else:
+            line = row[0]
+            if 'Seq Scan on ' in line:
+                scans.append(line.split('Seq Scan on ')[1].split()[0])
+        lines.append(line)
+    return lines, scans
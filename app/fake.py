@@ -1,8 +1,16 @@
-from random import randint
+import datetime
+import hashlib
+import itertools
+import random
+import time
+from array import array
 from sqlalchemy.exc import IntegrityError
+from werkzeug.security import generate_password_hash
 from faker import Faker
+from flask import current_app
 from . import db
-from .models import User, Post, Comment
+from .models import User, Post, Comment, Follow, Vote, Role, Timeline, reconcile_counters
+from .rendering import render, POST_TAGS, COMMENT_TAGS
 
 
 def users(count=100):
@@ -25,11 +33,15 @@ def users(count=100):
             db.session.rollback()
 
 
+def _ids(model):
+    return [id for id, in db.session.query(model.id)]
+
+
 def posts(count=100):
     fake = Faker()
-    user_count = User.query.count()
+    user_ids = _ids(User)
     for i in range(count):
-        u = User.query.offset(randint(0, user_count - 1)).first()
+        u = User.query.get(random.choice(user_ids))
         p = Post(title=fake.text(14), body=fake.text(),
                  timestamp=fake.past_date(),
                  author=u)
@@ -39,11 +51,11 @@ def posts(count=100):
 
 def comments(count=100):
     fake = Faker()
-    user_count = User.query.count()
-    post_count = Post.query.count()
+    user_ids = _ids(User)
+    post_ids = _ids(Post)
     for i in range(count):
-        u = User.query.offset(randint(0, user_count - 1)).first()
-        p = Post.query.offset(randint(0, post_count - 1)).first()
+        u = User.query.get(random.choice(user_ids))
+        p = Post.query.get(random.choice(post_ids))
         c = Comment(body=fake.text(20),
                     timestamp=fake.past_date(), author=u, post=p)
         db.session.add(c)
@@ -51,13 +63,160 @@ def comments(count=100):
 
 
 def votes(count=100):
-    fake = Faker()
-    user_count = User.query.count()
-    post_count = Post.query.count()
+    user_ids = _ids(User)
+    post_ids = _ids(Post)
     for i in range(count):
-        u = User.query.offset(randint(0, user_count - 1)).first()
-        p = Post.query.offset(randint(0, post_count - 1)).first()
-        u.upvote(p)
-        db.session.add(p)
+        u = User.query.get(random.choice(user_ids))
+        p = Post.query.get(random.choice(post_ids))
+        u.upvote('post', p)
     db.session.commit()
 
+
+# bulk generator for load testing. rows are written with executemany
+# INSERTs that bypass the ORM events, the counters and timelines those
+# events maintain are recomputed in bulk at the end.
+
+def _power_law(rng, ids, alpha):
+    '''Cumulative weights giving ids a popularity that follows a power law.'''
+    ranks = list(range(1, len(ids) + 1))
+    rng.shuffle(ranks)
+    return list(itertools.accumulate(1 / rank ** alpha for rank in ranks))
+
+
+def _insert(table, rows, batch_size, report):
+    start = time.perf_counter()
+    count = 0
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            break
+        db.session.execute(table.insert(), batch)
+        db.session.commit()
+        count += len(batch)
+    elapsed = time.perf_counter() - start
+    report(f'{table.name}: {count} rows in {elapsed:.1f}s '
+           f'({count / elapsed if elapsed else 0:.0f} rows/s)')
+    return count
+
+
+def _new_ids(model, after):
+    return array('l', (id for id, in db.session.query(model.id)
+                       .filter(model.id > after).order_by(model.id)))
+
+
+def _unique_pairs(count, make, existing=()):
+    # draw pairs until `count` new distinct ones are found, giving up on a
+    # graph too small to hold that many
+    pairs = set(existing)
+    wanted = len(pairs) + count
+    for _ in range(count * 5):
+        if len(pairs) >= wanted:
+            break
+        pairs.add(make())
+    return pairs - set(existing)
+
+
+def seed(users=1000, posts=10000, comments=30000, follows=20000, votes=50000,
+         seed=None, batch_size=5000, alpha=1.1, report=print):
+    '''Fill the database with a synthetic dataset of the given size.
+
+    Followers, votes and comments go to a few popular users and posts
+    following a power law with exponent `alpha`. The same `seed` gives the
+    same dataset, timestamps aside which are relative to the current time.
+    '''
+    rng = random.Random(seed)
+    fake = Faker()
+    fake.seed_instance(seed)
+    now = datetime.datetime.utcnow()
+    year = 365 * 24 * 3600
+
+    def past(seconds=year):
+        return now - datetime.timedelta(seconds=rng.randrange(seconds))
+
+    # pools of texts, rendered once, that rows pick from
+    post_texts = [(fake.text(14), body, render(body, POST_TAGS))
+                  for body in (fake.text() for _ in range(500))]
+    comment_texts = [(body, render(body, COMMENT_TAGS))
+                     for body in (fake.text(60) for _ in range(500))]
+    profiles = [(fake.user_name(), fake.name(), fake.city(), fake.sentence())
+                for _ in range(500)]
+    password_hash = generate_password_hash('password')
+    if Role.query.filter_by(default=True).first() is None:
+        # a fresh database, the users need their roles
+        Role.insert_roles()
+    role_id = Role.cached().default.id
+
+    max_user = db.session.query(db.func.max(User.id)).scalar() or 0
+    max_post = db.session.query(db.func.max(Post.id)).scalar() or 0
+    max_comment = db.session.query(db.func.max(Comment.id)).scalar() or 0
+
+    def user_rows():
+        for i in range(users):
+            username, name, city, about_me = rng.choice(profiles)
+            username = f'{username}{max_user + i}'
+            email = f'{username}@example.com'
+            yield {'email': email, 'username': username,
+                   'password_hash': password_hash, 'role_id': role_id,
+                   'confirmed': True, 'name': name, 'location': city,
+                   'about_me': about_me, 'member_since': past(2 * year),
+                   'last_seen': past(), 'server_own': False,
+                   'avatar_hash': hashlib.md5(email.encode('utf-8')).hexdigest()}
+
+    _insert(User.__table__, user_rows(), batch_size, report)
+    user_ids = _new_ids(User, max_user)
+    popular_users = _power_law(rng, user_ids, alpha)
+
+    def post_rows():
+        authors = rng.choices(user_ids, cum_weights=popular_users, k=posts)
+        for author_id in authors:
+            title, body, body_html = rng.choice(post_texts)
+            yield {'title': title, 'body': body, 'body_html': body_html,
+                   'timestamp': past(), 'author_id': author_id,
+                   'deleted': False, 'editable': True}
+
+    _insert(Post.__table__, post_rows(), batch_size, report)
+    post_ids = _new_ids(Post, max_post)
+    authors = dict(db.session.query(Post.id, Post.author_id).filter(Post.id > max_post))
+    popular_posts = _power_law(rng, post_ids, alpha)
+
+    def comment_rows():
+        if not post_ids:
+            return
+        for post_id in rng.choices(post_ids, cum_weights=popular_posts, k=comments):
+            body, body_html = rng.choice(comment_texts)
+            yield {'body': body, 'body_html': body_html, 'timestamp': past(),
+                   'author_id': rng.choice(user_ids), 'post_id': post_id,
+                   'disabled': False, 'editable': True}
+
+    _insert(Comment.__table__, comment_rows(), batch_size, report)
+
+    # everyone follows themselves, the rest favours popular users
+    self_follows = {(id, id) for id in user_ids}
+    follow_pairs = _unique_pairs(follows, lambda: (
+        rng.choice(user_ids), rng.choices(user_ids, cum_weights=popular_users)[0]),
+        self_follows) if user_ids else set()
+    _insert(Follow.__table__, ({'follower_id': follower, 'followed_id': followed,
+                                'timestamp': past()}
+                               for follower, followed in sorted(self_follows | follow_pairs)),
+            batch_size, report)
+
+    # authors upvote their own posts, the rest favours popular posts
+    self_votes = {(author_id, post_id) for post_id, author_id in authors.items()}
+    vote_pairs = _unique_pairs(votes, lambda: (
+        rng.choice(user_ids), rng.choices(post_ids, cum_weights=popular_posts)[0]),
+        self_votes) if post_ids else set()
+    def vote_rows():
+        for user_id, post_id in sorted(self_votes | vote_pairs):
+            upvote = (user_id, post_id) in self_votes or rng.random() < 0.8
+            yield {'user_id': user_id, 'post_id': post_id,
+                   'upvote': upvote, 'downvote': not upvote}
+
+    _insert(Vote.__table__, vote_rows(), batch_size, report)
+
+    start = time.perf_counter()
+    reconcile_counters()
+    Timeline.rebuild()
+    # the follows were inserted behind the ORM's back
+    current_app.extensions['follow_graph'].clear()
+    report(f'counters and timelines rebuilt in {time.perf_counter() - start:.1f}s')
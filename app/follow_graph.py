@@ -0,0 +1,79 @@
+from array import array
+from bisect import bisect_left
+from flask import current_app, has_app_context
+from . import db
+from .cache import TTLCache
+from .models import Follow
+
+
+class FollowGraph:
+    '''In-process cache of who every user follows.
+
+    The ids a user follows are loaded with one query the first time they are
+    needed and kept as a sorted array of ints, 4 bytes per follow, in an LRU
+    of FLASKY_FOLLOW_CACHE_SIZE users. A user's entry is dropped whenever one
+    of their follows is inserted or deleted, and again once the transaction
+    ends. Other processes see the change after FLASKY_FOLLOW_CACHE_TTL seconds.
+    '''
+    def __init__(self, maxsize, ttl):
+        self.cache = TTLCache(maxsize, ttl)
+
+    def followed_ids(self, user_id):
+        ids = self.cache.get(user_id)
+        if ids is None:
+            ids = array('i', db.session.scalars(
+                db.select(Follow.followed_id).where(Follow.follower_id == user_id)
+                .order_by(Follow.followed_id)))
+            self.cache.set(user_id, ids)
+        return ids
+
+    def is_following(self, follower_id, followed_id):
+        ids = self.followed_ids(follower_id)
+        i = bisect_left(ids, followed_id)
+        return i < len(ids) and ids[i] == followed_id
+
+    def are_following(self, follower_id, ids):
+        '''The subset of `ids` followed by `follower_id`.'''
+        followed = self.followed_ids(follower_id)
+        return {id for id in ids
+                for i in [bisect_left(followed, id)]
+                if i < len(followed) and followed[i] == id}
+
+    def discard(self, *user_ids):
+        for user_id in user_ids:
+            self.cache.discard(user_id)
+
+    def clear(self):
+        self.cache.clear()
+
+
+def _graph():
+    if has_app_context():
+        return current_app.extensions.get('follow_graph')
+
+
+def on_change(mapper, connection, target):
+    graph = _graph()
+    if graph is not None:
+        graph.discard(target.follower_id)
+    db.inspect(target).session.info.setdefault('follows_changed', set()).add(target.follower_id)
+
+
+def on_end(session):
+    # entries loaded mid-transaction may hold rows that were just committed
+    # or rolled back, either way they have to go
+    changed = session.info.pop('follows_changed', None)
+    graph = _graph()
+    if changed and graph is not None:
+        graph.discard(*changed)
+
+
+db.event.listen(Follow, 'after_insert', on_change)
+db.event.listen(Follow, 'after_delete', on_change)
+db.event.listen(db.session, 'after_commit', on_end)
+db.event.listen(db.session, 'after_rollback', on_end)
+
+
+def init_app(app):
+    app.extensions['follow_graph'] = FollowGraph(app.config['FLASKY_FOLLOW_CACHE_SIZE'],
+                                                 app.config['FLASKY_FOLLOW_CACHE_TTL'])
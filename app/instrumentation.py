@@ -0,0 +1,104 @@
+import threading
+import time
+from contextlib import contextmanager
+from flask import current_app, g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from .exceptions import QueryBudgetExceeded
+
+_local = threading.local()
+
+
+class QueryStats:
+    '''Counts the SQL statements run by the current thread while active.
+
+    Used per request by init_app, and as a context manager in tests:
+
+        with QueryStats() as stats:
+            client.get('/')
+        assert stats.count <= 10
+    '''
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.queries = []
+
+    def __enter__(self):
+        if not hasattr(_local, 'active'):
+            _local.active = []
+        _local.active.append(self)
+        return self
+
+    def __exit__(self, *exc):
+        active = getattr(_local, 'active', [])
+        if self in active:
+            active.remove(self)
+
+    def record(self, statement, parameters, duration):
+        self.count += 1
+        self.duration += duration
+        self.queries.append((statement, parameters, duration))
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info['query_start_time'].pop()
+    for stats in getattr(_local, 'active', ()):
+        stats.record(statement, parameters, duration)
+
+
+@contextmanager
+def max_queries(limit):
+    '''Fail with the list of statements if the block runs more than `limit` queries.'''
+    with QueryStats() as stats:
+        yield stats
+    if stats.count > limit:
+        statements = '\n'.join(statement for statement, _, _ in stats.queries)
+        raise AssertionError(f'{stats.count} queries run, expected at most {limit}:\n{statements}')
+
+
+def _start_request():
+    g.query_stats = QueryStats().__enter__()
+
+
+def _finish_request(response):
+    stats = g.pop('query_stats', None)
+    if stats is None:
+        return response
+    stats.__exit__()
+    config = current_app.config
+    for statement, parameters, duration in stats.queries:
+        if duration >= config['FLASKY_SLOW_DB_QUERY_TIME']:
+            current_app.logger.warning(
+                'Slow query: %s\nParameters: %s\nDuration: %fs\nEndpoint: %s\n' %
+                (statement, parameters, duration, request.endpoint))
+    if config['FLASKY_QUERY_HEADERS']:
+        response.headers['X-Query-Count'] = str(stats.count)
+        response.headers.add('Server-Timing',
+                             f'db;dur={stats.duration * 1000:.1f};desc="{stats.count} queries"')
+    budget = config['FLASKY_QUERY_BUDGETS'].get(
+        request.endpoint, config['FLASKY_QUERY_BUDGET_DEFAULT'])
+    if budget is not None and stats.count > budget:
+        message = f'{request.endpoint} ran {stats.count} queries, its budget is {budget}'
+        if config['FLASKY_QUERY_BUDGET_ACTION'] == 'raise':
+            raise QueryBudgetExceeded(message)
+        current_app.logger.warning(message)
+    return response
+
+
+def _teardown_request(exc):
+    # the request failed before after_request had a chance to run
+    stats = g.pop('query_stats', None)
+    if stats is not None:
+        stats.__exit__()
+
+
+def init_app(app):
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.teardown_request(_teardown_request)
@@ -0,0 +1,177 @@
+import json
+import queue
+import threading
+import time
+from flask import current_app, has_app_context
+from simple_websocket import ConnectionClosed
+from . import db, sock
+
+
+class LocalBackend:
+    '''Delivers messages to the subscribers of this process only.'''
+    local = True
+
+    def __init__(self, deliver):
+        self.deliver = deliver
+
+    def publish(self, channel, message):
+        self.deliver(channel, message)
+
+
+class RedisBackend:
+    '''Fans messages out to every worker through Redis pub/sub.'''
+    prefix = 'flasky:live:'
+    local = False
+
+    def __init__(self, url, deliver):
+        import redis
+        self.redis = redis.Redis.from_url(url)
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.psubscribe(**{self.prefix + '*': lambda message: deliver(
+            message['channel'].decode('utf-8')[len(self.prefix):],
+            json.loads(message['data']))})
+        self.thread = pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    def publish(self, channel, message):
+        self.redis.publish(self.prefix + channel, json.dumps(message))
+
+
+class Hub:
+    '''Publish/subscribe of the live events of post pages.
+
+    Subscribers get a bounded queue of messages, a subscriber that doesn't
+    keep up loses messages rather than holding the publishers back. Vote
+    changes are coalesced: they are published at most once per `interval`
+    seconds and channel, with the latest counts of everything that changed.
+    '''
+    def __init__(self, app):
+        self.app = app
+        self.interval = app.config['FLASKY_LIVE_INTERVAL']
+        self.queue_size = app.config['FLASKY_LIVE_QUEUE_SIZE']
+        self.subscribers = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.flusher = None
+        url = app.config['FLASKY_LIVE_BACKEND']
+        if url.startswith('redis'):
+            self.backend = RedisBackend(url, self.deliver)
+        else:
+            self.backend = LocalBackend(self.deliver)
+
+    def subscribe(self, channel):
+        subscription = queue.Queue(self.queue_size)
+        with self.lock:
+            self.subscribers.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, channel, subscription):
+        with self.lock:
+            subscribers = self.subscribers.get(channel, set())
+            subscribers.discard(subscription)
+            if not subscribers:
+                self.subscribers.pop(channel, None)
+
+    def deliver(self, channel, message):
+        with self.lock:
+            subscribers = list(self.subscribers.get(channel, ()))
+        for subscription in subscribers:
+            try:
+                subscription.put_nowait(message)
+            except queue.Full:
+                pass
+
+    def publish(self, channel, message):
+        self.backend.publish(channel, message)
+
+    def vote(self, channel, kind, id, delta):
+        with self.lock:
+            if self.backend.local and channel not in self.subscribers:
+                # nobody is watching the post, no need to query its counts
+                return
+            changes = self.pending.setdefault(channel, {}).setdefault(kind, {})
+            changes[id] = changes.get(id, 0) + delta
+            if self.flusher is None:
+                self.flusher = threading.Thread(target=self._flush_later, daemon=True)
+                self.flusher.start()
+
+    def _flush_later(self):
+        time.sleep(self.interval)
+        with self.app.app_context():
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('Publishing vote counts failed')
+
+    def flush(self):
+        '''Publish the coalesced vote changes, with the current counts.'''
+        from .models import Post, Comment
+        with self.lock:
+            pending, self.pending, self.flusher = self.pending, {}, None
+        models = {'posts': Post, 'comments': Comment}
+        ids = {kind: set() for kind in models}
+        for changes in pending.values():
+            for kind, deltas in changes.items():
+                ids[kind].update(deltas)
+        counts = {kind: dict(db.session.query(model.id, model.vote_count)
+                             .filter(model.id.in_(ids[kind])))
+                  for kind, model in models.items() if ids[kind]}
+        for channel, changes in pending.items():
+            self.publish(channel, {'type': 'votes', **{
+                kind: {id: {'delta': delta, 'count': counts[kind].get(id)}
+                       for id, delta in deltas.items()}
+                for kind, deltas in changes.items()}})
+
+
+def channel(post_id):
+    return f'post:{post_id}'
+
+
+def publish_pending(session):
+    '''Hand the events of a committed transaction over to the hub.'''
+    events = session.info.pop('live_events', None)
+    if not events or not has_app_context():
+        return
+    hub = current_app.extensions.get('live')
+    if hub is None:
+        return
+    for event in events:
+        if event[0] == 'vote':
+            _, post_id, kind, id, delta = event
+            hub.vote(channel(post_id), kind, id, delta)
+        else:
+            _, post_id, message = event
+            hub.publish(channel(post_id), message)
+
+
+def discard_pending(session):
+    session.info.pop('live_events', None)
+
+
+db.event.listen(db.session, 'after_commit', publish_pending)
+db.event.listen(db.session, 'after_rollback', discard_pending)
+
+
+@sock.route('/ws/post/<int:id>')
+def post_updates(ws, id):
+    '''Stream the vote and comment events of a post page.'''
+    hub = current_app.extensions['live']
+    subscription = hub.subscribe(channel(id))
+    # the request is going to last, don't hold a database connection
+    db.session.remove()
+    try:
+        while True:
+            try:
+                message = subscription.get(timeout=1)
+            except queue.Empty:
+                # raises ConnectionClosed once the client went away
+                ws.receive(timeout=0)
+                continue
+            ws.send(json.dumps(message))
+    except ConnectionClosed:
+        pass
+    finally:
+        hub.unsubscribe(channel(id), subscription)
+
+
+def init_app(app):
+    app.extensions['live'] = Hub(app)
@@ -0,0 +1,127 @@
+import atexit
+import hashlib
+import logging
+import queue
+import threading
+import traceback
+from logging.handlers import QueueHandler, QueueListener
+
+
+def fingerprint(record):
+    '''Records with the same fingerprint come from the same problem.
+
+    Exceptions are identified by their type and the frames they went
+    through, other records by where they were logged and their unformatted
+    message, so changing values such as ids don't make them different.
+    '''
+    if record.exc_info and record.exc_info[1] is not None:
+        frames = traceback.extract_tb(record.exc_info[2])
+        key = (record.exc_info[0].__name__,) + tuple((f.filename, f.lineno) for f in frames)
+    else:
+        key = (record.pathname, record.lineno, str(record.msg))
+    return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+
+class DigestHandler(logging.Handler):
+    '''Pass the first record of each kind on to `target`, batch the rest.
+
+    Within a `window` of seconds only the first record of every fingerprint
+    is handed to `target`, and no more than `rate` of them. Everything else
+    is counted and sent as a single digest record when the window ends.
+    '''
+    def __init__(self, target, window=300, rate=10):
+        super().__init__(target.level)
+        self.target = target
+        self.window = window
+        self.rate = rate
+        self.seen = {}
+        self.sent = 0
+        self.timer = None
+
+    def emit(self, record):
+        key = getattr(record, 'fingerprint', None) or fingerprint(record)
+        if self.timer is None:
+            self.timer = threading.Timer(self.window, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+        entry = self.seen.get(key)
+        if entry is not None:
+            entry[1] += 1
+        elif self.sent < self.rate:
+            self.seen[key] = [record, 0]
+            self.sent += 1
+            self.target.handle(record)
+        else:
+            self.seen[key] = [record, 1]
+
+    def digest(self, repeats):
+        parts = [f'{count} x {record.levelname} {record.name}:\n{self.format(record)}'
+                 for record, count in repeats]
+        return logging.LogRecord(
+            repeats[0][0].name, max(record.levelno for record, _ in repeats), __file__, 0,
+            '%d repeated log records in the last %d seconds\n\n%s',
+            (sum(count for _, count in repeats), self.window, '\n\n'.join(parts)), None)
+
+    def flush(self):
+        '''End the current window, sending the digest of what was held back.'''
+        self.acquire()
+        try:
+            if self.timer is not None:
+                self.timer.cancel()
+            repeats = [(record, count) for record, count in self.seen.values() if count]
+            self.seen, self.sent, self.timer = {}, 0, None
+        finally:
+            self.release()
+        if repeats:
+            self.target.handle(self.digest(repeats))
+
+    def close(self):
+        self.flush()
+        self.target.close()
+        super().close()
+
+
+class DroppingQueueHandler(QueueHandler):
+    '''A QueueHandler that drops records instead of blocking when the queue is full.'''
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # the traceback is turned into text here, fingerprint it first
+        record.fingerprint = fingerprint(record)
+        return super().prepare(record)
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class StoppableQueueListener(QueueListener):
+    '''A QueueListener that can be stopped more than once, e.g. again at exit.'''
+    def stop(self):
+        if self._thread is not None:
+            super().stop()
+
+
+def add_queued_handler(app, handler, level, digest=False):
+    '''Attach `handler` to the app logger, with records handed to it by a thread.
+
+    Logging only costs the request thread a put on a bounded queue. With
+    `digest` repeated records are batched by a DigestHandler first.
+    '''
+    config = app.config
+    handler.setLevel(level)
+    if digest:
+        handler = DigestHandler(handler, config['FLASKY_LOG_DIGEST_WINDOW'],
+                                config['FLASKY_LOG_DIGEST_RATE'])
+    queue_handler = DroppingQueueHandler(queue.Queue(config['FLASKY_LOG_QUEUE_SIZE']))
+    queue_handler.setLevel(level)
+    listener = StoppableQueueListener(queue_handler.queue, handler,
+                                      respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    app.logger.addHandler(queue_handler)
+    return queue_handler, listener
@@ -31,7 +31,8 @@ class EditProfileAdminForm(FlaskForm):
 
     def __init__(self, user, *args, **kwargs):
         super(EditProfileAdminForm, self).__init__(*args, **kwargs)
-        self.role.choices = [(role.id, role.name) for role in Role.query.order_by(Role.name).all()]
+        self.role.choices = [(role.id, role.name) for role in
+                             sorted(Role.cached().by_id.values(), key=lambda role: role.name)]
         self.user = user
 
     def validate_email(self, field):
@@ -2,26 +2,18 @@ from flask import render_template, session, redirect, url_for, flash, abort, req
 from flask import make_response, jsonify
 from . import main
 from .forms import PostForm, EditProfileForm, EditProfileAdminForm, CommentForm
-from .. import db
-from ..models import User, Role, Post, Permission, Comment, Vote
+from .. import db, response_cache
+from ..models import User, Post, Permission, Comment, Vote, Follow, Suggestion
 from flask_login import login_required, current_user
 from ..decorators import admin_required, permission_required
+from ..votes import vote_statuses
+from ..pagination import paginate
 from datetime import timedelta, datetime
-from flask_sqlalchemy import get_debug_queries
 import json
 
 
-@main.after_app_request
-def after_request(response):
-    for query in get_debug_queries():
-        if query.duration >= current_app.config['FLASKY_SLOW_DB_QUERY_TIME']:
-            current_app.logger.warning(
-                    'Slow query: %s\nParameters: %s\nDuration: %fs\nContext: %s\n' %
-                        (query.statement, query.parameters, query.duration, query.context))
-    return response
-                            
-
 @main.route('/', methods=['GET', 'POST'])
+@response_cache.cached()
 def index():
     form = PostForm()
     if current_user.can(Permission.WRITE) and form.validate_on_submit():
@@ -31,34 +23,38 @@ def index():
         db.session.add(post)
         db.session.commit()
         return redirect(url_for('.index'))
-    page = request.args.get('page', 1, type=int)
     show_followed = False
     if current_user.is_authenticated:
         show_followed = bool(request.cookies.get('show_followed', ''))
     if show_followed:
-        query = current_user.followed_posts
+        query = current_user.timeline()
     else:
         query = Post.query
-    pagination = query.filter(Post.deleted != True).order_by(Post.timestamp.desc()).paginate(
-        page=page, per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
-        error_out=False)
+    query = query.filter(Post.deleted != True).options(db.joinedload(Post.author))
+    pagination = paginate(query, (Post.timestamp, Post.id),
+                          per_page=current_app.config['FLASKY_POSTS_PER_PAGE'])
     posts = pagination.items
+    response_cache.tag('posts', *(f'user:{post.author_id}' for post in posts))
     return render_template('index.html', form=form, posts=posts,
-                           show_followed=show_followed, pagination=pagination)
+                           show_followed=show_followed, pagination=pagination,
+                           post_votes=vote_statuses(current_user, posts))
 
 
 @main.route('/user/<username>')
+@response_cache.cached()
 def user(username):
     user = User.query.filter_by(username=username).first_or_404()
     if user.server_own:
         abort(404)
-    page = request.args.get('page', 1, type=int)
-    pagination = user.posts.order_by(Post.timestamp.desc()).paginate(
-        page=page, per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
-        error_out=False
-    )
+    pagination = paginate(user.posts, (Post.timestamp, Post.id),
+                          per_page=current_app.config['FLASKY_POSTS_PER_PAGE'])
     posts = pagination.items
-    return render_template('user.html', user=user, posts=posts, pagination=pagination)
+    response_cache.tag(f'user:{user.id}', *(f'post:{post.id}' for post in posts))
+    suggestions = []
+    if user == current_user:
+        suggestions = Suggestion.for_user(user.id, current_app.config['FLASKY_SUGGESTIONS_SHOWN'])
+    return render_template('user.html', user=user, posts=posts, pagination=pagination,
+                           post_votes=vote_statuses(current_user, posts), suggestions=suggestions)
 
 
 @main.route('/edit-profile', methods=['GET', 'POST'])
@@ -89,7 +85,7 @@ def edit_profile_admin(id):
         user.email = form.email.data
         user.username = form.username.data
         user.confirmed = form.confirmed.data
-        user.role = Role.query.get(form.role.data)
+        user.role_id = form.role.data
         user.name = form.name.data
         user.location = form.location.data
         user.about_me = form.about_me.data
@@ -107,6 +103,7 @@ def edit_profile_admin(id):
 
 
 @main.route('/post/<int:id>', methods=['GET', 'POST'])
+@response_cache.cached(cookies=('top_comments',))
 def post(id):
     post = Post.query.get_or_404(id)
     form = CommentForm()
@@ -117,22 +114,28 @@ def post(id):
         db.session.add(comment)
         db.session.commit()
         flash('Your comment has been published.')
-        return redirect(url_for('.post', id=post.id, page=-1) + f"#{comment.id}")
-    page = request.args.get('page', 1, type=int)
-    if page == -1:
-        page = (post.comments.count() - 1) // \
-                current_app.config['FLASKY_COMMENTS_PER_PAGE'] + 1
+        return redirect(url_for('.post', id=post.id, comment=comment.id) + f"#{comment.id}")
     top_comments = bool(request.cookies.get('top_comments', ''))
     if top_comments:
-        query = post.comments.order_by(Comment.vote_count.desc())
+        keys = (Comment.vote_count, Comment.id)
     else:
-        query = post.comments.order_by(Comment.timestamp.desc())
-    pagination = query.paginate(
-        page=page, per_page=current_app.config['FLASKY_COMMENTS_PER_PAGE'],
-        error_out=False)
+        keys = (Comment.timestamp, Comment.id)
+    # jump straight to the page that starts with a given comment, page=-1 is
+    # kept for old links and means the latest one
+    seek = None
+    if 'comment' in request.args:
+        seek = post.comments.filter_by(id=request.args.get('comment', type=int)).first()
+    elif request.args.get('page', type=int) == -1:
+        seek = post.comments.order_by(Comment.timestamp.desc(), Comment.id.desc()).first()
+    pagination = paginate(post.comments.options(db.joinedload(Comment.author)), keys, seek=seek,
+                          per_page=current_app.config['FLASKY_COMMENTS_PER_PAGE'])
     comments = pagination.items
+    response_cache.tag(f'post:{post.id}', f'user:{post.author_id}',
+                       *(f'user:{comment.author_id}' for comment in comments))
     return render_template('post.html', posts=[post], form=form, comments=comments,
-                           pagination=pagination, request=request, top_comments=top_comments)
+                           pagination=pagination, request=request, top_comments=top_comments,
+                           post_votes=vote_statuses(current_user, [post]),
+                           comment_votes=vote_statuses(current_user, comments))
 
 
 @main.route('/edit/<int:id>', methods=['GET', 'POST'])
@@ -164,10 +167,9 @@ def follow(username):
     if user is None or user.server_own:
         flash('Invalid user.')
         return redirect(url_for('.index'))
-    if current_user.is_following(user):
+    if not current_user.follow(user):
         flash('You are already following this user.')
         return redirect(url_for('.user', username=username))
-    current_user.follow(user)
     db.session.commit()
     flash(f'You are now following {username}!')
     return redirect(url_for('.user', username=username))
@@ -181,10 +183,9 @@ def unfollow(username):
     if user is None or user.server_own:
         flash('Invalid user.')
         return redirect(url_for('.index'))
-    if not current_user.is_following(user):
+    if not current_user.unfollow(user):
         flash('you don\'t follow this user')
         return redirect(url_for('.user', username=username))
-    current_user.unfollow(user)
     db.session.commit()
     flash(f'you do not follow {username} anymore.')
     return redirect(url_for('.user', username=username))
@@ -193,27 +194,25 @@ def unfollow(username):
 @main.route('/user/<username>/followers')
 def followers(username):
     user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get('page', 1, type=int)
-    pagination = user.followers.paginate(
-        page=page, per_page=current_app.config['FLASKY_FOLLOWERS_PER_PAGE'],
-        error_out=False)
+    pagination = paginate(user.followers, (Follow.timestamp, Follow.follower_id),
+                          per_page=current_app.config['FLASKY_FOLLOWERS_PER_PAGE'])
     follows = [{'user': item.follower, 'timestamp': item.timestamp}
                for item in pagination.items]
     return render_template('followers.html', user=user,title='Followers of', pagination=pagination,
-                           follows=follows, endpoint='.followers')
+                           follows=follows, endpoint='.followers',
+                           relationships=current_user.relationships(f['user'].id for f in follows))
 
 
 @main.route('/user/<username>/followed_by')
 def followed_by(username):
     user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get('page', 1, type=int)
-    pagination = user.followed.paginate(
-        page=page, per_page=current_app.config['FLASKY_FOLLOWERS_PER_PAGE'],
-        error_out=False)
+    pagination = paginate(user.followed, (Follow.timestamp, Follow.followed_id),
+                          per_page=current_app.config['FLASKY_FOLLOWERS_PER_PAGE'])
     follows = [{'user': item.followed, 'timestamp': item.timestamp}
                for item in pagination.items]
     return render_template('followers.html', user=user, title='Followed by', pagination=pagination,
-                           follows=follows, endpoint='.followed_by')
+                           follows=follows, endpoint='.followed_by',
+                           relationships=current_user.relationships(f['user'].id for f in follows))
 
 
 @main.route('/all')
@@ -234,7 +233,6 @@ def show_followed():
 
 @main.route('/post/<int:post_id>/comments/<int:id>', methods=['GET', 'POST'])
 def edit_comment(id, post_id):
-    page = request.args.get('page')
     post = Post.query.get_or_404(post_id)
     comment = post.comments.filter_by(id=id).first()
     if current_user != comment.author and \
@@ -246,7 +244,7 @@ def edit_comment(id, post_id):
         db.session.add(comment)
         db.session.commit()
         flash('Your comment has been updated.')
-        return redirect(url_for('.post', id=comment.post_id, page=page) + f"#{comment.id}")
+        return redirect(url_for('.post', id=comment.post_id, comment=comment.id) + f"#{comment.id}")
     form.body.data = comment.body
     return render_template('edit_comment.html', posts=[post], form=form)
 
@@ -260,16 +258,11 @@ def upvote(id, obj_type):
     obj = query.get_or_404(id)
     status = None
     if obj.editable:
-        if current_user.vote_status(obj) == 'UP':
-            current_user.remove_vote(obj)
-        else:
-            current_user.upvote(obj_type, obj)
-            status = 'UP'
+        status = Vote.toggle(current_user._get_current_object(), obj, 'UP')
         db.session.commit()
 
     if request.is_json and request.method == 'POST':
         id = json.loads(request.data).get('id')
-        print(id, obj.vote_count)
         return jsonify({'id': id, 'data': obj.vote_count, 'status': status})
 
     elif request.method == 'GET':
@@ -285,11 +278,7 @@ def downvote(id, obj_type):
     obj = query.get_or_404(id)
     status = None
     if obj.editable:
-        if current_user.vote_status(obj) == 'DOWN':
-            current_user.remove_vote(obj)
-        else:
-            current_user.downvote(obj_type, obj)
-            status = 'DOWN'
+        status = Vote.toggle(current_user._get_current_object(), obj, 'DOWN')
         db.session.commit()
 
     if request.is_json and request.method == 'POST':
@@ -321,7 +310,8 @@ def upvoted():
         error_out=False)
     posts = [vote.post for vote in pagination.items if vote.post.author != current_user]
     return render_template('upvoted_posts.html', posts=posts,
-                           pagination=pagination)
+                           pagination=pagination,
+                           post_votes=vote_statuses(current_user, posts))
 
 
 @main.route('/post/<int:id>/new-comment')
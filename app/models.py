@@ -1,14 +1,84 @@
 from app.exceptions import ValidationError
-import bleach
-from markdown import markdown
 from . import db
+from .rendering import render_body, POST_TAGS, COMMENT_TAGS
+from .pagination import Feed
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin, AnonymousUserMixin
 from . import login_manager
 import jwt
 import datetime
-from flask import current_app, request, url_for, g, has_request_context
+from flask import current_app, request, url_for, g, has_request_context, has_app_context
+from sqlalchemy.dialects import sqlite, postgresql
+from sqlalchemy.exc import IntegrityError
 import hashlib
+import time
+from types import MappingProxyType
+
+
+def _bump_counters(connection, model, id, **deltas):
+    # counters are changed with a single `col = col + delta` UPDATE issued on
+    # the flush connection, so concurrent writers never overwrite each other.
+    if id is None:
+        return
+    table = model.__table__
+    connection.execute(table.update().where(table.c.id == id).values(
+        {name: table.c[name] + delta for name, delta in deltas.items()} | new_version(table)))
+
+
+def new_version(table):
+    '''The values a Core UPDATE of posts, comments or users needs to bump the row version.
+
+    The version and updated_at columns back the API's ETags and Last-Modified
+    headers, everything that changes what to_json shows has to bump them.
+    '''
+    if 'version' not in table.c:
+        return {}
+    return {'version': table.c.version + 1, 'updated_at': datetime.datetime.utcnow()}
+
+
+def _on_versioned_update(mapper, connection, target):
+    # before_update also runs for objects without net changes, skip those
+    if db.object_session(target).is_modified(target, include_collections=False):
+        target.version = type(target).version + 1
+        target.updated_at = datetime.datetime.utcnow()
+
+
+class CacheVersion(db.Model):
+    '''Version stamps of data every worker caches in memory.
+
+    A worker changing the data bumps the stamp in the same transaction, the
+    others notice the new version and reload their copy.
+    '''
+    __tablename__ = 'cache_versions'
+    name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    @staticmethod
+    def get(name):
+        return db.session.execute(db.select(CacheVersion.version).where(
+            CacheVersion.name == name)).scalar() or 0
+
+    @staticmethod
+    def bump(connection, name):
+        table = CacheVersion.__table__
+        result = connection.execute(table.update().where(table.c.name == name)
+                                    .values(version=table.c.version + 1))
+        if result.rowcount == 0:
+            connection.execute(table.insert().values(name=name, version=1))
+
+
+class RoleTable:
+    '''An immutable snapshot of the roles table, see Role.cached().'''
+    def __init__(self, rows, version):
+        self.version = version
+        self.checked = time.monotonic()
+        self.by_id = MappingProxyType({row.id: row for row in rows})
+        self.by_name = MappingProxyType({row.name: row for row in rows})
+        self.default = next((row for row in rows if row.default), None)
+
+    def has_permission(self, role_id, perm):
+        role = self.by_id.get(role_id)
+        return role is not None and role.permissions & perm == perm
 
 
 class Role(db.Model):
@@ -59,10 +129,46 @@ class Role(db.Model):
             db.session.add(role)
         db.session.commit()
 
+    @staticmethod
+    def cached():
+        '''The roles of this worker, reloaded when another worker changed them.'''
+        app = current_app._get_current_object()
+        roles = app.extensions.get('roles')
+        if roles is not None and \
+                time.monotonic() - roles.checked < app.config['FLASKY_ROLE_CACHE_CHECK']:
+            return roles
+        version = CacheVersion.get('roles')
+        if roles is None or roles.version != version:
+            rows = db.session.execute(db.select(
+                Role.id, Role.name, Role.default, Role.permissions)).all()
+            roles = app.extensions['roles'] = RoleTable(rows, version)
+        roles.checked = time.monotonic()
+        return roles
+
+    @staticmethod
+    def on_flush(session, flush_context):
+        if any(isinstance(obj, Role) for obj in session.new | session.dirty | session.deleted):
+            CacheVersion.bump(session.connection(), 'roles')
+            session.info['roles_changed'] = True
+
+    @staticmethod
+    def on_commit(session):
+        if session.info.pop('roles_changed', False) and has_app_context():
+            current_app.extensions.pop('roles', None)
+
+    @staticmethod
+    def on_rollback(session):
+        session.info.pop('roles_changed', None)
+
     def __repr__(self):
         return f'<Role {self.name}>'
 
 
+db.event.listen(db.session, 'after_flush', Role.on_flush)
+db.event.listen(db.session, 'after_commit', Role.on_commit)
+db.event.listen(db.session, 'after_rollback', Role.on_rollback)
+
+
 class Permission:
     FOLLOW = 1
     COMMENT = 2
@@ -78,27 +184,143 @@ class Follow(db.Model):
     followed_id = db.Column(db.Integer, db.ForeignKey('users.id'),
                             primary_key=True)
     timestamp = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    __table_args__ = (
+        db.Index('ix_follows_followed_id_timestamp', 'followed_id', 'timestamp'),
+        db.Index('ix_follows_follower_id_timestamp', 'follower_id', 'timestamp'))
 
     @staticmethod
-    def to_json(instance):
+    def to_json(instance, following=None):
         json_follower = {
             'follower': instance.follower.username,
             'follower_url': url_for('api.get_user', id=instance.follower.id),
             'follower_since': instance.timestamp}
+        if following is not None:
+            json_follower['following'] = following
         return json_follower
 
+    @staticmethod
+    def on_insert(mapper, connection, target):
+        _bump_counters(connection, User, target.follower_id, following_count=1)
+        _bump_counters(connection, User, target.followed_id, follower_count=1)
+
+    @staticmethod
+    def on_delete(mapper, connection, target):
+        _bump_counters(connection, User, target.follower_id, following_count=-1)
+        _bump_counters(connection, User, target.followed_id, follower_count=-1)
+
+    def cache_tags(self):
+        '''What cached responses showing this row are tagged with, see app.response_cache.'''
+        return {f'user:{self.follower_id}', f'user:{self.followed_id}'}
+
     def __repr__(self):
         return f'Follower {self.follower} Followed {self.followed}'
 
 
+db.event.listen(Follow, 'after_insert', Follow.on_insert)
+db.event.listen(Follow, 'after_delete', Follow.on_delete)
+
+
 class Vote(db.Model):
     __tablename__ = 'votes'
     id = db.Column(db.Integer, primary_key=True)
     upvote = db.Column(db.Boolean, default=False)
     downvote = db.Column(db.Boolean, default=False)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
-    post_id = db.Column(db.Integer, db.ForeignKey('posts.id'))
-    comment_id = db.Column(db.Integer, db.ForeignKey('comments.id'))
+    post_id = db.Column(db.Integer, db.ForeignKey('posts.id'), index=True)
+    comment_id = db.Column(db.Integer, db.ForeignKey('comments.id'), index=True)
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'post_id', name='uq_votes_user_id_post_id'),
+        db.UniqueConstraint('user_id', 'comment_id', name='uq_votes_user_id_comment_id'))
+
+    # the vote engine below works with plain UPDATE/INSERT/DELETE statements
+    # whose rowcounts tell what changed, so a vote click costs a handful of
+    # statements and concurrent clicks can neither lose a vote_count update
+    # nor insert a second vote row (the unique constraints make sure of that).
+
+    @staticmethod
+    def _match(user, obj):
+        column = Vote.post_id if isinstance(obj, Post) else Vote.comment_id
+        return db.and_(Vote.user_id == user.id, column == obj.id)
+
+    @staticmethod
+    def _insert_ignore(values):
+        table = Vote.__table__
+        dialect = db.session.get_bind().dialect.name
+        if dialect == 'sqlite':
+            stmt = sqlite.insert(table).values(values).on_conflict_do_nothing()
+        elif dialect == 'postgresql':
+            stmt = postgresql.insert(table).values(values).on_conflict_do_nothing()
+        elif dialect == 'mysql':
+            stmt = table.insert().values(values).prefix_with('IGNORE')
+        else:
+            try:
+                with db.session.begin_nested():
+                    return db.session.execute(table.insert().values(values)).rowcount
+            except IntegrityError:
+                return 0
+        return db.session.execute(stmt).rowcount
+
+    @staticmethod
+    def _bump(obj, delta):
+        if delta:
+            _bump_counters(db.session, type(obj), obj.id, vote_count=delta)
+            db.session.expire(obj, ['vote_count', 'version', 'updated_at'])
+            # pushed to the post page once the transaction commits, see app.live
+            if isinstance(obj, Post):
+                event = ('vote', obj.id, 'posts', obj.id, delta)
+            else:
+                event = ('vote', obj.post_id, 'comments', obj.id, delta)
+            db.session.info.setdefault('live_events', []).append(event)
+            db.session.info.setdefault('cache_tags', set()).update(obj.cache_tags())
+
+    @staticmethod
+    def cast(user, obj, status):
+        '''Make the vote of `user` on `obj` an 'UP' or 'DOWN' vote.
+
+        Returns the change applied to obj.vote_count, 0 if the vote already was `status`.
+        '''
+        column, opposite = ('upvote', 'downvote') if status == 'UP' else ('downvote', 'upvote')
+        delta = 1 if status == 'UP' else -1
+        obj_type = 'post' if isinstance(obj, Post) else 'comment'
+        if user.id is None or obj.id is None:
+            # not in the database yet (e.g. the self upvote of a new post)
+            db.session.add(Vote(user=user, **{obj_type: obj, column: True}))
+            obj.vote_count = (obj.vote_count or 0) + delta
+            return delta
+        table = Vote.__table__
+        flipped = db.session.execute(
+            table.update().where(Vote._match(user, obj), table.c[opposite] == True)
+            .values({column: True, opposite: False})).rowcount
+        if flipped:
+            change = 2 * delta
+        elif Vote._insert_ignore({'user_id': user.id, f'{obj_type}_id': obj.id,
+                                  column: True, opposite: False}):
+            change = delta
+        else:
+            change = 0
+        Vote._bump(obj, change)
+        return change
+
+    @staticmethod
+    def remove(user, obj):
+        '''Take back the vote of `user` on `obj`, returns the change of obj.vote_count.'''
+        if user.id is None or obj.id is None:
+            return 0
+        table = Vote.__table__
+        for column, delta in (('upvote', -1), ('downvote', 1)):
+            if db.session.execute(table.delete().where(
+                    Vote._match(user, obj), table.c[column] == True)).rowcount:
+                Vote._bump(obj, delta)
+                return delta
+        return 0
+
+    @staticmethod
+    def toggle(user, obj, status):
+        '''Cast `status`, or remove the vote if it already is `status`. Returns the new status.'''
+        if Vote.cast(user, obj, status):
+            return status
+        Vote.remove(user, obj)
+        return None
 
     def __repr__(self):
         return f'Vote {self.user} {self.post if self.post else self.comment}'
@@ -111,12 +333,25 @@ class Post(db.Model):
     body = db.Column(db.Text)
     body_html = db.Column(db.Text)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.datetime.utcnow)
-    author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    # active history keeps the previous author around so on_update can move
+    # the post_count over when a deleted post is handed to the 'deleted' user
+    author_id = db.column_property(db.Column(db.Integer, db.ForeignKey('users.id')),
+                                   active_history=True)
     comments = db.relationship('Comment', backref='post', lazy='dynamic')
     votes = db.relationship('Vote', backref='post', lazy='dynamic')
     vote_count = db.Column(db.Integer, default=0)
+    version = db.Column(db.Integer, nullable=False, default=1)
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    comment_count = db.Column(db.Integer, default=0)
     deleted = db.Column(db.Boolean, default=False)
     editable = db.Column(db.Boolean, default=True)
+    __table_args__ = (
+        db.Index('ix_posts_author_id_timestamp', 'author_id', 'timestamp'),
+        # the front page only lists live posts; backends without partial
+        # indexes get a plain (timestamp, id) index
+        db.Index('ix_posts_live_timestamp', 'timestamp', 'id',
+                 sqlite_where=db.text('deleted != 1'),
+                 postgresql_where=db.text('deleted != true')))
 
     def __init__(self, **kwargs):
         super(Post, self).__init__(**kwargs)
@@ -127,12 +362,7 @@ class Post(db.Model):
 
     @staticmethod
     def on_changed_body(target, value, oldvalue, initiator):
-        allowed_tags = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
-                        'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
-                        'h1', 'h2', 'h3', 'p']
-        target.body_html = bleach.linkify(bleach.clean(
-            markdown(value, output_format='html'),
-            tags=allowed_tags, strip=True))
+        target.body_html = render_body(target, value, POST_TAGS)
 
     def to_json(self):
         json_post = {
@@ -143,7 +373,7 @@ class Post(db.Model):
             'timestamp': self.timestamp,
             'author_url': url_for('api.get_user', id=self.author_id),
             'comments_url': url_for('api.get_post_comments', id=self.id),
-            'comments_count': self.comments.count(),
+            'comments_count': self.comment_count,
             'vote_count': self.vote_count
         }
         return json_post
@@ -165,12 +395,37 @@ class Post(db.Model):
             target.body = '**[deleted]**'
             target.editable = False
 
+    @staticmethod
+    def on_insert(mapper, connection, target):
+        _bump_counters(connection, User, target.author_id, post_count=1)
+
+    @staticmethod
+    def on_update(mapper, connection, target):
+        # deleting a post hands it over to the 'deleted' user
+        history = db.inspect(target).attrs.author_id.history
+        if history.has_changes():
+            for author_id in history.deleted:
+                _bump_counters(connection, User, author_id, post_count=-1)
+            for author_id in history.added:
+                _bump_counters(connection, User, author_id, post_count=1)
+
+    @staticmethod
+    def on_remove(mapper, connection, target):
+        _bump_counters(connection, User, target.author_id, post_count=-1)
+
+    def cache_tags(self):
+        return {'posts', f'post:{self.id}', f'user:{self.author_id}'}
+
     def __repr__(self):
         return f'<Post {self.id}>'
 
 
 db.event.listen(Post.body, 'set', Post.on_changed_body)
 db.event.listen(Post.deleted, 'set', Post.on_delete)
+db.event.listen(Post, 'after_insert', Post.on_insert)
+db.event.listen(Post, 'after_update', Post.on_update)
+db.event.listen(Post, 'after_delete', Post.on_remove)
+db.event.listen(Post, 'before_update', _on_versioned_update)
 
 
 class Comment(db.Model):
@@ -184,13 +439,16 @@ class Comment(db.Model):
     post_id = db.Column(db.Integer, db.ForeignKey('posts.id'))
     votes = db.relationship('Vote', backref='comment', lazy='dynamic')
     vote_count = db.Column(db.Integer, default=0)
+    version = db.Column(db.Integer, nullable=False, default=1)
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     editable = db.Column(db.Boolean, default=True)
+    __table_args__ = (
+        db.Index('ix_comments_post_id_timestamp', 'post_id', 'timestamp'),
+        db.Index('ix_comments_post_id_vote_count', 'post_id', 'vote_count'))
 
     @staticmethod
     def on_changed_body(target, value, oldvalue, initiator):
-        allowed_tags = ['a', 'abbr', 'acronym', 'b', 'code', 'em', 'i', 'strong']
-        target.body_html = bleach.linkify(bleach.clean(
-            markdown(value, output_format='html'), tags=allowed_tags, strip=True))
+        target.body_html = render_body(target, value, COMMENT_TAGS)
 
     def to_json(self):
         json_comment = {
@@ -210,8 +468,29 @@ class Comment(db.Model):
             raise ValidationError('comment does not have a body')
         return Comment(body=body)
 
+    @staticmethod
+    def on_insert(mapper, connection, target):
+        _bump_counters(connection, Post, target.post_id, comment_count=1)
+        author = target.__dict__.get('author')
+        db.inspect(target).session.info.setdefault('live_events', []).append(
+            ('comment', target.post_id, {
+                'type': 'comment', 'id': target.id, 'post_id': target.post_id,
+                'author': author.username if author is not None else None,
+                'body_html': target.body_html}))
+
+    @staticmethod
+    def on_delete(mapper, connection, target):
+        _bump_counters(connection, Post, target.post_id, comment_count=-1)
+
+    def cache_tags(self):
+        # the comment count of the post shows on the index too
+        return {'posts', f'post:{self.post_id}'}
+
 
 db.event.listen(Comment.body, 'set', Comment.on_changed_body)
+db.event.listen(Comment, 'after_insert', Comment.on_insert)
+db.event.listen(Comment, 'after_delete', Comment.on_delete)
+db.event.listen(Comment, 'before_update', _on_versioned_update)
 
 
 class User(db.Model, UserMixin):
@@ -242,14 +521,23 @@ class User(db.Model, UserMixin):
     comments = db.relationship('Comment', backref='author', lazy='dynamic')
     votes = db.relationship('Vote', foreign_keys='Vote.user_id', backref='user', lazy='dynamic')
     server_own = db.Column(db.Boolean, default=False)
+    post_count = db.Column(db.Integer, default=0)
+    version = db.Column(db.Integer, nullable=False, default=1)
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    follower_count = db.Column(db.Integer, default=0)
+    following_count = db.Column(db.Integer, default=0)
 
     def __init__(self, **kwargs):
         super(User, self).__init__(**kwargs)
-        if self.role is None:
+        if self.role is None and self.role_id is None:
+            roles = Role.cached()
+            role = None
             if self.email == current_app.config['FLASKY_ADMIN']:
-                self.role = Role.query.filter_by(name='Administrator').first()
-            if self.role is None:
-                self.role = Role.query.filter_by(default=True).first()
+                role = roles.by_name.get('Administrator')
+            if role is None:
+                role = roles.default
+            if role is not None:
+                self.role_id = role.id
 
         if self.email is not None and self.avatar_hash is None:
             self.avatar_hash = self.gravatar_hash()
@@ -350,7 +638,10 @@ class User(db.Model, UserMixin):
         return True
 
     def can(self, perm):
-        return self.role is not None and self.role.has_permission(perm)
+        if self.role_id is None or 'role' in self.__dict__:
+            # a role assigned but not flushed yet, or already loaded
+            return self.role is not None and self.role.has_permission(perm)
+        return Role.cached().has_permission(self.role_id, perm)
 
     def is_administrator(self):
         return self.can(Permission.ADMIN)
@@ -368,36 +659,91 @@ class User(db.Model, UserMixin):
         hash = self.avatar_hash or self.gravatar_hash()
         return f'{url}/{hash}?s={size}&d={default}&r={rating}'
 
+    # follow and unfollow check the follows table rather than the follow
+    # graph, whose entries can be stale when another worker changed them
+
+    def _follow_of(self, user):
+        if self.id is None or user.id is None:
+            return None
+        return self.followed.filter_by(followed_id=user.id).first()
+
     def follow(self, user):
-        if not self.is_following(user):
-            f = Follow(follower=self, followed=user)
-            db.session.add(f)
+        '''Follow `user`, returns False if this user already does.'''
+        if self._follow_of(user) is not None:
+            return False
+        db.session.add(Follow(follower=self, followed=user))
+        User._follow_graph().discard(self.id)
+        return True
 
     def unfollow(self, user):
-        f = self.followed.filter_by(followed_id=user.id).first()
-        if f:
-            db.session.delete(f)
+        '''Stop following `user`, returns False if this user didn't follow them.'''
+        f = self._follow_of(user)
+        if f is None:
+            return False
+        db.session.delete(f)
+        User._follow_graph().discard(self.id)
+        return True
+
+    @staticmethod
+    def _follow_graph():
+        return current_app.extensions['follow_graph']
 
     def is_following(self, user):
-        if user.id is None:
+        if self.id is None or user.id is None:
             return False
-        return self.followed.filter_by(followed_id=user.id).first() is not None
+        return User._follow_graph().is_following(self.id, user.id)
 
     def is_followed_by(self, user):
-        if user.id is None:
+        if self.id is None or user.id is None:
             return False
-        return self.followers.filter_by(follower_id=user.id).first() is not None
+        return User._follow_graph().is_following(user.id, self.id)
+
+    def are_following(self, ids):
+        '''The subset of the user `ids` this user follows, for list pages.'''
+        if self.id is None:
+            return set()
+        return User._follow_graph().are_following(self.id, ids)
+
+    def relationships(self, ids):
+        '''Map each of the user `ids` to (self follows them, they follow self).
+
+        Who self follows comes from the follow graph, who follows self from
+        one query for the whole page.
+        '''
+        ids = list(ids)
+        if self.id is None or not ids:
+            return {id: (False, False) for id in ids}
+        following = self.are_following(ids)
+        followers = set(db.session.scalars(db.select(Follow.follower_id).where(
+            Follow.followed_id == self.id, Follow.follower_id.in_(ids))))
+        return {id: (id in following, id in followers) for id in ids}
+
+    def timeline(self):
+        '''The posts of the users this user follows, as a Feed paged by (timestamp, id).
+
+        Fanned out posts are read from the timelines table along its
+        (user_id, timestamp) index, the live posts of authors with too many
+        followers are merged in with a UNION on the same key.
+        '''
+        fanned_out = db.select(Timeline.post_id.label('id'), Timeline.timestamp.label('timestamp'))\
+            .where(Timeline.user_id == self.id)
+        heavy = db.select(Post.id.label('id'), Post.timestamp.label('timestamp'))\
+            .join(Follow, Follow.followed_id == Post.author_id)\
+            .join(User, User.id == Post.author_id)\
+            .where(Follow.follower_id == self.id, Post.deleted != True,
+                   ~Timeline._light_authors())
+        return Feed(Post.query, Post, [(fanned_out, (Timeline.timestamp, Timeline.post_id)),
+                                       (heavy, (Post.timestamp, Post.id))],
+                    (Post.timestamp, Post.id))
 
     @property
     def followed_posts(self):
-        return Post.query.join(Follow, Follow.followed_id == Post.author_id)\
-            .filter(Follow.follower_id == self.id)
+        return self.timeline().unbounded()[0]
 
     @staticmethod
     def add_self_follows():
         for user in User.query.all():
-            if not user.is_following(user):
-                user.follow(user)
+            if user.follow(user):
                 db.session.add(user)
                 db.session.commit()
 
@@ -412,15 +758,21 @@ class User(db.Model, UserMixin):
                           algorithm='HS256')
     
     @staticmethod
-    def verify_auth_token(token):
+    def auth_token_data(token):
         try:
-            data = jwt.decode(
+            return jwt.decode(
                 token,
                 current_app.config['SECRET_KEY'],
                 algorithms=['HS256']
             )
         except:
             return None
+
+    @staticmethod
+    def verify_auth_token(token):
+        data = User.auth_token_data(token)
+        if data is None:
+            return None
         return User.query.get(data['id'])
 
     def to_json(self):
@@ -431,48 +783,28 @@ class User(db.Model, UserMixin):
             'last_seen': self.last_seen,
             'posts_url': url_for('api.get_user_posts', id=self.id),
             'followed_posts_url': url_for('api.get_user_followed_posts', id=self.id),
-            'post_count': self.posts.count()
+            'post_count': self.post_count
         }
         return json_user
     
     def upvote(self, obj_type, obj):
         if obj_type not in ['comment', 'post']:
             raise ValueError('obj_type should be either "post" or "comment"')
-
-        if self.vote_status(obj) != 'UP':
-            vote = obj.votes.filter_by(user_id=self.id).first()
-            if vote is not None:
-                self.remove_vote(obj)
-            vote = Vote(user_id=self.id, **{f"{obj_type}_id": obj.id})
-            vote.upvote = True
-            obj.vote_count += 1
-            db.session.add_all([vote, obj])
+        Vote.cast(self, obj, 'UP')
 
     def downvote(self, obj_type, obj):
         if obj_type not in ['comment', 'post']:
             raise ValueError('obj_type should be either "post" or "comment"')
-
-        if self.vote_status(obj) != 'DOWN':
-            vote = obj.votes.filter_by(user_id=self.id).first()
-            if vote is not None:
-                self.remove_vote(obj)
-            vote = Vote(user_id=self.id, **{f"{obj_type}_id": obj.id})
-            vote.downvote = True
-            obj.vote_count -= 1
-            db.session.add_all([vote, obj])
+        Vote.cast(self, obj, 'DOWN')
 
     def remove_vote(self, obj):
-        vote = obj.votes.filter_by(user_id=self.id).first()
-        if vote is not None:
-            if self.vote_status(obj) == 'UP':
-                obj.vote_count -= 1
-            if self.vote_status(obj) == 'DOWN':
-                obj.vote_count += 1
-            db.session.delete(vote)
-            db.session.add(obj)
+        Vote.remove(self, obj)
 
     def vote_status(self, obj):
-        vote = obj.votes.filter_by(user_id=self.id).first()
+        if self.id is None or obj.id is None:
+            return None
+        vote = db.session.query(Vote.upvote, Vote.downvote)\
+            .filter(Vote._match(self, obj)).first()
         if vote is not None:
             if vote.upvote:
                 return 'UP'
@@ -489,11 +821,140 @@ class User(db.Model, UserMixin):
             u.server_own = True
             db.session.add(u)
             db.session.commit()
-        
+
+    def cache_tags(self):
+        return {f'user:{self.id}'}
+
     def __repr__(self):
         return f'<User {self.username}>'
 
 
+db.event.listen(User, 'before_update', _on_versioned_update)
+
+
+class Timeline(db.Model):
+    # materialized home timelines: a row per (follower, post) written when the
+    # post is created. authors with more than FLASKY_TIMELINE_FANOUT_LIMIT
+    # followers are not fanned out, their posts are merged in at read time.
+    __tablename__ = 'timelines'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('posts.id'), primary_key=True)
+    timestamp = db.Column(db.DateTime)
+    __table_args__ = (db.Index('ix_timelines_user_id_timestamp', 'user_id', 'timestamp'),)
+
+    @staticmethod
+    def _light_authors():
+        limit = current_app.config['FLASKY_TIMELINE_FANOUT_LIMIT']
+        return db.or_(User.follower_count <= limit, User.follower_count == None)
+
+    @staticmethod
+    def on_new_post(mapper, connection, target):
+        if target.deleted:
+            return
+        followers = db.select(Follow.follower_id, db.literal(target.id),
+                              db.literal(target.timestamp, db.DateTime))\
+            .join(User, User.id == Follow.followed_id)\
+            .where(Follow.followed_id == target.author_id, Timeline._light_authors())
+        connection.execute(Timeline.__table__.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'], followers))
+
+    @staticmethod
+    def on_post_update(mapper, connection, target):
+        if db.inspect(target).attrs.deleted.history.added == [True]:
+            connection.execute(Timeline.__table__.delete().where(
+                Timeline.post_id == target.id))
+
+    @staticmethod
+    def on_post_delete(mapper, connection, target):
+        connection.execute(Timeline.__table__.delete().where(
+            Timeline.post_id == target.id))
+
+    @staticmethod
+    def on_follow(mapper, connection, target):
+        # backfill the most recent posts of the newly followed user
+        posts = db.select(db.literal(target.follower_id), Post.id, Post.timestamp)\
+            .join(User, User.id == Post.author_id)\
+            .where(Post.author_id == target.followed_id, Post.deleted != True,
+                   Timeline._light_authors(),
+                   ~db.exists().where(Timeline.user_id == target.follower_id,
+                                      Timeline.post_id == Post.id))\
+            .order_by(Post.timestamp.desc())\
+            .limit(current_app.config['FLASKY_TIMELINE_BACKFILL'])
+        connection.execute(Timeline.__table__.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'], posts))
+
+    @staticmethod
+    def on_unfollow(mapper, connection, target):
+        posts = db.select(Post.id).where(Post.author_id == target.followed_id)
+        connection.execute(Timeline.__table__.delete().where(
+            Timeline.user_id == target.follower_id, Timeline.post_id.in_(posts)))
+        # Follow.on_delete has already counted the unfollow. an author dropping
+        # back to the limit is read from the timelines again, so what they
+        # wrote while they had too many followers is fanned out now
+        follower_count = connection.execute(db.select(User.follower_count).where(
+            User.id == target.followed_id)).scalar()
+        if follower_count == current_app.config['FLASKY_TIMELINE_FANOUT_LIMIT']:
+            Timeline.backfill_followers(connection, target.followed_id)
+
+    @staticmethod
+    def backfill_followers(connection, author_id):
+        '''Add the recent posts of `author_id` to the timelines of all their followers.'''
+        posts = db.select(Post.id, Post.timestamp)\
+            .where(Post.author_id == author_id, Post.deleted != True)\
+            .order_by(Post.timestamp.desc())\
+            .limit(current_app.config['FLASKY_TIMELINE_BACKFILL']).subquery()
+        rows = db.select(Follow.follower_id, posts.c.id, posts.c.timestamp)\
+            .select_from(Follow.__table__.join(posts, db.true()))\
+            .where(Follow.followed_id == author_id,
+                   ~db.exists().where(Timeline.user_id == Follow.follower_id,
+                                      Timeline.post_id == posts.c.id))
+        connection.execute(Timeline.__table__.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'], rows))
+
+    @staticmethod
+    def rebuild():
+        '''Recreate every timeline from the follows and posts tables.'''
+        rows = db.select(Follow.follower_id, Post.id, Post.timestamp)\
+            .join(Post, Post.author_id == Follow.followed_id)\
+            .join(User, User.id == Follow.followed_id)\
+            .where(Post.deleted != True, Timeline._light_authors())
+        db.session.execute(Timeline.__table__.delete())
+        db.session.execute(Timeline.__table__.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'], rows))
+        db.session.commit()
+
+
+db.event.listen(Post, 'after_insert', Timeline.on_new_post)
+db.event.listen(Post, 'after_update', Timeline.on_post_update)
+db.event.listen(Post, 'before_delete', Timeline.on_post_delete)
+db.event.listen(Follow, 'after_insert', Timeline.on_follow)
+db.event.listen(Follow, 'after_delete', Timeline.on_unfollow)
+
+
+class Suggestion(db.Model):
+    # precomputed "who to follow" lists, rewritten by app.suggestions.rebuild
+    __tablename__ = 'suggestions'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    suggested_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    score = db.Column(db.Float, nullable=False)
+    __table_args__ = (db.Index('ix_suggestions_user_id_score', 'user_id', 'score'),)
+
+    @staticmethod
+    def for_user(user_id, limit=None):
+        '''The suggested users of `user_id`, best first, with their scores.
+
+        Users followed since the lists were computed are left out.
+        '''
+        followed = db.select(Follow.followed_id).where(Follow.follower_id == user_id)
+        query = db.select(User, Suggestion.score)\
+            .join(User, User.id == Suggestion.suggested_id)\
+            .where(Suggestion.user_id == user_id, Suggestion.suggested_id.not_in(followed))\
+            .order_by(Suggestion.score.desc(), Suggestion.suggested_id)
+        if limit is not None:
+            query = query.limit(limit)
+        return db.session.execute(query).all()
+
+
 class AnonymousUser(AnonymousUserMixin):
     def can(self, permissions):
         return False
@@ -504,6 +965,36 @@ class AnonymousUser(AnonymousUserMixin):
     def vote_status(self, post):
         return None
 
+    def relationships(self, ids):
+        return {id: (False, False) for id in ids}
+
+
+def reconcile_counters():
+    '''Recompute every stored counter and vote count from the source tables in bulk.'''
+    posts, users = Post.__table__, User.__table__
+    comments, follows, votes = Comment.__table__, Follow.__table__, Vote.__table__
+
+    def count(table, column, id):
+        return db.select(db.func.count()).select_from(table)\
+            .where(column == id).scalar_subquery()
+
+    def score(column, id):
+        value = db.case((votes.c.upvote == True, 1), (votes.c.downvote == True, -1), else_=0)
+        return db.select(db.func.coalesce(db.func.sum(value), 0))\
+            .where(column == id).scalar_subquery()
+
+    db.session.execute(posts.update().values(
+        comment_count=count(comments, comments.c.post_id, posts.c.id),
+        vote_count=score(votes.c.post_id, posts.c.id), **new_version(posts)))
+    db.session.execute(comments.update().values(
+        vote_count=score(votes.c.comment_id, comments.c.id), **new_version(comments)))
+    db.session.execute(users.update().values(
+        post_count=count(posts, posts.c.author_id, users.c.id),
+        follower_count=count(follows, follows.c.followed_id, users.c.id),
+        following_count=count(follows, follows.c.follower_id, users.c.id),
+        **new_version(users)))
+    db.session.commit()
+
 
 @login_manager.user_loader
 def load_user(user_id):
@@ -3,9 +3,10 @@ from . import moderate
 from .. import db
 from ..models import Comment, Permission, User, Role
 from ..decorators import admin_required, permission_required
+from ..votes import vote_statuses
+from ..pagination import paginate
 from datetime import datetime, timedelta
 from flask_login import login_required, current_user
-from flask_sqlalchemy import get_debug_queries
 
 
 @moderate.before_request
@@ -17,30 +18,20 @@ def before_request():
         abort(403)
 
 
-@moderate.after_app_request
-def after_request(response):
-    for query in get_debug_queries():
-        if query.duration >= current_app.config['FLASKY_SLOW_DB_QUERY_TIME']:
-            current_app.logger.warning(
-                    'Slow query: %s\nParameters: %s\nDuration: %fs\nContext: %s\n' %
-                        (query.statement, query.parameters, query.duration, query.context))
-    return response
-
-
 @moderate.route('/')
 def _moderate():
     page = request.args.get('page', 1,  type=int)
     comments_24h = bool(request.cookies.get('comments_24h', ''))
     if comments_24h:
         since = datetime.now() - timedelta(hours=24)
-        query = Comment.query.filter(Comment.timestamp >= since).order_by(Comment.timestamp.desc())
+        query = Comment.query.filter(Comment.timestamp >= since)
     else:
-        query = Comment.query.order_by(Comment.timestamp.desc())
-    pagination = query.paginate(
-        page=page, per_page=current_app.config['FLASKY_COMMENTS_PER_PAGE'],
-        error_out=False)
+        query = Comment.query
+    pagination = paginate(query.options(db.joinedload(Comment.author)), (Comment.timestamp, Comment.id),
+                          per_page=current_app.config['FLASKY_COMMENTS_PER_PAGE'])
     comments = pagination.items
-    return render_template('moderate.html', comments=comments, pagination=pagination, page=page, comments_24h=comments_24h)
+    return render_template('moderate.html', comments=comments, pagination=pagination, page=page, comments_24h=comments_24h,
+                           comment_votes=vote_statuses(current_user, comments))
 
 
 @moderate.route('/enable/<int:id>')
@@ -49,7 +40,8 @@ def moderate_enable(id):
     comment.disabled = False
     db.session.add(comment)
     db.session.commit()
-    return redirect(url_for('._moderate', page=request.args.get('page', 1, type=int)))
+    return redirect(url_for('._moderate', page=request.args.get('page', 1, type=int),
+                            cursor=request.args.get('cursor')))
 
 
 @moderate.route('/disable/<int:id>')
@@ -58,7 +50,8 @@ def moderate_disable(id):
     comment.disabled = True
     db.session.add(comment)
     db.session.commit()
-    return redirect(url_for('._moderate', page=request.args.get('page', 1, type=int)))
+    return redirect(url_for('._moderate', page=request.args.get('page', 1, type=int),
+                            cursor=request.args.get('cursor')))
 
 
 @moderate.route('/all_comments')
@@ -0,0 +1,169 @@
+import base64
+import datetime
+import json
+from flask import request, abort
+from . import db
+
+
+def encode_cursor(values, direction='next'):
+    '''Turn the sort key of a row into an opaque, url safe cursor.'''
+    data = {'d': direction, 'k': [
+        {'dt': value.isoformat()} if isinstance(value, datetime.datetime) else value
+        for value in values]}
+    raw = json.dumps(data, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, size):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        data = json.loads(raw)
+        values = [datetime.datetime.fromisoformat(value['dt'])
+                  if isinstance(value, dict) else value for value in data['k']]
+        direction = data['d']
+    except (ValueError, TypeError, KeyError):
+        return None
+    if direction not in ('next', 'prev') or len(values) != size:
+        return None
+    return values, direction
+
+
+def row_key(row, keys):
+    return [getattr(row, key.key) for key in keys]
+
+
+def _seek(keys, values, descending, inclusive):
+    # (a, b) < (x, y) spelled out as a < x OR (a = x AND b < y), which every
+    # backend can answer from a composite index on (a, b)
+    clauses = []
+    for i, (key, value) in enumerate(zip(keys, values)):
+        last = i == len(keys) - 1
+        if descending:
+            cmp = key <= value if last and inclusive else key < value
+        else:
+            cmp = key >= value if last and inclusive else key > value
+        clauses.append(db.and_(*[k == v for k, v in zip(keys[:i], values[:i])], cmp))
+    return db.or_(*clauses)
+
+
+class Feed:
+    '''Rows of a model merged from several selects that share a sort key.
+
+    `arms` are (select, key columns) pairs, each select giving the model's
+    id and its sort key, labeled like the `keys` of the model. A page of a
+    feed pushes the seek and the limit into every select, so each one is read
+    along its own index and only a page worth of rows of each is merged.
+    '''
+    def __init__(self, query, model, arms, keys):
+        self.query = query
+        self.model = model
+        self.arms = arms
+        self.keys = keys
+
+    def filter(self, *criteria):
+        return Feed(self.query.filter(*criteria), self.model, self.arms, self.keys)
+
+    def options(self, *options):
+        return Feed(self.query.options(*options), self.model, self.arms, self.keys)
+
+    def _join(self, selects):
+        merged = db.union(*selects).subquery()
+        keys = [merged.c[key.key] for key in self.keys]
+        return self.query.join(merged, merged.c.id == self.model.id), keys
+
+    def unbounded(self):
+        '''The whole feed as a query of the model, and its sort key.'''
+        return self._join([select for select, _ in self.arms])
+
+    def page(self, descending, values, inclusive, limit):
+        '''The query of `limit` rows after `values`, in the order of the keys.'''
+        selects = []
+        for select, keys in self.arms:
+            if values is not None:
+                select = select.where(_seek(keys, values, descending, inclusive))
+            select = select.order_by(*[key.desc() if descending else key.asc()
+                                       for key in keys]).limit(limit)
+            selects.append(db.select(select.subquery()))
+        query, keys = self._join(selects)
+        return query.order_by(*[key.desc() if descending else key.asc()
+                                for key in keys]).limit(limit)
+
+
+def _fetch(query, keys, descending, values, inclusive, limit):
+    if isinstance(query, Feed):
+        return query.page(descending, values, inclusive, limit).all()
+    rows = query.order_by(None).order_by(
+        *[key.desc() if descending else key.asc() for key in keys])
+    if values is not None:
+        rows = rows.filter(_seek(keys, values, descending, inclusive))
+    return rows.limit(limit).all()
+
+
+class KeysetPagination:
+    '''Cursor based pagination over a unique sort key such as (timestamp, id).
+
+    Unlike the OFFSET based flask_sqlalchemy pagination it never counts the
+    rows and the cost of a page doesn't depend on how deep it is. It exposes
+    the same has_prev/has_next/items attributes, `page` and `total` are None.
+    '''
+    page = None
+    total = None
+
+    def __init__(self, query, keys, per_page, values=None, direction='next',
+                 inclusive=False, descending=True):
+        self.per_page = per_page
+        forward = direction == 'next'
+        order = descending if forward else not descending
+        items = _fetch(query, keys, order, values, inclusive and forward, per_page + 1)
+        more = len(items) > per_page
+        items = items[:per_page]
+        if not forward:
+            items.reverse()
+        self.items = items
+        if forward:
+            self.has_next = more
+            self.has_prev = values is not None
+            if inclusive and self.has_prev:
+                # a direct seek can land on the first page
+                self.has_prev = bool(_fetch(query, keys, not descending, values, False, 1))
+        else:
+            self.has_prev = more
+            self.has_next = True
+        self.next_cursor = self.prev_cursor = None
+        if items and self.has_next:
+            self.next_cursor = encode_cursor(row_key(items[-1], keys), 'next')
+        if items and self.has_prev:
+            self.prev_cursor = encode_cursor(row_key(items[0], keys), 'prev')
+
+
+def paginate(query, keys, per_page, descending=True, seek=None):
+    '''Paginate `query` ordered by `keys` according to the request arguments.
+
+    `?cursor=` selects keyset pagination, `?page=` keeps working with OFFSET
+    pagination for old links. In both modes the returned object has
+    next_cursor/prev_cursor so the following pages are keyset ones. `seek` is
+    a row the page should start at.
+    '''
+    if seek is not None:
+        return KeysetPagination(query, keys, per_page, row_key(seek, keys),
+                                inclusive=True, descending=descending)
+    cursor = request.args.get('cursor')
+    if cursor:
+        decoded = decode_cursor(cursor, len(keys))
+        if decoded is None:
+            abort(400)
+        values, direction = decoded
+        return KeysetPagination(query, keys, per_page, values, direction,
+                                descending=descending)
+    page = request.args.get('page', 1, type=int)
+    if isinstance(query, Feed):
+        query, keys = query.unbounded()
+    pagination = query.order_by(None).order_by(
+        *[key.desc() if descending else key.asc() for key in keys]).paginate(
+        page=page, per_page=per_page, error_out=False)
+    pagination.next_cursor = pagination.prev_cursor = None
+    if pagination.items and pagination.has_next:
+        pagination.next_cursor = encode_cursor(row_key(pagination.items[-1], keys), 'next')
+    if pagination.items and pagination.has_prev:
+        pagination.prev_cursor = encode_cursor(row_key(pagination.items[0], keys), 'prev')
+    return pagination
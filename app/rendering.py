@@ -0,0 +1,196 @@
+import hashlib
+import multiprocessing
+import threading
+import bleach
+from markdown import markdown
+from markupsafe import escape
+from flask import current_app, has_app_context
+from . import db
+from .cache import TTLCache
+
+POST_TAGS = ('a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
+             'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
+             'h1', 'h2', 'h3', 'p')
+COMMENT_TAGS = ('a', 'abbr', 'acronym', 'b', 'code', 'em', 'i', 'strong')
+
+# keyed by a hash of the tags and the body, so changing the allowed tags
+# never serves html sanitized with the old list
+_cache = TTLCache(maxsize=4096, ttl=float('inf'))
+_slots = None
+_slots_lock = threading.Lock()
+_threads = []
+
+
+def _render(body, tags):
+    return bleach.linkify(bleach.clean(
+        markdown(body, output_format='html'), tags=list(tags), strip=True))
+
+
+def _plain(body):
+    return f'<p>{escape(body)}</p>'
+
+
+def _key(body, tags):
+    return hashlib.sha256('\0'.join(tags + (body,)).encode('utf-8')).digest()
+
+
+def _render_to(connection, body, tags):
+    connection.send(_render(body, tags))
+    connection.close()
+
+
+def _render_in_process(body, tags):
+    '''The html of `body` rendered in a process of its own, None if it took too long.
+
+    A render that runs out of time can only be stopped by killing its
+    process, so each gets one and no other render goes down with it. At most
+    FLASKY_RENDER_PROCESSES run at once.
+    '''
+    global _slots
+    config = current_app.config
+    with _slots_lock:
+        if _slots is None:
+            _slots = threading.BoundedSemaphore(config['FLASKY_RENDER_PROCESSES'])
+    with _slots:
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=_render_to, args=(sender, body, tags),
+                                          daemon=True)
+        process.start()
+        sender.close()
+        try:
+            if receiver.poll(config['FLASKY_RENDER_TIMEOUT']):
+                return receiver.recv()
+        except EOFError:
+            pass
+        finally:
+            receiver.close()
+            if process.is_alive():
+                process.terminate()
+            process.join()
+    current_app.logger.warning('Rendering a %d characters body timed out', len(body))
+    return None
+
+
+def render(body, tags):
+    '''Markdown `body` to html sanitized down to `tags`.
+
+    Results are cached by content. Large bodies are rendered in a process
+    with a time limit, None is returned if they run out of it. Bodies over
+    FLASKY_RENDER_MAX_SIZE aren't parsed at all and are shown as escaped text.
+    '''
+    if body is None:
+        return None
+    key = _key(body, tags)
+    html = _cache.get(key)
+    if html is not None:
+        return html
+    if len(body) > current_app.config['FLASKY_RENDER_MAX_SIZE']:
+        return _plain(body)
+    if len(body) > current_app.config['FLASKY_RENDER_POOL_THRESHOLD']:
+        html = _render_in_process(body, tags)
+        if html is None:
+            return None
+    else:
+        html = _render(body, tags)
+    _cache.set(key, html)
+    return html
+
+
+def render_body(target, body, tags):
+    '''The body_html of `target` for its new `body`, None until it's rendered.
+
+    Large bodies aren't rendered by the request that sets them: body_html
+    stays NULL, which the templates show as text, and a thread renders it
+    once the transaction is committed.
+    '''
+    config = current_app.config
+    if body is None or len(body) <= config['FLASKY_RENDER_POOL_THRESHOLD'] or \
+            len(body) > config['FLASKY_RENDER_MAX_SIZE']:
+        return render(body, tags)
+    html = _cache.get(_key(body, tags))
+    if html is None:
+        db.session.info.setdefault('render_later', []).append((target, tags))
+    return html
+
+
+def _collect_renders(session, flush_context):
+    waiting = []
+    for target, tags in session.info.pop('render_later', []):
+        identity = db.inspect(target).identity
+        if identity is None:
+            # not flushed yet
+            waiting.append((target, tags))
+        else:
+            session.info.setdefault('render_jobs', []).append(
+                (type(target), identity[0], target.body, tags))
+    if waiting:
+        session.info['render_later'] = waiting
+
+
+def _start_renders(session):
+    jobs = session.info.pop('render_jobs', None)
+    if jobs and has_app_context():
+        thread = threading.Thread(target=_render_jobs,
+                                  args=(current_app._get_current_object(), jobs), daemon=True)
+        _threads[:] = [t for t in _threads if t.is_alive()] + [thread]
+        thread.start()
+
+
+def _discard_renders(session):
+    session.info.pop('render_later', None)
+    session.info.pop('render_jobs', None)
+
+
+def _render_jobs(app, jobs):
+    with app.app_context():
+        try:
+            for model, id, body, tags in jobs:
+                html = render(body, tags)
+                obj = db.session.get(model, id)
+                # the body may have been edited meanwhile, that edit renders its own
+                if html is not None and obj is not None and obj.body == body:
+                    obj.body_html = html
+            db.session.commit()
+        except Exception:
+            app.logger.exception('Rendering %d bodies failed', len(jobs))
+
+
+def join(timeout=None):
+    '''Wait for the renders started so far, for tests and scripts.'''
+    for thread in list(_threads):
+        thread.join(timeout)
+
+
+db.event.listen(db.session, 'after_flush_postexec', _collect_renders)
+db.event.listen(db.session, 'after_commit', _start_renders)
+db.event.listen(db.session, 'after_rollback', _discard_renders)
+
+
+def rerender_all(batch_size=500):
+    '''Render every post and comment body again, after the allowed tags changed.
+
+    Rows are read in id order, `batch_size` at a time, and only the ones
+    whose html changed are written back. Returns the number of updated rows.
+    '''
+    from .models import Post, Comment, new_version
+    updated = 0
+    for model, tags in ((Post, POST_TAGS), (Comment, COMMENT_TAGS)):
+        table = model.__table__
+        last_id = 0
+        while True:
+            rows = db.session.execute(
+                db.select(table.c.id, table.c.body, table.c.body_html)
+                .where(table.c.id > last_id).order_by(table.c.id).limit(batch_size)).all()
+            if not rows:
+                break
+            last_id = rows[-1].id
+            changes = [{'row_id': row.id, 'html': html} for row in rows
+                       for html in [render(row.body, tags)]
+                       if html is not None and html != row.body_html]
+            if changes:
+                db.session.execute(
+                    table.update().where(table.c.id == db.bindparam('row_id'))
+                    .values(body_html=db.bindparam('html'), **new_version(table)), changes)
+                updated += len(changes)
+            db.session.commit()
+    return updated
@@ -0,0 +1,183 @@
+import functools
+import pickle
+import threading
+from flask import current_app, g, request, session, make_response, has_app_context
+from flask_login import current_user
+from . import db
+from .cache import TTLCache
+
+
+class LocalStore:
+    '''Cached responses and tag clocks in an LRU of this process.'''
+    def __init__(self, maxsize, ttl):
+        self.ttl = ttl
+        self.entries = TTLCache(maxsize, ttl)
+        self.tags = TTLCache(maxsize * 4, ttl, on_evict=self._evicted)
+        self.now = 0
+        # the latest clock of a tag pushed out of `tags`, a tag that isn't
+        # there anymore may have been bumped as late as this
+        self.floor = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def set(self, key, entry):
+        self.entries.set(key, entry)
+
+    def clock(self):
+        return self.now
+
+    def _evicted(self, tag, clock):
+        self.floor = max(self.floor, clock)
+
+    def tag_clocks(self, tags):
+        return [self.tags.get(tag, self.floor) for tag in tags]
+
+    def bump(self, tags):
+        # a tag only has to be remembered for as long as the entries that
+        # were stored before its bump could still be served
+        with self.lock:
+            self.now += 1
+            now = self.now
+        for tag in tags:
+            self.tags.set(tag, now)
+
+
+class RedisStore:
+    '''The same, shared by every worker through Redis.'''
+    prefix = 'flasky:response:'
+
+    def __init__(self, url, ttl):
+        import redis
+        self.redis = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, key):
+        data = self.redis.get(self.prefix + 'entry:' + key)
+        return pickle.loads(data) if data is not None else None
+
+    def set(self, key, entry):
+        self.redis.set(self.prefix + 'entry:' + key, pickle.dumps(entry), ex=self.ttl)
+
+    def clock(self):
+        return int(self.redis.get(self.prefix + 'clock') or 0)
+
+    def tag_clocks(self, tags):
+        return [int(clock or 0) for clock in
+                self.redis.mget([self.prefix + 'tag:' + tag for tag in tags])]
+
+    def bump(self, tags):
+        now = self.redis.incr(self.prefix + 'clock')
+        self.redis.mset({self.prefix + 'tag:' + tag: now for tag in tags})
+        for tag in tags:
+            self.redis.expire(self.prefix + 'tag:' + tag, self.ttl)
+
+
+class ResponseCache:
+    '''Whole responses of anonymous GET requests, dropped when their data changes.
+
+    Views tag the response with what it shows, e.g. 'post:12', commits bump
+    the tags of the rows they wrote. The store keeps a clock that every bump
+    advances and the clock of each tag's last bump: a response is served
+    while none of its tags was bumped after the request that rendered it
+    started, so a write racing a render never leaves a stale entry behind.
+    '''
+    def __init__(self, store):
+        self.store = store
+
+    def lookup(self, key):
+        entry = self.store.get(key)
+        if entry is None or not self.fresh(entry['start'], entry['tags']):
+            return None
+        return current_app.response_class(entry['body'], status=entry['status'],
+                                          headers=entry['headers'])
+
+    def fresh(self, start, tags):
+        return all(clock <= start for clock in self.store.tag_clocks(tags))
+
+    def save(self, key, response, start, tags):
+        tags = sorted(tags)
+        if not self.fresh(start, tags):
+            return
+        self.store.set(key, {'start': start, 'tags': tags, 'status': response.status_code,
+                             'headers': list(response.headers), 'body': response.get_data()})
+
+    def invalidate(self, tags):
+        if tags:
+            self.store.bump(sorted(tags))
+
+
+def tag(*tags):
+    '''Declare what the current response depends on.'''
+    if 'response_tags' in g:
+        g.response_tags.update(tags)
+
+
+def cached(cookies=()):
+    '''Serve the view from the response cache to anonymous users.
+
+    The key is the path, query string and the values of `cookies`. Only
+    responses the view tagged, without cookies set, are stored.
+    '''
+    def decorator(f):
+        @functools.wraps(f)
+        def decorated_function(*args, **kwargs):
+            cache = current_app.extensions.get('response_cache')
+            if cache is None or request.method != 'GET' or \
+                    current_user.is_authenticated or session.get('_flashes'):
+                return f(*args, **kwargs)
+            key = '\0'.join([request.full_path] +
+                            [request.cookies.get(name, '') for name in cookies])
+            response = cache.lookup(key)
+            if response is not None:
+                response.headers['X-Cache'] = 'HIT'
+                return response
+            start = cache.store.clock()
+            g.response_tags = set()
+            response = make_response(f(*args, **kwargs))
+            tags = g.pop('response_tags')
+            if response.status_code == 200 and tags and 'Set-Cookie' not in response.headers:
+                cache.save(key, response, start, tags)
+            response.headers['X-Cache'] = 'MISS'
+            return response
+        return decorated_function
+    return decorator
+
+
+def collect_tags(session, flush_context):
+    tags = session.info.setdefault('cache_tags', set())
+    for obj in session.new | session.dirty | session.deleted:
+        cache_tags = getattr(obj, 'cache_tags', None)
+        if cache_tags is not None:
+            tags.update(cache_tags())
+
+
+def invalidate_committed(session):
+    tags = session.info.pop('cache_tags', None)
+    if tags and has_app_context():
+        cache = current_app.extensions.get('response_cache')
+        if cache is not None:
+            cache.invalidate(tags)
+
+
+def discard_tags(session):
+    session.info.pop('cache_tags', None)
+
+
+db.event.listen(db.session, 'after_flush', collect_tags)
+db.event.listen(db.session, 'after_commit', invalidate_committed)
+db.event.listen(db.session, 'after_rollback', discard_tags)
+
+
+def init_app(app):
+    config = app.config
+    url = config['FLASKY_RESPONSE_CACHE_STORE']
+    if not url:
+        return
+    if url.startswith('redis'):
+        store = RedisStore(url, config['FLASKY_RESPONSE_CACHE_TTL'])
+    else:
+        store = LocalStore(config['FLASKY_RESPONSE_CACHE_SIZE'],
+                           config['FLASKY_RESPONSE_CACHE_TTL'])
+    app.extensions['response_cache'] = ResponseCache(store)
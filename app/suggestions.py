@@ -0,0 +1,109 @@
+import datetime
+import heapq
+from array import array
+from flask import current_app
+from . import db
+from .models import User, Follow, Suggestion
+
+
+class Graph:
+    '''The follows table as compressed sparse rows.
+
+    The users followed by user `u` are indices[indptr[u]:indptr[u + 1]], and
+    ages[i] is how many days ago the follow at indices[i] was made. Ids are
+    used as row numbers, so the arrays cost 4 bytes per user and 8 per follow.
+    '''
+    def __init__(self, indptr, indices, ages):
+        self.indptr = indptr
+        self.indices = indices
+        self.ages = ages
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def followed(self, user_id):
+        if user_id >= len(self):
+            return range(0)
+        return range(self.indptr[user_id], self.indptr[user_id + 1])
+
+    @staticmethod
+    def load(batch_size=100000, now=None):
+        '''Read the follows, self follows left out, `batch_size` rows at a time.'''
+        now = now or datetime.datetime.utcnow()
+        table = Follow.__table__
+        indptr, indices, ages = array('i', [0]), array('i'), array('f')
+        last = (0, 0)
+        while True:
+            rows = db.session.execute(
+                db.select(table.c.follower_id, table.c.followed_id, table.c.timestamp)
+                .where(db.tuple_(table.c.follower_id, table.c.followed_id) > last,
+                       table.c.follower_id != table.c.followed_id)
+                .order_by(table.c.follower_id, table.c.followed_id)
+                .limit(batch_size)).all()
+            if not rows:
+                break
+            for follower_id, followed_id, timestamp in rows:
+                # rows arrive sorted by follower, close the rows up to it
+                while len(indptr) <= follower_id:
+                    indptr.append(len(indices))
+                indices.append(followed_id)
+                ages.append((now - timestamp).total_seconds() / 86400 if timestamp else 0)
+            last = (rows[-1].follower_id, rows[-1].followed_id)
+        indptr.append(len(indices))
+        return Graph(indptr, indices, ages)
+
+
+def score(graph, user_id, half_life, exclude=()):
+    '''Score the friends of the friends of `user_id` that it doesn't follow yet.
+
+    Every path user -> friend -> candidate adds 1, plus up to 1 more the more
+    recent the friend -> candidate follow is, halving every `half_life` days.
+    So candidates are ranked by their common neighbours first.
+    '''
+    indices, ages = graph.indices, graph.ages
+    followed = {indices[i] for i in graph.followed(user_id)}
+    seen = followed | {user_id} | set(exclude)
+    scores = {}
+    for friend in followed:
+        for i in graph.followed(friend):
+            candidate = indices[i]
+            if candidate not in seen:
+                scores[candidate] = scores.get(candidate, 0) + 1 + 0.5 ** (ages[i] / half_life)
+    return scores
+
+
+def rebuild(top=None, chunk_size=1000, batch_size=100000, half_life=None):
+    '''Recompute the top `top` suggestions of every user, returns the rows written.
+
+    The graph is loaded once, then users are scored `chunk_size` ids at a
+    time: their old suggestions are replaced and committed before the next
+    chunk, so only a chunk worth of scores is ever held in memory and pages
+    keep showing the old lists meanwhile.
+    '''
+    config = current_app.config
+    top = top or config['FLASKY_SUGGESTIONS_TOP']
+    half_life = half_life or config['FLASKY_SUGGESTIONS_HALF_LIFE']
+    graph = Graph.load(batch_size)
+    exclude = set(db.session.scalars(db.select(User.id).where(User.server_own == True)))
+    table = Suggestion.__table__
+    written = 0
+    for start in range(0, len(graph), chunk_size):
+        end = min(start + chunk_size, len(graph))
+        rows = []
+        for user_id in range(start, end):
+            if user_id in exclude:
+                continue
+            scores = score(graph, user_id, half_life, exclude)
+            best = heapq.nsmallest(top, scores.items(), key=lambda item: (-item[1], item[0]))
+            rows.extend({'user_id': user_id, 'suggested_id': candidate, 'score': value}
+                        for candidate, value in best)
+        db.session.execute(table.delete().where(table.c.user_id >= start,
+                                                table.c.user_id < end))
+        if rows:
+            db.session.execute(table.insert(), rows)
+        db.session.commit()
+        written += len(rows)
+    # users with ids past the last follower don't follow anyone anymore
+    db.session.execute(table.delete().where(table.c.user_id >= len(graph)))
+    db.session.commit()
+    return written
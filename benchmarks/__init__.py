@@ -0,0 +1,97 @@
+'''Benchmark suites for Flasky.
+
+Every suite produces a JSON document of the form
+
+    {"suite": ..., "created": ..., "python": ..., "results": {size: {name: stats}}}
+
+which `compare` diffs against a baseline run to fail on regressions.
+'''
+import datetime
+import json
+import math
+import platform
+
+
+def percentile(values, p):
+    '''Nearest-rank percentile of a sorted list.'''
+    if not values:
+        return None
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def summarize(timings, queries=None):
+    '''Latency stats in milliseconds for a list of durations in seconds.'''
+    timings = sorted(timings)
+    total = sum(timings)
+    stats = {
+        'count': len(timings),
+        'throughput': len(timings) / total if total else None,
+        'mean': 1000 * total / len(timings) if timings else None,
+        'p50': 1000 * percentile(timings, 50) if timings else None,
+        'p95': 1000 * percentile(timings, 95) if timings else None,
+        'p99': 1000 * percentile(timings, 99) if timings else None,
+    }
+    if queries:
+        stats['queries'] = sum(queries) / len(queries)
+    return stats
+
+
+def document(suite, results):
+    return {'suite': suite,
+            'created': datetime.datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'results': results}
+
+
+def save(doc, path):
+    with open(path, 'w') as f:
+        json.dump(doc, f, indent=2, sort_keys=True)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+# metrics where a bigger number is better, the others are costs
+HIGHER_IS_BETTER = {'throughput'}
+
+
+def compare(baseline, current, metric='p95', threshold=0.2):
+    '''Regressions of `current` against `baseline`.
+
+    A benchmark regresses when `metric` got worse by more than `threshold`
+    (a fraction): grew, or shrank for HIGHER_IS_BETTER metrics. Running
+    more queries is a regression too. Returns a list of
+    (size, name, what, old, new) tuples, benchmarks missing from either run
+    are ignored.
+    '''
+    regressions = []
+    for size, benchmarks in current['results'].items():
+        for name, stats in benchmarks.items():
+            old = baseline['results'].get(size, {}).get(name)
+            if old is None:
+                continue
+            if metric in HIGHER_IS_BETTER:
+                worse = lambda old, new: new < old * (1 - threshold)
+            else:
+                worse = lambda old, new: new > old * (1 + threshold)
+            if old.get(metric) and stats.get(metric) and worse(old[metric], stats[metric]):
+                regressions.append((size, name, metric, old[metric], stats[metric]))
+            if old.get('queries') is not None and stats.get('queries') is not None and \
+                    stats['queries'] > old['queries']:
+                regressions.append((size, name, 'queries', old['queries'], stats['queries']))
+    return regressions
+
+
+def report(doc, columns=('throughput', 'p50', 'p95', 'p99', 'queries', 'alloc_kb'), echo=print):
+    for size, benchmarks in doc['results'].items():
+        shown = [column for column in columns
+                 if any(column in stats for stats in benchmarks.values())]
+        echo(f'size {size}')
+        width = max(len(name) for name in benchmarks) if benchmarks else 0
+        echo('  ' + ' ' * width + ''.join(f'{column:>12}' for column in shown))
+        for name, stats in benchmarks.items():
+            cells = ''.join(f'{stats[column]:>12.2f}' if stats.get(column) is not None
+                            else f'{"-":>12}' for column in shown)
+            echo(f'  {name:<{width}}{cells}')
@@ -0,0 +1,139 @@
+'''Microbenchmarks of the hot model methods on graphs of growing size.
+
+For each size N the fixture has a user followed by N users, a reader
+following N authors, and a post and a comment that have N votes each. Every
+operation is timed with its SQL count, then run again under tracemalloc for
+the peak memory it allocates. The scaling curve is the log-log slope of the
+mean time between the smallest and the largest size: about 0 for operations
+that don't depend on N, about 1 for the ones that grow linearly with it.
+'''
+import math
+import time
+import tracemalloc
+from . import summarize, document
+
+
+def _fixture(size):
+    from app import db
+    from app.models import User, Post, Comment, Follow, Vote, Role, Timeline, \
+        reconcile_counters
+    role_id = Role.cached().default.id
+    first = (db.session.query(db.func.max(User.id)).scalar() or 0) + 1
+    db.session.execute(User.__table__.insert(), [
+        {'email': f'user{i}@example.com', 'username': f'user{i}', 'role_id': role_id,
+         'confirmed': True, 'password_hash': 'x'} for i in range(2 * size + 3)])
+    ids = [id for id, in db.session.query(User.id).filter(User.id >= first).order_by(User.id)]
+    hub, reader, actor, crowd, authors = ids[0], ids[1], ids[2], ids[3:size + 3], ids[size + 3:]
+    db.session.execute(Follow.__table__.insert(),
+                       [{'follower_id': id, 'followed_id': id} for id in ids] +
+                       [{'follower_id': id, 'followed_id': hub} for id in crowd] +
+                       [{'follower_id': reader, 'followed_id': id} for id in authors])
+    db.session.execute(Post.__table__.insert(), [
+        {'title': 'title', 'body': 'body', 'body_html': '<p>body</p>', 'author_id': id,
+         'deleted': False, 'editable': True} for id in [hub] + authors])
+    post_id = db.session.query(Post.id).filter(Post.author_id == hub).scalar()
+    db.session.execute(Comment.__table__.insert(), [
+        {'body': 'body', 'body_html': 'body', 'author_id': hub, 'post_id': post_id,
+         'disabled': False, 'editable': True}])
+    comment_id = db.session.query(Comment.id).scalar()
+    db.session.execute(Vote.__table__.insert(), [
+        {'user_id': id, 'post_id': post_id, 'comment_id': None, 'upvote': True,
+         'downvote': False} for id in crowd] + [
+        {'user_id': id, 'post_id': None, 'comment_id': comment_id, 'upvote': True,
+         'downvote': False} for id in crowd])
+    db.session.commit()
+    reconcile_counters()
+    Timeline.rebuild()
+    return (User.query.get(hub), User.query.get(reader), User.query.get(actor),
+            Post.query.get(post_id), Comment.query.get(comment_id))
+
+
+def operations(hub, reader, actor, post, comment):
+    '''(name, callable) pairs, run in order so that the state cycles.'''
+    from app import db
+    from app.models import Post
+    token = actor.generate_auth_token(3600)
+
+    def commit(f):
+        def call():
+            f()
+            db.session.commit()
+        return call
+
+    return [
+        ('upvote', commit(lambda: actor.upvote('post', post))),
+        ('vote_status', lambda: actor.vote_status(post)),
+        ('downvote', commit(lambda: actor.downvote('post', post))),
+        ('remove_vote', commit(lambda: actor.remove_vote(post))),
+        ('comment upvote', commit(lambda: actor.upvote('comment', comment))),
+        ('comment remove_vote', commit(lambda: actor.remove_vote(comment))),
+        ('follow', commit(lambda: actor.follow(hub))),
+        ('is_following', lambda: actor.is_following(hub)),
+        ('unfollow', commit(lambda: actor.unfollow(hub))),
+        ('followed_posts', lambda: reader.timeline().page(True, None, False, 20).all()),
+        ('Post.to_json', lambda: post.to_json()),
+        ('Comment.to_json', lambda: comment.to_json()),
+        ('verify_auth_token', lambda: actor.verify_auth_token(token)),
+    ]
+
+
+def measure(ops, calls, allocation_calls):
+    from app.instrumentation import QueryStats
+    timings = {name: [] for name, _ in ops}
+    queries = {name: [] for name, _ in ops}
+    for _ in range(calls):
+        for name, op in ops:
+            with QueryStats() as stats:
+                start = time.perf_counter()
+                op()
+                timings[name].append(time.perf_counter() - start)
+            queries[name].append(stats.count)
+    peaks = {name: 0 for name, _ in ops}
+    tracemalloc.start()
+    try:
+        for _ in range(allocation_calls):
+            for name, op in ops:
+                tracemalloc.reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+                op()
+                peaks[name] = max(peaks[name], tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        tracemalloc.stop()
+    results = {}
+    for name, _ in ops:
+        results[name] = summarize(timings[name], queries[name])
+        results[name]['alloc_kb'] = peaks[name] / 1024
+    return results
+
+
+def scaling(results):
+    '''Log-log slope of the mean time of each operation across sizes.'''
+    sizes = sorted(results, key=int)
+    if len(sizes) < 2:
+        return {}
+    low, high = sizes[0], sizes[-1]
+    span = math.log(int(high) / int(low))
+    return {name: math.log(results[high][name]['mean'] / stats['mean']) / span
+            for name, stats in results[low].items()
+            if name in results[high] and stats['mean'] and results[high][name]['mean']}
+
+
+def run(sizes=(10, 100, 1000), calls=50, allocation_calls=5, echo=print):
+    from app import create_app, db
+    from app.models import Role, User
+    results = {}
+    for size in sizes:
+        app = create_app('benchmark')
+        with app.app_context(), app.test_request_context():
+            db.drop_all()
+            db.create_all()
+            Role.insert_roles()
+            User.create_deleted_user()
+            echo(f'building a graph of size {size}')
+            ops = operations(*_fixture(size))
+            results[str(size)] = measure(ops, calls, allocation_calls)
+            db.session.remove()
+            db.drop_all()
+    doc = document('models', results)
+    doc['scaling'] = scaling(results)
+    return doc
@@ -0,0 +1,147 @@
+'''HTTP benchmarks of the main routes.
+
+Requests go through the Werkzeug test client of an app created with the
+'benchmark' configuration, or to a running server (such as gunicorn) when a
+base url is given. SQL counts come from the X-Query-Count response header, so
+a server has to run with FLASKY_QUERY_HEADERS enabled for them to show up.
+'''
+import http.cookiejar
+import json
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from base64 import b64encode
+from . import summarize, document
+
+PASSWORD = 'password'
+
+
+class TestClientDriver:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, headers=None, data=None, json_body=None):
+        response = self.client.open(path, method=method, headers=headers,
+                                    data=data, json=json_body)
+        return response.status_code, response.headers.get('X-Query-Count')
+
+
+class URLDriver:
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def request(self, method, path, headers=None, data=None, json_body=None):
+        headers = dict(headers or {})
+        body = None
+        if json_body is not None:
+            body = json.dumps(json_body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        elif data is not None:
+            body = urllib.parse.urlencode(data).encode('utf-8')
+        request = urllib.request.Request(self.base_url + path, body, headers, method=method)
+        try:
+            with self.opener.open(request) as response:
+                response.read()
+                return response.status, response.headers.get('X-Query-Count')
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers.get('X-Query-Count')
+
+
+def scenarios():
+    '''The benchmarked requests, aimed at the busiest rows of the database.
+
+    Returns the user to log in as and a list of
+    (name, logged in, method, path, headers, json body) tuples.
+    '''
+    from app.models import User, Post
+    users = User.query.filter(User.server_own != True)
+    user = users.order_by(User.following_count.desc()).first()
+    author = users.order_by(User.post_count.desc()).first()
+    post = Post.query.filter(Post.deleted != True).order_by(Post.comment_count.desc()).first()
+    api = {'Authorization': 'Basic ' + b64encode(
+        f'{user.email}:{PASSWORD}'.encode('utf-8')).decode('utf-8'),
+        'Accept': 'application/json'}
+    return user, [
+        ('index', False, 'GET', '/', None, None),
+        ('index (timeline)', True, 'GET', '/', None, None),
+        ('post', False, 'GET', f'/post/{post.id}', None, None),
+        ('user', False, 'GET', f'/user/{author.username}', None, None),
+        ('upvote', True, 'POST', f'/upvote/post/{post.id}', None, {'id': post.id}),
+        ('api posts', False, 'GET', '/api/v1/posts/', api, None),
+        ('api comments', False, 'GET', '/api/v1/comments/', api, None),
+        ('api post comments', False, 'GET', f'/api/v1/posts/{post.id}/comments/', api, None),
+        ('api user posts', False, 'GET', f'/api/v1/users/{author.id}/posts/', api, None),
+        ('api timeline', False, 'GET', f'/api/v1/users/{user.id}/timeline/', api, None),
+        ('api followers', False, 'GET', f'/api/v1/users/{author.id}/followers/', api, None),
+    ]
+
+
+def log_in(driver, user):
+    status, _ = driver.request('POST', '/auth/login',
+                               data={'email': user.email, 'password': PASSWORD})
+    if status != 302:
+        raise RuntimeError(f'could not log in as {user.email} ({status}), '
+                           'is CSRF protection disabled?')
+    driver.request('GET', '/followed')
+
+
+def measure(anonymous, logged_in, scenarios, requests, warmup):
+    results = {}
+    for name, login, method, path, headers, json_body in scenarios:
+        driver = logged_in if login else anonymous
+        timings, queries = [], []
+        for i in range(warmup + requests):
+            start = time.perf_counter()
+            status, count = driver.request(method, path, headers=headers, json_body=json_body)
+            elapsed = time.perf_counter() - start
+            if status >= 400:
+                raise RuntimeError(f'{name}: {method} {path} returned {status}')
+            if i >= warmup:
+                timings.append(elapsed)
+                if count is not None:
+                    queries.append(int(count))
+        results[name] = summarize(timings, queries)
+    return results
+
+
+def dataset(users):
+    '''Row counts of a dataset with `users` users.'''
+    return dict(users=users, posts=10 * users, comments=20 * users,
+                follows=10 * users, votes=20 * users)
+
+
+def run(sizes=(100, 1000), requests=100, warmup=10, seed=0, url=None, echo=print):
+    '''Benchmark the routes on a freshly seeded database of each size.
+
+    With `url` the requests go to that server instead and the database it
+    uses is benchmarked as it is, `sizes` is ignored.
+    '''
+    from app import create_app, db, fake, activity
+    from app.models import Role, User
+    results = {}
+    if url is not None:
+        user, benchmarks = scenarios()
+        anonymous, logged_in = URLDriver(url), URLDriver(url)
+        log_in(logged_in, user)
+        results['server'] = measure(anonymous, logged_in, benchmarks, requests, warmup)
+        return document('routes', results)
+    for size in sizes:
+        app = create_app('benchmark')
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            Role.insert_roles()
+            User.create_deleted_user()
+            echo(f'seeding {size} users')
+            fake.seed(seed=seed, report=echo, **dataset(size))
+            user, benchmarks = scenarios()
+            anonymous, logged_in = TestClientDriver(app), TestClientDriver(app)
+            log_in(logged_in, user)
+            results[str(size)] = measure(anonymous, logged_in, benchmarks, requests, warmup)
+            activity.flush()
+            db.session.remove()
+            db.drop_all()
+    return document('routes', results)
@@ -0,0 +1,80 @@
+'''The API serializers against the models' to_json methods.
+
+For each page size N the fixture has N posts, N comments, N users and N
+follows, all loaded before timing. Each kind of page is serialized with
+to_json and with app.api.serializers, and the resulting documents are
+encoded into a response with the JSON provider of the app, as jsonify
+does, and with orjson when it is installed. Timings include the SQL, if any, the serializer had to run.
+'''
+from .models import measure
+
+
+def _fixture(size):
+    from app import db
+    from app.models import User, Post, Comment, Follow, Role
+    role_id = Role.cached().default.id
+    first = (db.session.query(db.func.max(User.id)).scalar() or 0) + 1
+    db.session.execute(User.__table__.insert(), [
+        {'email': f'user{i}@example.com', 'username': f'user{i}', 'role_id': role_id,
+         'confirmed': True, 'password_hash': 'x'} for i in range(size + 1)])
+    ids = [id for id, in db.session.query(User.id).filter(User.id >= first).order_by(User.id)]
+    hub, crowd = ids[0], ids[1:]
+    db.session.execute(Follow.__table__.insert(),
+                       [{'follower_id': id, 'followed_id': hub} for id in crowd])
+    db.session.execute(Post.__table__.insert(), [
+        {'title': 'title', 'body': 'body', 'body_html': '<p>body</p>', 'author_id': id,
+         'deleted': False, 'editable': True} for id in crowd])
+    post_id = db.session.query(db.func.min(Post.id)).scalar()
+    db.session.execute(Comment.__table__.insert(), [
+        {'body': 'body', 'body_html': 'body', 'author_id': id, 'post_id': post_id,
+         'disabled': False, 'editable': True} for id in crowd])
+    db.session.commit()
+    return (Post.query.all(), Comment.query.all(), User.query.filter(User.id.in_(crowd)).all(),
+            Follow.query.filter(Follow.followed_id == hub).all())
+
+
+def operations(posts, comments, users, follows):
+    from flask import current_app
+    from app.api import serializers
+    from app.models import Follow
+    encoders = [('json', current_app.json.response)]
+    try:
+        from app.json_provider import OrjsonProvider
+        encoders.append(('orjson', OrjsonProvider(current_app._get_current_object()).response))
+    except ImportError:
+        pass
+    pages = [
+        ('posts', posts, lambda page: [post.to_json() for post in page], serializers.posts),
+        ('comments', comments, lambda page: [comment.to_json() for comment in page],
+         serializers.comments),
+        ('users', users, lambda page: [user.to_json() for user in page], serializers.users),
+        ('follows', follows, lambda page: [Follow.to_json(follow) for follow in page],
+         serializers.follows),
+    ]
+    ops = []
+    for kind, page, to_json, serialize in pages:
+        ops.append((f'{kind} to_json', lambda page=page, f=to_json: f(page)))
+        ops.append((f'{kind} serializer', lambda page=page, f=serialize: f(page)))
+        document = serialize(page)
+        for name, dumps in encoders:
+            ops.append((f'{kind} {name} encode', lambda doc=document, f=dumps: f(doc)))
+    return ops
+
+
+def run(sizes=(20, 50, 200), calls=50, allocation_calls=5, echo=print):
+    from app import create_app, db
+    from app.models import Role, User
+    from . import document
+    results = {}
+    for size in sizes:
+        app = create_app('benchmark')
+        with app.app_context(), app.test_request_context():
+            db.drop_all()
+            db.create_all()
+            Role.insert_roles()
+            User.create_deleted_user()
+            echo(f'serializing pages of {size}')
+            results[str(size)] = measure(operations(*_fixture(size)), calls, allocation_calls)
+            db.session.remove()
+            db.drop_all()
+    return document('serializers', results)
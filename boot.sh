@@ -9,4 +9,7 @@ while true; do
 	echo Deploy command failed, retrying in 5 secs...
 	sleep 5
 done
-exec gunicorn -b 0.0.0.0:5000 --access-logfile - --error-logfile - main:app
+# post pages keep a WebSocket open for live updates (app/live.py), each one
+# holds a thread for as long as it is open, so sync workers won't do
+exec gunicorn -b 0.0.0.0:5000 --worker-class gthread --threads ${GUNICORN_THREADS:-100} \
+	--access-logfile - --error-logfile - main:app
@@ -12,13 +12,60 @@ class Config:
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     FLASKY_MAIL_SUBJECT_PREFIX = '[FLASKY]'
     FLASKY_MAIL_SENDER = 'FLASKY Admin flasky@example.com'
+    FLASKY_MAIL_WORKERS = 2
+    FLASKY_MAIL_QUEUE_SIZE = 1000
+    FLASKY_MAIL_ENQUEUE_TIMEOUT = 1
+    FLASKY_MAIL_RETRIES = 3
+    FLASKY_MAIL_BACKOFF = 1
+    FLASKY_MAIL_IDLE = 2
+    FLASKY_MAIL_SHUTDOWN_TIMEOUT = 10
+    FLASKY_LOG_QUEUE_SIZE = 10000
+    FLASKY_LOG_DIGEST_WINDOW = int(os.environ.get('FLASKY_LOG_DIGEST_WINDOW', 300))
+    FLASKY_LOG_DIGEST_RATE = 10
+    FLASKY_LIVE_BACKEND = os.environ.get('FLASKY_LIVE_BACKEND', 'local')
+    FLASKY_LIVE_INTERVAL = 0.5
+    FLASKY_LIVE_QUEUE_SIZE = 100
     FLASKY_ADMIN = os.environ.get('FLASKY_ADMIN')
     SQLALCHEMY_TRACK_MODIFICATION = False
     FLASKY_POSTS_PER_PAGE = 20
     FLASKY_FOLLOWERS_PER_PAGE = 50
     FLASKY_COMMENTS_PER_PAGE = os.environ.get('FLASKY_COMMENTS_PER_PAGE', 30)
-    SQLALCHEMY_RECORD_QUERIES = True
     FLASKY_SLOW_DB_QUERY_TIME = 0.5
+    # per request SQL accounting, see app/instrumentation.py
+    FLASKY_QUERY_HEADERS = True
+    FLASKY_QUERY_BUDGETS = {
+        'main.index': 15,
+        'main.user': 15,
+        'main.post': 15,
+        'main.upvote': 10,
+        'main.downvote': 10,
+        'main.followers': 10,
+        'main.followed_by': 10,
+    }
+    FLASKY_QUERY_BUDGET_DEFAULT = None
+    FLASKY_QUERY_BUDGET_ACTION = os.environ.get('FLASKY_QUERY_BUDGET_ACTION', 'log')
+    FLASKY_TIMELINE_FANOUT_LIMIT = int(os.environ.get('FLASKY_TIMELINE_FANOUT_LIMIT', 1000))
+    FLASKY_TIMELINE_BACKFILL = 1000
+    FLASKY_LAST_SEEN_INTERVAL = int(os.environ.get('FLASKY_LAST_SEEN_INTERVAL', 60))
+    FLASKY_LAST_SEEN_MIN_DELTA = int(os.environ.get('FLASKY_LAST_SEEN_MIN_DELTA', 60))
+    FLASKY_AUTH_CACHE_SIZE = 1024
+    FLASKY_ROLE_CACHE_CHECK = 10
+    FLASKY_FOLLOW_CACHE_SIZE = 10000
+    FLASKY_FOLLOW_CACHE_TTL = 300
+    FLASKY_API_EXPAND_COMMENTS = 5
+    FLASKY_API_BATCH_SIZE = 100
+    FLASKY_JSON_PROVIDER = os.environ.get('FLASKY_JSON_PROVIDER', 'default')
+    FLASKY_RESPONSE_CACHE_STORE = os.environ.get('FLASKY_RESPONSE_CACHE_STORE', 'local')
+    FLASKY_RESPONSE_CACHE_SIZE = 1024
+    FLASKY_RESPONSE_CACHE_TTL = 60
+    FLASKY_SUGGESTIONS_TOP = 20
+    FLASKY_SUGGESTIONS_SHOWN = 5
+    FLASKY_SUGGESTIONS_HALF_LIFE = 30
+    FLASKY_RENDER_POOL_THRESHOLD = 10000
+    FLASKY_RENDER_MAX_SIZE = 100000
+    FLASKY_RENDER_TIMEOUT = 2
+    FLASKY_RENDER_PROCESSES = 2
+    FLASKY_AUTH_CACHE_TTL = int(os.environ.get('FLASKY_AUTH_CACHE_TTL', 60))
     SSL_REDIRECT = False
 
     @staticmethod
@@ -37,17 +84,29 @@ class TestingConfig(Config):
     SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL') or \
         'sqlite://'
     WTF_CSRF_ENABLED = False
+    FLASKY_QUERY_BUDGET_ACTION = 'raise'
+    FLASKY_LAST_SEEN_INTERVAL = 0
+
+
+class BenchmarkConfig(Config):
+    # the benchmarks drop and recreate every table of this database
+    SQLALCHEMY_DATABASE_URI = os.environ.get('BENCH_DATABASE_URL') or \
+        'sqlite://'
+    WTF_CSRF_ENABLED = False
 
 
 class ProductionConfig(Config):
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URI') or \
         'sqlite:///' + os.path.join(basedir, 'data.sqlite')
+    FLASKY_QUERY_HEADERS = False
     @classmethod
     def init_app(cls, app):
         Config.init_app(app)
-        # email errors to the administrators
+        # email errors to the administrators, from a background thread and
+        # with repeated errors batched into a digest
         import logging
         from logging.handlers import SMTPHandler
+        from app.log_handlers import add_queued_handler
         credentials = None
         secure = None
         if getattr(cls, 'MAIL_USERNAME', None) is not None:
@@ -61,8 +120,7 @@ class ProductionConfig(Config):
                 subject=cls.FLASKY_MAIL_SUBJECT_PREFIX + ' Application Error',
                 credentials=credentials,
                 secure=secure)
-        mail_handler.setLevel(logging.ERROR)
-        app.logger.addHandler(mail_handler)
+        add_queued_handler(app, mail_handler, logging.ERROR, digest=True)
 
 
 class DockerConfig(ProductionConfig):
@@ -86,14 +144,14 @@ class UnixConfig(ProductionConfig):
         # log to syslog
         import logging
         from logging.handlers import SysLogHandler
-        syslog_handler = SysLogHandler()
-        syslog_handler.setLevel(logging.WARNING)
-        app.logger.addHandler(syslog_handler)
+        from app.log_handlers import add_queued_handler
+        add_queued_handler(app, SysLogHandler(), logging.WARNING)
 
 
 config = {
     'development': DevelopmentConfig,
     'testing': TestingConfig,
+    'benchmark': BenchmarkConfig,
     'production': ProductionConfig,
     'docker': DockerConfig,
     'unix': UnixConfig,
@@ -10,6 +10,7 @@ import sys
 import click
 from app import create_app, db
 from app.models import User, Role, Post, Permission, Comment, Vote, Follow
+from app.models import Timeline, reconcile_counters
 from flask_migrate import Migrate, upgrade
 from dotenv import load_dotenv
 
@@ -78,3 +79,135 @@ def deploy():
 
     # ensure all users are following themselves
     User.add_self_follows()
+
+
+@app.cli.command()
+def recount():
+    '''Recompute the stored comment, post and follower counters.'''
+    reconcile_counters()
+
+
+@app.cli.command('rebuild-timelines')
+def rebuild_timelines():
+    '''Recreate the materialized home timelines.'''
+    Timeline.rebuild()
+
+
+@app.cli.command()
+@click.option('--batch-size', default=500, help='Rows read and written at a time.')
+def rerender(batch_size):
+    '''Render every post and comment body again, after the allowed tags changed.'''
+    from app.rendering import rerender_all
+    print(f'{rerender_all(batch_size)} bodies updated')
+
+
+@app.cli.command()
+@click.option('--top', default=None, type=int, help='Suggestions kept per user.')
+@click.option('--chunk-size', default=1000, help='Users scored between commits.')
+@click.option('--batch-size', default=100000, help='Follows read at a time.')
+def suggestions(top, chunk_size, batch_size):
+    '''Recompute the "who to follow" suggestions, run it periodically.'''
+    from app.suggestions import rebuild
+    print(f'{rebuild(top, chunk_size, batch_size)} suggestions written')
+
+
+@app.cli.command()
+@click.option('--users', default=1000, help='Number of users.')
+@click.option('--posts', default=10000, help='Number of posts.')
+@click.option('--comments', default=30000, help='Number of comments.')
+@click.option('--follows', default=20000, help='Number of follows, besides self follows.')
+@click.option('--votes', default=50000, help='Number of post votes, besides self upvotes.')
+@click.option('--seed', 'random_seed', default=None, type=int,
+              help='Random seed, the same seed gives the same data.')
+@click.option('--batch-size', default=5000, help='Rows inserted at a time.')
+def seed(users, posts, comments, follows, votes, random_seed, batch_size):
+    '''Fill the database with a large synthetic dataset for load testing.'''
+    from app import fake
+    fake.seed(users, posts, comments, follows, votes, seed=random_seed,
+              batch_size=batch_size)
+
+
+@app.cli.group()
+def bench():
+    '''Run the benchmark suites.'''
+
+
+def _finish_benchmark(doc, output, baseline, metric, threshold):
+    import benchmarks
+    benchmarks.report(doc)
+    for name, slope in doc.get('scaling', {}).items():
+        print(f'scaling {name}: {slope:.2f}')
+    if output:
+        benchmarks.save(doc, output)
+    if baseline:
+        regressions = benchmarks.compare(benchmarks.load(baseline), doc, metric, threshold)
+        for size, name, what, old, new in regressions:
+            print(f'REGRESSION size {size} {name}: {what} {old:.2f} -> {new:.2f}')
+        if regressions:
+            sys.exit(1)
+
+
+def benchmark_options(f):
+    f = click.option('--output', '-o', default=None, help='Write the results to this JSON file.')(f)
+    f = click.option('--baseline', default=None,
+                     help='JSON results of an earlier run to compare against.')(f)
+    f = click.option('--metric', default='p95', help='Metric compared with the baseline.')(f)
+    f = click.option('--threshold', default=0.2,
+                     help='Allowed relative change of the metric, for the worse, before failing.')(f)
+    return f
+
+
+@bench.command()
+@click.option('--sizes', default='100,1000', help='Comma separated numbers of users to seed.')
+@click.option('--requests', default=100, help='Measured requests per route.')
+@click.option('--warmup', default=10, help='Unmeasured requests per route.')
+@click.option('--seed', 'random_seed', default=0, help='Random seed of the datasets.')
+@click.option('--url', default=None,
+              help='Benchmark a running server using this database instead of the test client.')
+@benchmark_options
+def routes(sizes, requests, warmup, random_seed, url, output, baseline, metric, threshold):
+    '''Benchmark the main routes and report latency percentiles and SQL counts.'''
+    from benchmarks import routes as suite
+    doc = suite.run([int(size) for size in sizes.split(',')], requests, warmup,
+                    random_seed, url)
+    _finish_benchmark(doc, output, baseline, metric, threshold)
+
+
+@bench.command()
+@click.option('--sizes', default='10,100,1000', help='Comma separated graph sizes.')
+@click.option('--calls', default=50, help='Timed calls per operation.')
+@click.option('--allocation-calls', default=5, help='Calls per operation traced for allocations.')
+@benchmark_options
+def models(sizes, calls, allocation_calls, output, baseline, metric, threshold):
+    '''Benchmark the hot model methods on graphs of growing size.'''
+    from benchmarks import models as suite
+    doc = suite.run([int(size) for size in sizes.split(',')], calls, allocation_calls)
+    _finish_benchmark(doc, output, baseline, metric, threshold)
+
+
+@bench.command()
+@click.option('--sizes', default='20,50,200', help='Comma separated page sizes.')
+@click.option('--calls', default=50, help='Timed calls per operation.')
+@click.option('--allocation-calls', default=5, help='Calls per operation traced for allocations.')
+@benchmark_options
+def serializers(sizes, calls, allocation_calls, output, baseline, metric, threshold):
+    '''Benchmark the API serializers against the to_json methods.'''
+    from benchmarks import serializers as suite
+    doc = suite.run([int(size) for size in sizes.split(',')], calls, allocation_calls)
+    _finish_benchmark(doc, output, baseline, metric, threshold)
+
+
+@app.cli.command()
+def explain():
+    '''Show the query plan of each view's main query and flag full scans.'''
+    from app.explain import view_queries, explain as explain_query
+    full_scans = 0
+    for name, query in view_queries():
+        lines, scans = explain_query(query)
+        flag = 'FULL SCAN of ' + ', '.join(scans) if scans else 'ok'
+        print(f'{name}: {flag}')
+        for line in lines:
+            print(f'    {line}')
+        full_scans += bool(scans)
+    if full_scans:
+        sys.exit(1)
@@ -0,0 +1,28 @@
+"""cache versions
+
+Revision ID: 3a9d51f0e6b2
+Revises: c47d2e8b9f10
+Create Date: 2026-10-18 17:02:41.118305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3a9d51f0e6b2'
+down_revision = 'c47d2e8b9f10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('cache_versions',
+    sa.Column('name', sa.String(length=64), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade():
+    op.drop_table('cache_versions')
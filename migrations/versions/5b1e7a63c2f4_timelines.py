@@ -0,0 +1,40 @@
+"""timelines
+
+Revision ID: 5b1e7a63c2f4
+Revises: dacf00d9d8fd
+Create Date: 2026-10-18 11:40:07.552911
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b1e7a63c2f4'
+down_revision = 'dacf00d9d8fd'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('timelines',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('post_id', sa.Integer(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['post_id'], ['posts.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'post_id')
+    )
+    op.create_index('ix_timelines_user_id_timestamp', 'timelines', ['user_id', 'timestamp'], unique=False)
+
+    # fan out every existing post, 'flask rebuild-timelines' applies the
+    # follower limit afterwards
+    op.execute('INSERT INTO timelines (user_id, post_id, timestamp) '
+               'SELECT follows.follower_id, posts.id, posts.timestamp '
+               'FROM follows JOIN posts ON posts.author_id = follows.followed_id '
+               'WHERE posts.deleted IS NULL OR posts.deleted = false')
+
+
+def downgrade():
+    op.drop_index('ix_timelines_user_id_timestamp', table_name='timelines')
+    op.drop_table('timelines')
@@ -0,0 +1,36 @@
+"""unique votes
+
+Revision ID: 8e3f0c9a1d27
+Revises: 5b1e7a63c2f4
+Create Date: 2026-10-18 14:02:55.104733
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8e3f0c9a1d27'
+down_revision = '5b1e7a63c2f4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # drop the duplicate votes left behind by racing clicks, then recount
+    op.execute('DELETE FROM votes WHERE id NOT IN (SELECT id FROM '
+               '(SELECT min(id) AS id FROM votes GROUP BY user_id, post_id, comment_id) AS keep)')
+    score = ('SELECT coalesce(sum(CASE WHEN votes.upvote THEN 1 '
+             'WHEN votes.downvote THEN -1 ELSE 0 END), 0) FROM votes')
+    op.execute(f'UPDATE posts SET vote_count = ({score} WHERE votes.post_id = posts.id)')
+    op.execute(f'UPDATE comments SET vote_count = ({score} WHERE votes.comment_id = comments.id)')
+
+    with op.batch_alter_table('votes') as batch_op:
+        batch_op.create_unique_constraint('uq_votes_user_id_post_id', ['user_id', 'post_id'])
+        batch_op.create_unique_constraint('uq_votes_user_id_comment_id', ['user_id', 'comment_id'])
+
+
+def downgrade():
+    with op.batch_alter_table('votes') as batch_op:
+        batch_op.drop_constraint('uq_votes_user_id_comment_id', type_='unique')
+        batch_op.drop_constraint('uq_votes_user_id_post_id', type_='unique')
@@ -0,0 +1,33 @@
+"""suggestions
+
+Revision ID: 9c4e27a1b5d3
+Revises: 3a9d51f0e6b2
+Create Date: 2026-10-18 19:12:05.604217
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9c4e27a1b5d3'
+down_revision = '3a9d51f0e6b2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('suggestions',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('suggested_id', sa.Integer(), nullable=False),
+    sa.Column('score', sa.Float(), nullable=False),
+    sa.ForeignKeyConstraint(['suggested_id'], ['users.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'suggested_id')
+    )
+    op.create_index('ix_suggestions_user_id_score', 'suggestions', ['user_id', 'score'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_suggestions_user_id_score', table_name='suggestions')
+    op.drop_table('suggestions')
@@ -0,0 +1,40 @@
+"""hot query indexes
+
+Revision ID: c47d2e8b9f10
+Revises: 8e3f0c9a1d27
+Create Date: 2026-10-18 15:26:13.870412
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c47d2e8b9f10'
+down_revision = '8e3f0c9a1d27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(op.f('ix_votes_post_id'), 'votes', ['post_id'], unique=False)
+    op.create_index(op.f('ix_votes_comment_id'), 'votes', ['comment_id'], unique=False)
+    op.create_index('ix_posts_author_id_timestamp', 'posts', ['author_id', 'timestamp'], unique=False)
+    op.create_index('ix_posts_live_timestamp', 'posts', ['timestamp', 'id'], unique=False,
+                    sqlite_where=sa.text('deleted != 1'),
+                    postgresql_where=sa.text('deleted != true'))
+    op.create_index('ix_comments_post_id_timestamp', 'comments', ['post_id', 'timestamp'], unique=False)
+    op.create_index('ix_comments_post_id_vote_count', 'comments', ['post_id', 'vote_count'], unique=False)
+    op.create_index('ix_follows_followed_id_timestamp', 'follows', ['followed_id', 'timestamp'], unique=False)
+    op.create_index('ix_follows_follower_id_timestamp', 'follows', ['follower_id', 'timestamp'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_follows_follower_id_timestamp', table_name='follows')
+    op.drop_index('ix_follows_followed_id_timestamp', table_name='follows')
+    op.drop_index('ix_comments_post_id_vote_count', table_name='comments')
+    op.drop_index('ix_comments_post_id_timestamp', table_name='comments')
+    op.drop_index('ix_posts_live_timestamp', table_name='posts')
+    op.drop_index('ix_posts_author_id_timestamp', table_name='posts')
+    op.drop_index(op.f('ix_votes_comment_id'), table_name='votes')
+    op.drop_index(op.f('ix_votes_post_id'), table_name='votes')
@@ -0,0 +1,40 @@
+"""engagement counters
+
+Revision ID: dacf00d9d8fd
+Revises: 06cfba0b6653
+Create Date: 2026-10-18 09:12:41.318202
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'dacf00d9d8fd'
+down_revision = '06cfba0b6653'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('posts', sa.Column('comment_count', sa.Integer(), nullable=True, server_default='0'))
+    op.add_column('users', sa.Column('post_count', sa.Integer(), nullable=True, server_default='0'))
+    op.add_column('users', sa.Column('follower_count', sa.Integer(), nullable=True, server_default='0'))
+    op.add_column('users', sa.Column('following_count', sa.Integer(), nullable=True, server_default='0'))
+
+    # backfill the counters from the existing rows
+    op.execute('UPDATE posts SET comment_count = '
+               '(SELECT count(*) FROM comments WHERE comments.post_id = posts.id)')
+    op.execute('UPDATE users SET '
+               'post_count = (SELECT count(*) FROM posts WHERE posts.author_id = users.id), '
+               'follower_count = (SELECT count(*) FROM follows WHERE follows.followed_id = users.id), '
+               'following_count = (SELECT count(*) FROM follows WHERE follows.follower_id = users.id)')
+
+
+def downgrade():
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.drop_column('following_count')
+        batch_op.drop_column('follower_count')
+        batch_op.drop_column('post_count')
+    with op.batch_alter_table('posts') as batch_op:
+        batch_op.drop_column('comment_count')
@@ -0,0 +1,34 @@
+"""row versions
+
+Revision ID: e5b8a0d4c291
+Revises: 9c4e27a1b5d3
+Create Date: 2026-10-18 20:41:37.902114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5b8a0d4c291'
+down_revision = '9c4e27a1b5d3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    for table in ('posts', 'comments', 'users'):
+        op.add_column(table, sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+        op.add_column(table, sa.Column('updated_at', sa.DateTime(), nullable=True))
+
+    # backfill updated_at with the creation time of the existing rows
+    op.execute('UPDATE posts SET updated_at = timestamp')
+    op.execute('UPDATE comments SET updated_at = timestamp')
+    op.execute('UPDATE users SET updated_at = member_since')
+
+
+def downgrade():
+    for table in ('users', 'comments', 'posts'):
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column('updated_at')
+            batch_op.drop_column('version')
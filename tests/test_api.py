@@ -1,9 +1,12 @@
 from flask import url_for, request
+import datetime
 import json
 import unittest
+from unittest import mock
 import re
 from app import create_app, db
 from app.models import User, Role, Post, Comment, Follow
+from app.instrumentation import max_queries
 from base64 import b64encode
 
 
@@ -261,3 +264,428 @@ class ApiTestCase(unittest.TestCase):
         json_response = json.loads(response.get_data(as_text=True))
         self.assertIsNotNone(json_response.get('comments'))
         self.assertEqual(json_response.get('count', 0), 2)
+
+    def test_cursor_pagination(self):
+        r = Role.query.filter_by(name='User').first()
+        u = User(email='john@example.com', password='cat', confirmed=True, role=r)
+        db.session.add(u)
+        db.session.commit()
+        # posts sharing a timestamp are still ordered by id
+        timestamp = datetime.datetime.utcnow()
+        posts = [Post(title=f'post {i}', body='body', author=u, timestamp=timestamp)
+                 for i in range(7)]
+        db.session.add_all(posts)
+        db.session.commit()
+        self.app.config['FLASKY_POSTS_PER_PAGE'] = 3
+
+        # walk forward from the first offset page using the cursors
+        response = self.client.get(
+            '/api/v1/posts/',
+            headers=self.get_api_headers('john@example.com', 'cat'))
+        json_response = json.loads(response.get_data(as_text=True))
+        self.assertEqual(json_response['count'], 7)
+        self.assertIsNone(json_response['prev_url'])
+        titles = [post['title'] for post in json_response['posts']]
+        pages = [json_response]
+        while json_response['next_url']:
+            response = self.client.get(
+                json_response['next_url'],
+                headers=self.get_api_headers('john@example.com', 'cat'))
+            self.assertEqual(response.status_code, 200)
+            json_response = json.loads(response.get_data(as_text=True))
+            self.assertIsNone(json_response['count'])
+            titles += [post['title'] for post in json_response['posts']]
+            pages.append(json_response)
+        self.assertEqual(titles, [f'post {i}' for i in reversed(range(7))])
+        self.assertEqual(len(pages), 3)
+
+        # and back again
+        response = self.client.get(
+            pages[-1]['prev_url'],
+            headers=self.get_api_headers('john@example.com', 'cat'))
+        json_response = json.loads(response.get_data(as_text=True))
+        self.assertEqual(json_response['posts'], pages[1]['posts'])
+
+        # page numbers still work
+        response = self.client.get(
+            '/api/v1/posts/?page=2',
+            headers=self.get_api_headers('john@example.com', 'cat'))
+        json_response = json.loads(response.get_data(as_text=True))
+        self.assertEqual(json_response['posts'], pages[1]['posts'])
+
+        # a tampered cursor is rejected
+        response = self.client.get(
+            '/api/v1/posts/?cursor=garbage',
+            headers=self.get_api_headers('john@example.com', 'cat'))
+        self.assertEqual(response.status_code, 400)
+
+    def test_posts_query_count(self):
+        r = Role.query.filter_by(name='User').first()
+        u = User(email='john@example.com', password='cat', confirmed=True, role=r)
+        db.session.add(u)
+        db.session.commit()
+        headers = self.get_api_headers('john@example.com', 'cat')
+        db.session.add_all([Post(title='title', body='body', author=u) for _ in range(3)])
+        db.session.commit()
+        response = self.client.get('/api/v1/posts/', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        count = int(response.headers['X-Query-Count'])
+        db.session.add_all([Post(title='title', body='body', author=u) for _ in range(10)])
+        db.session.commit()
+        with max_queries(count):
+            response = self.client.get('/api/v1/posts/', headers=headers)
+        self.assertEqual(response.status_code, 200)
+
+    def test_followers_relationships(self):
+        r = Role.query.filter_by(name='User').first()
+        viewer = User(email='john@example.com', username='john', password='cat',
+                      confirmed=True, role=r)
+        target = User(email='susan@example.com', username='susan', password='dog',
+                      confirmed=True, role=r)
+        others = [User(email=f'user{i}@example.com', username=f'user{i}', password='cat')
+                  for i in range(4)]
+        db.session.add_all([viewer, target] + others)
+        db.session.commit()
+        for u in others + [viewer]:
+            u.follow(target)
+        viewer.follow(others[0])
+        others[1].follow(viewer)
+        db.session.commit()
+        self.assertEqual(viewer.relationships([others[0].id, others[1].id, others[2].id]), {
+            others[0].id: (True, False), others[1].id: (False, True),
+            others[2].id: (False, False)})
+        headers = self.get_api_headers('john@example.com', 'cat')
+        response = self.client.get(f'/api/v1/users/{target.id}/followers/', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        followers = {f['follower']: f['following']
+                     for f in response.get_json()['followers']}
+        self.assertTrue(followers['user0'])
+        self.assertFalse(followers['user1'])
+        count = int(response.headers['X-Query-Count'])
+        # more followers on the page cost no extra queries
+        more = [User(email=f'more{i}@example.com', username=f'more{i}', password='cat')
+                for i in range(5)]
+        db.session.add_all(more)
+        db.session.commit()
+        for u in more:
+            u.follow(target)
+        db.session.commit()
+        with max_queries(count):
+            response = self.client.get(f'/api/v1/users/{target.id}/followers/', headers=headers)
+        self.assertEqual(len(response.get_json()['followers']), 11)
+
+    def test_suggestions(self):
+        r = Role.query.filter_by(name='User').first()
+        users = [User(email=f'user{i}@example.com', username=f'user{i}', password='cat',
+                      confirmed=True, role=r) for i in range(3)]
+        db.session.add_all(users)
+        db.session.commit()
+        users[0].follow(users[1])
+        users[1].follow(users[2])
+        db.session.commit()
+        from app.suggestions import rebuild
+        rebuild()
+        response = self.client.get(f'/api/v1/users/{users[0].id}/suggestions/',
+                                   headers=self.get_api_headers('user0@example.com', 'cat'))
+        self.assertEqual(response.status_code, 200)
+        json_response = response.get_json()
+        self.assertEqual(json_response['count'], 1)
+        self.assertEqual(json_response['suggestions'][0]['username'], 'user2')
+        self.assertIn('score', json_response['suggestions'][0])
+
+        # the limit is kept within 1..FLASKY_SUGGESTIONS_TOP
+        top = self.app.config['FLASKY_SUGGESTIONS_TOP']
+        with mock.patch('app.api.users.Suggestion.for_user', return_value=[]) as for_user:
+            for limit, expected in (('100000000', top), ('-5', 1), ('3', 3)):
+                self.client.get(f'/api/v1/users/{users[0].id}/suggestions/?limit={limit}',
+                                headers=self.get_api_headers('user0@example.com', 'cat'))
+                self.assertEqual(for_user.call_args.args, (users[0].id, expected))
+
+    def test_conditional_get(self):
+        r = Role.query.filter_by(name='User').first()
+        u = User(email='john@example.com', username='john', password='cat',
+                 confirmed=True, role=r)
+        other = User(email='susan@example.com', username='susan', password='dog')
+        p = Post(title='title', body='body', author=u)
+        db.session.add_all([u, other, p])
+        db.session.commit()
+        headers = self.get_api_headers('john@example.com', 'cat')
+        for url in (f'/api/v1/posts/{p.id}', '/api/v1/posts/', f'/api/v1/users/{u.id}/posts/'):
+            response = self.client.get(url, headers=headers)
+            self.assertEqual(response.status_code, 200)
+            etag = response.headers['ETag']
+            response = self.client.get(url, headers=dict(headers, **{'If-None-Match': etag}))
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.get_data(), b'')
+            self.assertEqual(response.headers['ETag'], etag)
+            # a proxy may have weakened the ETag, If-None-Match compares weakly
+            response = self.client.get(url, headers=dict(headers, **{'If-None-Match': 'W/' + etag}))
+            self.assertEqual(response.status_code, 304)
+
+        # a vote is counted with a Core UPDATE, it changes the version too
+        url = f'/api/v1/posts/{p.id}'
+        response = self.client.get(url, headers=headers)
+        etag = response.headers['ETag']
+        self.assertIn('Last-Modified', response.headers)
+        version = p.version
+        other.upvote('post', p)
+        db.session.commit()
+        self.assertEqual(p.version, version + 1)
+        response = self.client.get(url, headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['vote_count'], 2)
+        response = self.client.get('/api/v1/posts/', headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 200)
+
+        # so does an edit through the ORM
+        etag = response.headers['ETag']
+        p.body = 'new body'
+        db.session.commit()
+        self.assertEqual(p.version, version + 2)
+        response = self.client.get('/api/v1/posts/', headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.get(url, headers=dict(headers, **{
+            'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'}))
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(url, headers=dict(headers, **{
+            'If-Modified-Since': 'Fri, 01 Jan 2010 00:00:00 GMT'}))
+        self.assertEqual(response.status_code, 200)
+
+    def test_serializers(self):
+        from app.api import serializers
+        u1 = User(email='john@example.com', username='john', password='cat')
+        u2 = User(email='susan@example.com', username='susan', password='dog')
+        p = Post(title='title', body='*body*', author=u1)
+        c = Comment(body='comment', post=p, author=u2)
+        db.session.add_all([u1, u2, p, c])
+        db.session.commit()
+        u2.follow(u1)
+        db.session.commit()
+        follows = u1.followers.all()
+        with self.app.test_request_context():
+            self.assertEqual(serializers.posts([p]), [p.to_json()])
+            self.assertEqual(serializers.comments([c]), [c.to_json()])
+            self.assertEqual(serializers.users([u1, u2]), [u1.to_json(), u2.to_json()])
+            self.assertEqual(serializers.follows(follows), [Follow.to_json(f) for f in follows])
+            # followers that weren't loaded are fetched in one query
+            following = {u1.id: True, u2.id: False}
+            db.session.expire_all()
+            follows = Follow.query.options(db.lazyload(Follow.follower))\
+                .filter_by(followed_id=u1.id).order_by(Follow.follower_id).all()
+            with max_queries(1):
+                entries = serializers.follows(follows, following)
+            self.assertEqual([(e['follower'], e['following']) for e in entries],
+                             [('john', True), ('susan', False)])
+        with self.app.test_request_context(base_url='http://localhost/prefix'):
+            self.assertTrue(serializers.post(p)['url'].startswith('/prefix/api/v1/posts/'))
+
+    def test_fields_and_expand(self):
+        r = Role.query.filter_by(name='User').first()
+        u = User(email='john@example.com', username='john', password='cat',
+                 confirmed=True, role=r)
+        db.session.add(u)
+        db.session.commit()
+        headers = self.get_api_headers('john@example.com', 'cat')
+        posts = [Post(title=f'title {i}', body='body', author=u) for i in range(3)]
+        db.session.add_all(posts)
+        db.session.add_all([Comment(body=f'comment {i}', post=posts[0], author=u)
+                            for i in range(7)])
+        db.session.commit()
+
+        response = self.client.get('/api/v1/posts/?fields=title,url', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([set(post) for post in response.get_json()['posts']],
+                         [{'title', 'url'}] * 3)
+        response = self.client.get(f'/api/v1/users/{u.id}?fields=username', headers=headers)
+        self.assertEqual(response.get_json(), {'username': 'john'})
+        response = self.client.get('/api/v1/posts/?fields=title,password', headers=headers)
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/api/v1/posts/?expand=votes', headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+        url = '/api/v1/posts/?fields=title&expand=author,comments'
+        response = self.client.get(url, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        json_posts = {post['title']: post for post in response.get_json()['posts']}
+        self.assertEqual(json_posts['title 0']['author']['username'], 'john')
+        self.assertEqual(set(json_posts['title 0']), {'title', 'author', 'comments'})
+        self.assertEqual(len(json_posts['title 0']['comments']),
+                         self.app.config['FLASKY_API_EXPAND_COMMENTS'])
+        self.assertEqual(json_posts['title 0']['comments'][0]['body'], 'comment 6')
+        self.assertEqual(json_posts['title 1']['comments'], [])
+        count = int(response.headers['X-Query-Count'])
+
+        # the related resources are loaded in batches
+        susan = User(email='susan@example.com', username='susan', password='dog')
+        db.session.add(susan)
+        db.session.add_all([Post(title='more', body='body', author=susan) for _ in range(5)])
+        db.session.commit()
+        with max_queries(count):
+            response = self.client.get(url, headers=headers)
+        self.assertEqual(len(response.get_json()['posts']), 8)
+
+        # an embedded resource changing changes the ETag
+        url = f'/api/v1/comments/{posts[0].comments.first().id}?expand=author,post'
+        response = self.client.get(url, headers=headers)
+        self.assertEqual(response.get_json()['post']['title'], 'title 0')
+        etag = response.headers['ETag']
+        u.username = 'johnny'
+        db.session.commit()
+        response = self.client.get(url, headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['author']['username'], 'johnny')
+
+    def test_batch_endpoints(self):
+        r = Role.query.filter_by(name='User').first()
+        u = User(email='john@example.com', username='john', password='cat',
+                 confirmed=True, role=r)
+        other = User(email='susan@example.com', username='susan', password='dog')
+        db.session.add_all([u, other])
+        db.session.commit()
+        headers = self.get_api_headers('john@example.com', 'cat')
+
+        # create posts, the invalid one doesn't stop the others
+        response = self.client.post('/api/v1/posts/batch', headers=headers, json={'posts': [
+            {'title': 'first', 'body': 'body'},
+            {'title': '', 'body': 'body'},
+            {'title': 'second', 'body': 'body'}]})
+        self.assertEqual(response.status_code, 200)
+        results = response.get_json()['posts']
+        self.assertEqual([result['status'] for result in results], [201, 400, 201])
+        self.assertEqual(results[2]['post']['title'], 'second')
+        self.assertEqual(results[2]['post']['vote_count'], 1)
+        self.assertEqual(Post.query.count(), 2)
+        self.assertEqual(u.post_count, 2)
+        first, second = Post.query.order_by(Post.id).all()
+
+        # read them back by id
+        response = self.client.get(f'/api/v1/posts/?ids={second.id},999,{first.id}',
+                                   headers=headers)
+        self.assertEqual(response.status_code, 200)
+        results = response.get_json()['posts']
+        self.assertEqual([(result['id'], result['status']) for result in results],
+                         [(second.id, 200), (999, 404), (first.id, 200)])
+        self.assertEqual(results[0]['post']['title'], 'second')
+        etag = response.headers['ETag']
+        response = self.client.get(f'/api/v1/posts/?ids={second.id},999,{first.id}',
+                                   headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(f'/api/v1/users/?ids={other.id}&fields=username',
+                                   headers=headers)
+        self.assertEqual(response.get_json()['users'],
+                         [{'id': other.id, 'status': 200, 'user': {'username': 'susan'}}])
+        for url in ('/api/v1/users/', '/api/v1/posts/?ids=1,x',
+                    '/api/v1/posts/?ids=' + ','.join(['1'] * 101)):
+            self.assertEqual(self.client.get(url, headers=headers).status_code, 400)
+
+        # vote on them in one transaction
+        comment = Comment(body='comment', post=first, author=other)
+        db.session.add(comment)
+        db.session.commit()
+        response = self.client.post('/api/v1/votes/batch', headers=headers, json={'votes': [
+            {'obj_type': 'post', 'id': first.id, 'action': 'remove'},
+            {'obj_type': 'post', 'id': second.id, 'action': 'down'},
+            {'obj_type': 'comment', 'id': comment.id, 'action': 'up'},
+            {'obj_type': 'comment', 'id': 999, 'action': 'up'},
+            {'obj_type': 'vote', 'id': first.id, 'action': 'up'},
+            {'obj_type': 'post', 'id': first.id, 'action': 'sideways'}]})
+        self.assertEqual(response.status_code, 200)
+        results = response.get_json()['votes']
+        self.assertEqual([result['status'] for result in results],
+                         [200, 200, 200, 404, 400, 400])
+        self.assertEqual([(result['vote'], result['vote_count']) for result in results[:3]],
+                         [(None, 0), ('DOWN', -1), ('UP', 1)])
+        self.assertEqual(db.session.get(Post, second.id).vote_count, -1)
+        self.assertEqual(u.vote_status(db.session.get(Comment, comment.id)), 'UP')
+        response = self.client.post('/api/v1/votes/batch', headers=headers, json={'votes': []})
+        self.assertEqual(response.status_code, 400)
+
+        # the single vote endpoints
+        response = self.client.post(f'/api/v1/upvote/{second.id}', headers=headers,
+                                    json={'obj_type': 'post'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.get_json()['vote_count'], 1)
+        response = self.client.delete(f'/api/v1/remove-vote/{second.id}', headers=headers,
+                                      json={'obj_type': 'post'})
+        self.assertEqual(response.status_code, 204)
+        response = self.client.post(f'/api/v1/downvote/{second.id}', headers=headers, json={})
+        self.assertEqual(response.status_code, 400)
+
+    def test_orjson_provider(self):
+        try:
+            from app.json_provider import OrjsonProvider
+        except ImportError:
+            self.skipTest('orjson is not installed')
+        document = {'b': [1, 2.5, None], 'a': datetime.datetime(2020, 1, 2, 3, 4, 5),
+                    'c': {'x': 'é'}, 'd': datetime.date(2020, 1, 2)}
+        provider = OrjsonProvider(self.app)
+        self.assertEqual(json.loads(provider.dumps(document)),
+                         json.loads(self.app.json.dumps(document)))
+        self.assertEqual(provider.loads(provider.dumps({'x': 1})), {'x': 1})
+
+        # responses go through orjson too, indented in debug mode
+        import orjson
+        from flask import jsonify
+        self.app.json = provider
+        with mock.patch('app.json_provider.orjson.dumps', wraps=orjson.dumps) as dumps, \
+                self.app.test_request_context():
+            response = jsonify(document)
+            self.assertEqual(dumps.call_args.args, (document,))
+            self.assertEqual(response.get_json(), json.loads(provider.dumps(document)))
+            self.assertNotIn(b'": ', response.get_data())
+            self.app.debug = True
+            dumps.reset_mock()
+            self.assertIn(b'\n  "', jsonify(document).get_data())
+            dumps.assert_called_once()
+
+    def test_credentials_cache(self):
+        r = Role.query.filter_by(name='User').first()
+        u = User(email='john@example.com', password='cat', confirmed=True, role=r)
+        db.session.add(u)
+        db.session.commit()
+        headers = self.get_api_headers('john@example.com', 'cat')
+        with mock.patch.object(User, 'verify_password', autospec=True,
+                               side_effect=User.verify_password) as verify:
+            for _ in range(3):
+                response = self.client.get('/api/v1/posts/', headers=headers)
+                self.assertEqual(response.status_code, 200)
+            self.assertEqual(verify.call_count, 1)
+
+        # a token is decoded and its user loaded once
+        response = self.client.post('/api/v1/tokens/', headers=headers)
+        token = json.loads(response.get_data(as_text=True))['token']
+        token_headers = self.get_api_headers(token, '')
+        self.client.get('/api/v1/posts/', headers=token_headers)
+        with mock.patch.object(User, 'auth_token_data') as decode:
+            response = self.client.get('/api/v1/posts/', headers=token_headers)
+            self.assertEqual(response.status_code, 200)
+            decode.assert_not_called()
+
+        # changing the password drops the cached credentials
+        u.password = 'dog'
+        db.session.commit()
+        response = self.client.get('/api/v1/posts/', headers=headers)
+        self.assertEqual(response.status_code, 401)
+        response = self.client.get(
+            '/api/v1/posts/', headers=self.get_api_headers('john@example.com', 'dog'))
+        self.assertEqual(response.status_code, 200)
+
+        # a user restored from the cache is served as the database has it,
+        # under the ETag of that version
+        self.client.get('/api/v1/posts/', headers=token_headers)
+        db.session.execute(User.__table__.update().where(User.id == u.id).values(
+            username='johnny', version=User.version + 1))
+        db.session.commit()
+        db.session.expire_all()
+        for url in (f'/api/v1/users/{u.id}', f'/api/v1/users/?ids={u.id}'):
+            response = self.client.get(url, headers=token_headers)
+            self.assertIn('johnny', response.get_data(as_text=True))
+        response = self.client.get(f'/api/v1/users/{u.id}', headers=token_headers)
+        self.assertEqual(response.headers['ETag'], f'"users-{u.id}-{u.version}"')
+
+        # so does a role change
+        self.client.get('/api/v1/posts/', headers=token_headers)
+        u.role = Role.query.filter_by(name='Administrator').first()
+        db.session.commit()
+        self.assertEqual(len(self.app.extensions['auth_cache']), 0)
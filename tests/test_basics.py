@@ -1,6 +1,10 @@
 import unittest
 from flask import current_app
 from app import create_app, db
+from app.explain import view_queries, explain
+from app import fake
+import benchmarks
+from app.models import User, Role, Post, Comment, Vote
 
 
 class BasicsTestCase(unittest.TestCase):
@@ -19,4 +23,63 @@ class BasicsTestCase(unittest.TestCase):
         self.assertFalse(current_app is None)
 
     def test_app_is_testing(self):
-        self.assertTrue(current_app.config['TESTING'])
\ No newline at end of file
+        self.assertTrue(current_app.config['TESTING'])
+
+    def test_hot_queries_use_indexes(self):
+        for name, query in view_queries():
+            lines, scans = explain(query)
+            self.assertEqual(scans, [], f'{name}: {lines}')
+
+    def test_seed(self):
+        Role.insert_roles()
+        sizes = dict(users=30, posts=60, comments=80, follows=50, votes=100,
+                     batch_size=7, report=lambda line: None)
+        fake.seed(seed=42, **sizes)
+        usernames = [u.username for u in User.query.order_by(User.id)]
+        self.assertEqual(len(usernames), 30)
+        self.assertEqual(Post.query.count(), 60)
+        self.assertEqual(Comment.query.count(), 80)
+        # every post is upvoted by its author
+        self.assertEqual(Vote.query.join(Post, Vote.post_id == Post.id)
+                         .filter(Vote.user_id == Post.author_id, Vote.upvote == True)
+                         .count(), 60)
+        user = User.query.first()
+        self.assertEqual(user.post_count, user.posts.count())
+        self.assertEqual(user.follower_count, user.followers.count())
+        post = Post.query.first()
+        self.assertEqual(post.vote_count,
+                         post.votes.filter_by(upvote=True).count() -
+                         post.votes.filter_by(downvote=True).count())
+
+        # the same seed gives the same data, the roles are created if needed
+        db.drop_all()
+        db.create_all()
+        self.app.extensions.pop('roles', None)
+        fake.seed(seed=42, **sizes)
+        self.assertEqual([u.username for u in User.query.order_by(User.id)], usernames)
+
+    def test_benchmark_compare(self):
+        self.assertEqual(benchmarks.percentile([1, 2, 3, 4], 50), 2)
+        self.assertEqual(benchmarks.percentile([1, 2, 3, 4], 99), 4)
+        baseline = benchmarks.document('routes', {'100': {
+            'index': benchmarks.summarize([0.010] * 10, [3] * 10)}})
+        current = benchmarks.document('routes', {'100': {
+            'index': benchmarks.summarize([0.011] * 10, [4] * 10),
+            'new': benchmarks.summarize([1.0])}})
+        self.assertEqual(benchmarks.compare(baseline, current, threshold=0.2),
+                         [('100', 'index', 'queries', 3, 4)])
+        regressions = benchmarks.compare(baseline, current, threshold=0.05)
+        self.assertEqual([what for _, _, what, _, _ in regressions], ['p95', 'queries'])
+        # a slower run has a lower throughput
+        regressions = benchmarks.compare(baseline, current, metric='throughput', threshold=0.05)
+        self.assertEqual([what for _, _, what, _, _ in regressions], ['throughput', 'queries'])
+        regressions = benchmarks.compare(current, baseline, metric='throughput', threshold=0.05)
+        self.assertEqual(regressions, [])
+
+    def test_benchmark_scaling(self):
+        from benchmarks.models import scaling
+        results = {'10': {'flat': {'mean': 1.0}, 'linear': {'mean': 1.0}},
+                   '1000': {'flat': {'mean': 1.0}, 'linear': {'mean': 100.0}}}
+        slopes = scaling(results)
+        self.assertAlmostEqual(slopes['flat'], 0)
+        self.assertAlmostEqual(slopes['linear'], 1)
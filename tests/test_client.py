@@ -1,7 +1,8 @@
 import unittest
 import re
 from app import create_app, db
-from app.models import User, Role
+from app.models import User, Role, Post
+from app.instrumentation import max_queries
 
 
 class FlaskClientTestCase(unittest.TestCase):
@@ -52,3 +53,44 @@ class FlaskClientTestCase(unittest.TestCase):
         response = self.client.get('/auth/logout', follow_redirects=True)
         self.assertEqual(response.status_code, 200)
         self.assertTrue('You have been logged out' in response.get_data(as_text=True))
+
+    def test_query_count(self):
+        users = [User(email=f'user{i}@example.com', username=f'user{i}', password='cat')
+                 for i in range(10)]
+        db.session.add_all(users)
+        db.session.commit()
+        db.session.add_all([Post(title='title', body='body', author=u) for u in users])
+        db.session.commit()
+        response = self.client.get('/')
+        self.assertEqual(response.status_code, 200)
+        count = int(response.headers['X-Query-Count'])
+        self.assertIn('db;dur=', response.headers['Server-Timing'])
+        # twice as many posts by different authors cost no extra queries
+        more = [User(email=f'more{i}@example.com', username=f'more{i}', password='cat')
+                for i in range(10)]
+        db.session.add_all(more)
+        db.session.commit()
+        db.session.add_all([Post(title='title', body='body', author=u) for u in more])
+        db.session.commit()
+        with max_queries(count):
+            response = self.client.get('/')
+        self.assertEqual(response.status_code, 200)
+
+    def test_followers_page(self):
+        john = User(email='john@example.com', username='john', password='cat', confirmed=True)
+        susan = User(email='susan@example.com', username='susan', password='dog')
+        david = User(email='david@example.com', username='david', password='dog')
+        db.session.add_all([john, susan, david])
+        db.session.commit()
+        susan.follow(john)
+        david.follow(john)
+        john.follow(susan)
+        db.session.commit()
+        response = self.client.get('/user/john/followers')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('susan', response.get_data(as_text=True))
+        self.client.post('/auth/login', data={'email': 'john@example.com', 'password': 'cat'})
+        data = self.client.get('/user/john/followers').get_data(as_text=True)
+        self.assertEqual(data.count('Follows you'), 2)
+        self.assertIn('/unfollow/susan', data)
+        self.assertIn('/follow/david', data)
@@ -1,6 +1,6 @@
 import unittest
 from app import create_app, db
-from app.models import User, Post, Role, Comment
+from app.models import User, Post, Role, Comment, reconcile_counters
 
 
 class CommentModelTestCase(unittest.TestCase):
@@ -42,3 +42,19 @@ class CommentModelTestCase(unittest.TestCase):
         db.session.delete(c)
         self.assertEqual(p.comments.count(), 0)
         self.assertEqual(u.comments.count(), 0)
+
+    def test_comment_count(self):
+        u = User(username='john', email='john@example.com', password='cat')
+        p = Post(title='test title', body='test body', author=u)
+        c1 = Comment(body='first comment', post=p, author=u)
+        c2 = Comment(body='second comment', post=p, author=u)
+        db.session.add_all([u, p, c1, c2])
+        db.session.commit()
+        self.assertEqual(p.comment_count, 2)
+        db.session.delete(c1)
+        db.session.commit()
+        self.assertEqual(p.comment_count, 1)
+        Post.query.filter_by(id=p.id).update({'comment_count': 7})
+        db.session.commit()
+        reconcile_counters()
+        self.assertEqual(p.comment_count, 1)
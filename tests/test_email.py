@@ -0,0 +1,134 @@
+import socketserver
+import threading
+import unittest
+from flask_mail import Message
+from app import create_app
+from app.email import MailQueue
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    '''Just enough SMTP to accept what smtplib sends.'''
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        server.connections += 1
+        self.reply('220 localhost')
+        while True:
+            line = self.rfile.readline().decode('ascii').strip()
+            if not line:
+                return
+            command = line.split(' ', 1)[0].upper()
+            if command == 'EHLO':
+                self.reply('250 localhost')
+            elif command == 'DATA':
+                self.reply('354 go ahead')
+                while self.rfile.readline() != b'.\r\n':
+                    pass
+                if server.failures > 0:
+                    server.failures -= 1
+                    self.reply('451 try again later')
+                else:
+                    server.messages += 1
+                    self.reply('250 ok')
+            elif command == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+
+class SMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), SMTPHandler)
+        self.connections = self.messages = self.failures = 0
+
+
+class EmailTestCase(unittest.TestCase):
+    def setUp(self):
+        self.smtp = SMTPServer()
+        threading.Thread(target=self.smtp.serve_forever, daemon=True).start()
+        self.app = create_app('testing')
+        self.app.config.update(FLASKY_MAIL_WORKERS=1, FLASKY_MAIL_BACKOFF=0.01,
+                               FLASKY_MAIL_IDLE=0.5)
+        state = self.app.extensions['mail']
+        state.server, state.port = self.smtp.server_address
+        state.use_ssl = state.use_tls = state.suppress = False
+        state.username = None
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        self.app_context.pop()
+        self.smtp.shutdown()
+        self.smtp.server_close()
+
+    def queue(self):
+        return MailQueue(self.app)
+
+    def message(self, i):
+        return Message(f'message {i}', sender='flasky@example.com',
+                       recipients=['john@example.com'], body='body')
+
+    def test_connection_reuse(self):
+        queue = self.queue()
+        for i in range(5):
+            self.assertTrue(queue.put(self.message(i)))
+        queue.queue.join()
+        self.assertEqual(self.smtp.messages, 5)
+        self.assertEqual(self.smtp.connections, 1)
+        metrics = queue.metrics()
+        self.assertEqual(metrics['sent'], 5)
+        self.assertEqual(metrics['depth'], 0)
+        queue.shutdown(timeout=5)
+        self.assertEqual(queue.metrics()['workers'], 0)
+
+    def test_retry(self):
+        self.smtp.failures = 2
+        queue = self.queue()
+        queue.put(self.message(0))
+        queue.queue.join()
+        self.assertEqual(self.smtp.messages, 1)
+        self.assertEqual(queue.metrics()['retried'], 2)
+
+        # gives up after FLASKY_MAIL_RETRIES attempts
+        self.smtp.failures = 10
+        queue.put(self.message(1))
+        queue.queue.join()
+        self.assertEqual(self.smtp.messages, 1)
+        self.assertEqual(queue.metrics()['failed'], 1)
+        queue.shutdown(timeout=5)
+
+    def test_unsendable_message(self):
+        queue = self.queue()
+        bad = self.message(0)
+        bad.subject = 'bad\nheader'
+        queue.put(bad)
+        queue.put(self.message(1))
+        queue.queue.join()
+        self.assertEqual(self.smtp.messages, 1)
+        self.assertEqual(queue.metrics()['failed'], 1)
+        self.assertEqual(queue.metrics()['workers'], 1)
+
+        # a worker that died anyway is replaced
+        queue.shutdown(timeout=5)
+        dead = threading.Thread(target=lambda: None)
+        dead.start()
+        dead.join()
+        queue.threads = [dead]
+        queue.put(self.message(2))
+        queue.queue.join()
+        self.assertEqual(self.smtp.messages, 2)
+        queue.shutdown(timeout=5)
+
+    def test_bounded(self):
+        self.app.config.update(FLASKY_MAIL_QUEUE_SIZE=1, FLASKY_MAIL_ENQUEUE_TIMEOUT=0)
+        queue = self.queue()
+        queue.start = lambda: None  # no workers, nothing leaves the queue
+        self.assertTrue(queue.put(self.message(0)))
+        self.assertFalse(queue.put(self.message(1)))
+        self.assertEqual(queue.metrics()['dropped'], 1)
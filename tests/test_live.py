@@ -0,0 +1,75 @@
+import queue
+import unittest
+from app import create_app, db
+from app.live import channel
+from app.models import User, Post, Role, Comment
+
+
+class LiveTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        User.create_deleted_user()
+        self.hub = self.app.extensions['live']
+        # no timer, the test flushes the hub itself
+        self.hub.interval = 60
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_votes_are_coalesced(self):
+        u1 = User(username='john', email='john@example.com', password='cat')
+        u2 = User(username='susan', email='susan@example.com', password='dog')
+        p = Post(title='title', body='body', author=u1)
+        db.session.add_all([u1, u2, p])
+        db.session.commit()
+        c = Comment(body='comment', post=p, author=u2)
+        db.session.add(c)
+        db.session.commit()
+        subscription = self.hub.subscribe(channel(p.id))
+        u2.upvote('post', p)
+        db.session.commit()
+        u2.downvote('post', p)
+        u1.upvote('comment', c)
+        db.session.commit()
+        u1.downvote('comment', c)
+        db.session.rollback()
+        self.assertTrue(subscription.empty())
+        self.hub.flush()
+        message = subscription.get_nowait()
+        self.assertEqual(message, {
+            'type': 'votes',
+            'posts': {p.id: {'delta': -1, 'count': 0}},
+            'comments': {c.id: {'delta': 1, 'count': 1}}})
+        self.assertTrue(subscription.empty())
+        self.hub.unsubscribe(channel(p.id), subscription)
+        self.assertNotIn(channel(p.id), self.hub.subscribers)
+
+    def test_new_comment(self):
+        u = User(username='john', email='john@example.com', password='cat')
+        p = Post(title='title', body='body', author=u)
+        db.session.add_all([u, p])
+        db.session.commit()
+        subscription = self.hub.subscribe(channel(p.id))
+        other = self.hub.subscribe(channel(p.id + 1))
+        c = Comment(body='*hi*', post=p, author=u)
+        db.session.add(c)
+        db.session.commit()
+        message = subscription.get_nowait()
+        self.assertEqual(message['type'], 'comment')
+        self.assertEqual(message['id'], c.id)
+        self.assertEqual(message['author'], 'john')
+        self.assertEqual(message['body_html'], '<em>hi</em>')
+        self.assertTrue(other.empty())
+
+    def test_slow_subscriber(self):
+        subscription = self.hub.subscribe('post:1')
+        for i in range(self.hub.queue_size + 10):
+            self.hub.publish('post:1', {'type': 'test', 'i': i})
+        self.assertEqual(subscription.qsize(), self.hub.queue_size)
+        self.assertEqual(subscription.get_nowait()['i'], 0)
@@ -0,0 +1,63 @@
+import logging
+import unittest
+from app import create_app
+from app.log_handlers import DigestHandler, add_queued_handler
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def fail(value):
+    raise ValueError(value)
+
+
+class LogHandlersTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.logger = logging.getLogger('test_log_handlers')
+        self.logger.propagate = False
+
+    def tearDown(self):
+        self.logger.handlers = []
+
+    def log_failure(self, value):
+        try:
+            fail(value)
+        except ValueError:
+            self.logger.exception('request failed')
+
+    def test_digest(self):
+        target = ListHandler()
+        handler = DigestHandler(target, window=60, rate=2)
+        self.logger.addHandler(handler)
+        for i in range(5):
+            self.log_failure(i)
+        self.logger.error('disk %s full', '/tmp')
+        self.logger.error('something else')
+        # the same traceback is sent once, the rate limit holds back the rest
+        self.assertEqual(len(target.records), 2)
+        handler.flush()
+        self.assertEqual(len(target.records), 3)
+        digest = target.records[-1].getMessage()
+        self.assertTrue(digest.startswith('5 repeated log records'))
+        self.assertIn('4 x ERROR', digest)
+        self.assertIn('something else', digest)
+        handler.flush()
+        self.assertEqual(len(target.records), 3)
+
+    def test_queued(self):
+        target = ListHandler()
+        self.app.logger = self.logger
+        queue_handler, listener = add_queued_handler(self.app, target, logging.ERROR)
+        self.logger.warning('ignored')
+        self.log_failure(1)
+        listener.stop()
+        self.assertEqual(len(target.records), 1)
+        self.assertIn('ValueError', target.records[0].getMessage())
+        self.assertEqual(queue_handler.dropped, 0)
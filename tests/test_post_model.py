@@ -1,6 +1,9 @@
+import time
 import unittest
-from app import create_app, db
+from unittest import mock
+from app import create_app, db, rendering
 from app.models import User, Post, Role
+from app.rendering import render, rerender_all, POST_TAGS
 
 
 class PostModelTestCase(unittest.TestCase):
@@ -41,3 +44,49 @@ class PostModelTestCase(unittest.TestCase):
         self.assertTrue(p.body == '**[deleted]**')
         self.assertFalse(p.author == u)
         self.assertTrue(p.editable is False)
+
+    def test_rendering(self):
+        body = '**bold** <script>alert(1)</script> http://example.com'
+        html = render(body, POST_TAGS)
+        self.assertIn('<strong>bold</strong>', html)
+        self.assertNotIn('<script>', html)
+        self.assertIn('<a href="http://example.com"', html)
+        self.assertIs(render(body, POST_TAGS), html)
+
+        # large bodies go through the process pool, huge ones aren't parsed
+        self.app.config['FLASKY_RENDER_POOL_THRESHOLD'] = 10
+        self.assertEqual(render(body + ' pool', POST_TAGS), html[:-4] + ' pool</p>')
+        # a render that timed out gives nothing, and isn't remembered
+        slow = body + ' slow'
+        self.app.config['FLASKY_RENDER_TIMEOUT'] = 0.2
+        with mock.patch('app.rendering._render', side_effect=lambda *args: time.sleep(5)):
+            self.assertIsNone(render(slow, POST_TAGS))
+        self.app.config['FLASKY_RENDER_TIMEOUT'] = 10
+        self.assertEqual(render(slow, POST_TAGS), html[:-4] + ' slow</p>')
+        self.app.config['FLASKY_RENDER_MAX_SIZE'] = 10
+        self.assertEqual(render('**' + 'a' * 20 + '**', POST_TAGS),
+                         '<p>**' + 'a' * 20 + '**</p>')
+
+    def test_render_after_commit(self):
+        # large bodies are stored unrendered and rendered once committed
+        self.app.config['FLASKY_RENDER_POOL_THRESHOLD'] = 10
+        u = User(username='john', email='john@example.com', password='cat')
+        p = Post(title='title', body='*a large enough body*', author=u)
+        db.session.add_all([u, p])
+        self.assertIsNone(p.body_html)
+        db.session.commit()
+        rendering.join()
+        db.session.refresh(p)
+        self.assertEqual(p.body_html, '<p><em>a large enough body</em></p>')
+
+    def test_rerender(self):
+        u = User(username='john', email='john@example.com', password='cat')
+        p = Post(title='title', body='*body*', author=u)
+        db.session.add_all([u, p])
+        db.session.commit()
+        db.session.execute(Post.__table__.update().values(body_html='stale'))
+        db.session.commit()
+        self.assertEqual(rerender_all(batch_size=1), 1)
+        self.assertEqual(rerender_all(batch_size=1), 0)
+        db.session.refresh(p)
+        self.assertEqual(p.body_html, '<p><em>body</em></p>')
@@ -0,0 +1,109 @@
+import unittest
+from app import create_app, db
+from app.models import User, Role, Post, Comment
+from app.response_cache import ResponseCache, LocalStore
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.client = self.app.test_client(use_cookies=True)
+        self.user = User(email='john@example.com', username='john', password='cat',
+                         confirmed=True)
+        self.post = Post(title='title', body='body', author=self.user)
+        db.session.add_all([self.user, self.post])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def get(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.headers.get('X-Cache'), response.get_data(as_text=True)
+
+    def test_anonymous_pages(self):
+        url = f'/post/{self.post.id}'
+        self.assertEqual(self.get(url)[0], 'MISS')
+        self.assertEqual(self.get(url)[0], 'HIT')
+        self.assertEqual(self.get(url + '?page=1')[0], 'MISS')
+        self.client.set_cookie('localhost', 'top_comments', '1')
+        self.assertEqual(self.get(url)[0], 'MISS')
+        self.client.delete_cookie('localhost', 'top_comments')
+        self.assertEqual(self.get(url)[0], 'HIT')
+        self.assertEqual(self.get('/')[0], 'MISS')
+        self.assertEqual(self.get('/user/john')[0], 'MISS')
+
+        # a new comment changes the post page and the comment counts shown
+        # on the index and the profile
+        db.session.add(Comment(body='a new comment', post=self.post, author=self.user))
+        db.session.commit()
+        status, data = self.get(url)
+        self.assertEqual(status, 'MISS')
+        self.assertIn('a new comment', data)
+        self.assertEqual(self.get('/')[0], 'MISS')
+        self.assertEqual(self.get('/user/john')[0], 'MISS')
+
+        # a post by someone else only changes the index
+        susan = User(email='susan@example.com', username='susan', password='dog')
+        db.session.add(Post(title='title', body='body', author=susan))
+        db.session.commit()
+        self.assertEqual(self.get('/')[0], 'MISS')
+        self.assertEqual(self.get('/user/john')[0], 'HIT')
+        self.assertEqual(self.get(url)[0], 'HIT')
+
+        # votes are counted outside of the ORM, they invalidate too
+        susan.upvote('post', self.post)
+        db.session.commit()
+        self.assertEqual(self.get(url)[0], 'MISS')
+
+        # and a renamed author, everywhere
+        self.user.username = 'johnny'
+        db.session.commit()
+        self.assertEqual(self.get(url)[0], 'MISS')
+        self.assertIn('johnny', self.get('/')[1])
+
+        # changes that are rolled back don't count
+        self.get(url)
+        self.post.title = 'rolled back'
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(self.get(url)[0], 'HIT')
+
+    def test_logged_in(self):
+        self.client.post('/auth/login', data={'email': 'john@example.com', 'password': 'cat'})
+        status, data = self.get('/')
+        self.assertIsNone(status)
+        self.assertIn('john', data)
+
+    def test_shared_store(self):
+        # two workers sharing a store, one of them commits
+        store = LocalStore(maxsize=100, ttl=60)
+        self.app.extensions['response_cache'] = ResponseCache(store)
+        other = ResponseCache(store)
+        url = f'/post/{self.post.id}'
+        self.get(url)
+        self.assertEqual(self.get(url)[0], 'HIT')
+        other.invalidate({f'post:{self.post.id}'})
+        self.assertEqual(self.get(url)[0], 'MISS')
+        other.invalidate({'post:12345'})
+        self.assertEqual(self.get(url)[0], 'HIT')
+
+    def test_evicted_tags(self):
+        store = LocalStore(maxsize=1, ttl=60)
+        self.app.extensions['response_cache'] = ResponseCache(store)
+        url = f'/post/{self.post.id}'
+        self.get(url)
+        self.assertEqual(self.get(url)[0], 'HIT')
+        # the post's tag is pushed out of the store by the bumps that follow it
+        store.bump([f'post:{self.post.id}'])
+        for i in range(4):
+            store.bump([f'post:{12345 + i}'])
+        self.assertEqual(self.get(url)[0], 'MISS')
+        self.assertEqual(self.get(url)[0], 'HIT')
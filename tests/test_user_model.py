@@ -2,7 +2,14 @@ import datetime
 import unittest
 import time
 from app import create_app, db
-from app.models import User, Permission, AnonymousUser, Role, Follow, Post
+from sqlalchemy.exc import IntegrityError
+from app.models import User, Permission, AnonymousUser, Role, Follow, Post, Timeline, Vote
+from app.models import reconcile_counters, CacheVersion, Suggestion
+from app import suggestions
+from app.votes import vote_statuses
+from app.activity import LastSeenTracker
+from app.instrumentation import max_queries
+from app.pagination import KeysetPagination
 
 
 class UserModelTestCase(unittest.TestCase):
@@ -155,6 +162,63 @@ class UserModelTestCase(unittest.TestCase):
         u.ping()
         self.assertTrue(u.last_seen > last_seen_before)
 
+    def test_last_seen_tracker(self):
+        u1 = User(email='john@example.com', password='cat')
+        u2 = User(email='susan@example.com', password='dog')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        tracker = LastSeenTracker(self.app, interval=3600, min_delta=60)
+        later = u1.last_seen + datetime.timedelta(minutes=5)
+        # recent activity isn't recorded, the rest waits for a flush
+        tracker.touch(u1, u1.last_seen + datetime.timedelta(seconds=10))
+        self.assertEqual(tracker.pending, {})
+        tracker.touch(u1, later - datetime.timedelta(minutes=1))
+        tracker.touch(u1, later)
+        tracker.touch(u2, later)
+        self.assertEqual(len(tracker.pending), 2)
+        with max_queries(1):
+            self.assertEqual(tracker.flush(), 2)
+        self.assertEqual(tracker.pending, {})
+        db.session.expire_all()
+        self.assertEqual(u1.last_seen, later)
+        self.assertEqual(u2.last_seen, later)
+
+        # with no request coming, a timer writes them when the interval is up
+        tracker = LastSeenTracker(self.app, interval=0.2, min_delta=60)
+        latest = later + datetime.timedelta(minutes=5)
+        tracker.touch(u1, latest)
+        self.assertEqual(len(tracker.pending), 1)
+        tracker.flusher.join(5)
+        self.assertEqual(tracker.pending, {})
+        self.assertIsNone(tracker.flusher)
+        db.session.expire_all()
+        self.assertEqual(u1.last_seen, latest)
+
+    def test_role_cache(self):
+        u = User(email='john@example.com', password='cat')
+        db.session.add(u)
+        db.session.commit()
+        self.assertIsNotNone(u.role_id)
+        u = User.query.get(u.id)
+        with max_queries(0):
+            self.assertTrue(u.can(Permission.WRITE))
+            self.assertFalse(u.can(Permission.MODERATE))
+            User(email='susan@example.com', password='dog')
+
+        # local changes reload the cache on the next use
+        role = Role.query.filter_by(name='User').first()
+        role.add_permission(Permission.MODERATE)
+        db.session.commit()
+        self.assertTrue(u.can(Permission.MODERATE))
+
+        # changes made by other workers are seen once the version is checked
+        db.session.execute(Role.__table__.update().values(permissions=0))
+        CacheVersion.bump(db.session.connection(), 'roles')
+        db.session.commit()
+        self.assertTrue(u.can(Permission.MODERATE))
+        Role.cached().checked -= self.app.config['FLASKY_ROLE_CACHE_CHECK']
+        self.assertFalse(u.can(Permission.MODERATE))
+
     def test_gravatar(self):
         u = User(email='john@example.com', password='cat')
         with self.app.test_request_context('/'):
@@ -205,6 +269,77 @@ class UserModelTestCase(unittest.TestCase):
         db.session.commit()
         self.assertTrue(Follow.query.count() - 1 == 0)
 
+    def test_follow_graph(self):
+        u1 = User(email='john@example.com', username='john', password='cat')
+        u2 = User(email='mira@example.com', username='mira', password='bat')
+        u3 = User(email='susan@example.com', username='susan', password='dog')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+        self.assertTrue(u1.is_following(u2))
+        ids = [u1.id, u2.id, u3.id]
+        # later checks are answered without the database
+        with max_queries(0):
+            self.assertTrue(u1.is_following(u2))
+            self.assertTrue(u2.is_followed_by(u1))
+            self.assertFalse(u1.is_following(u3))
+            self.assertEqual(u1.are_following(ids + [1000]), {u1.id, u2.id})
+        # list pages only query who follows the viewer
+        with max_queries(1):
+            self.assertEqual(u1.relationships(ids), {u1.id: (True, True), u2.id: (True, False),
+                                                     u3.id: (False, False)})
+        u1.follow(u3)
+        self.assertTrue(u1.is_following(u3))
+        db.session.rollback()
+        self.assertFalse(u1.is_following(u3))
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertFalse(u1.is_following(u2))
+        self.assertEqual(u1.are_following([u2.id, u3.id]), set())
+
+        # writes don't trust the graph, another worker may have changed the follows
+        self.assertFalse(u1.is_following(u3))
+        db.session.execute(Follow.__table__.insert().values(follower_id=u1.id,
+                                                            followed_id=u3.id))
+        db.session.commit()
+        self.assertFalse(u1.follow(u3))
+        db.session.commit()
+        self.assertTrue(u1.unfollow(u3))
+        db.session.commit()
+        self.assertEqual(Follow.query.filter_by(follower_id=u1.id, followed_id=u3.id).count(), 0)
+        self.assertFalse(u1.unfollow(u3))
+
+    def test_suggestions(self):
+        users = [User(email=f'user{i}@example.com', username=f'user{i}', password='cat')
+                 for i in range(5)]
+        db.session.add_all(users)
+        db.session.commit()
+        u0, u1, u2, u3, u4 = users
+        # u3 is followed by both friends of u0, u4 by one of them
+        for follower, followed in ((u0, u1), (u0, u2), (u1, u3), (u2, u3), (u2, u4)):
+            follower.follow(followed)
+        db.session.commit()
+        graph = suggestions.Graph.load(batch_size=2)
+        self.assertEqual(sorted(graph.indices[i] for i in graph.followed(u0.id)),
+                         [u1.id, u2.id])
+        scores = suggestions.score(graph, u0.id, half_life=30)
+        self.assertEqual(set(scores), {u3.id, u4.id})
+        self.assertAlmostEqual(scores[u3.id], 4, places=3)
+        self.assertAlmostEqual(scores[u4.id], 2, places=3)
+        self.assertGreater(suggestions.rebuild(chunk_size=2, batch_size=2), 0)
+        self.assertEqual([(u.id, round(score)) for u, score in Suggestion.for_user(u0.id)],
+                         [(u3.id, 4), (u4.id, 2)])
+        # following a suggestion removes it right away, the rest on rebuild
+        u0.follow(u4)
+        db.session.commit()
+        self.assertEqual([u.id for u, _ in Suggestion.for_user(u0.id)], [u3.id])
+        u0.unfollow(u1)
+        u0.unfollow(u2)
+        db.session.commit()
+        suggestions.rebuild()
+        self.assertEqual(Suggestion.for_user(u0.id), [])
+
     def test_vote(self):
         u1 = User(email='john@example.com', password='cat')
         u2 = User(email='sara@example.com', password='dog')
@@ -231,5 +366,122 @@ class UserModelTestCase(unittest.TestCase):
         self.assertEqual(p.votes.count(), 1)
         self.assertEqual(p.vote_count, 1)
 
+    def test_vote_statuses(self):
+        u1 = User(email='john@example.com', password='cat')
+        u2 = User(email='sara@example.com', password='dog')
+        p1 = Post(title='first', body='first body', author=u1)
+        p2 = Post(title='second', body='second body', author=u1)
+        p3 = Post(title='third', body='third body', author=u1)
+        db.session.add_all([u1, u2, p1, p2, p3])
+        db.session.commit()
+        u2.upvote('post', p1)
+        u2.downvote('post', p2)
+        db.session.commit()
+        self.assertEqual(vote_statuses(u2, [p1, p2, p3]),
+                         {p1.id: 'UP', p2.id: 'DOWN'})
+        self.assertEqual(vote_statuses(u1, [p1, p2, p3]),
+                         {p1.id: 'UP', p2.id: 'UP', p3.id: 'UP'})
+        self.assertEqual(vote_statuses(AnonymousUser(), [p1, p2, p3]), {})
 
+    def test_counters(self):
+        User.create_deleted_user()
+        u1 = User(username='john', email='john@example.com', password='cat')
+        u2 = User(username='sara', email='sara@example.com', password='dog')
+        p = Post(title='test title', body='test body', author=u1)
+        db.session.add_all([u1, u2, p])
+        db.session.commit()
+        self.assertEqual(u1.post_count, 1)
+        self.assertEqual(u1.follower_count, 1)
+        self.assertEqual(u1.following_count, 1)
+        u2.follow(u1)
+        db.session.commit()
+        self.assertEqual(u1.follower_count, 2)
+        self.assertEqual(u2.following_count, 2)
+        u2.unfollow(u1)
+        db.session.commit()
+        self.assertEqual(u1.follower_count, 1)
+        self.assertEqual(u2.following_count, 1)
+        # deleted posts are handed over to the 'deleted' user
+        p.deleted = True
+        db.session.commit()
+        self.assertEqual(u1.post_count, 0)
+        self.assertEqual(User.query.filter_by(username='deleted').first().post_count, 1)
 
+    def test_timeline(self):
+        User.create_deleted_user()
+        u1 = User(username='john', email='john@example.com', password='cat')
+        u2 = User(username='sara', email='sara@example.com', password='dog')
+        u3 = User(username='mira', email='mira@example.com', password='bat')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        old = Post(title='old', body='body', author=u2)
+        db.session.add(old)
+        db.session.commit()
+        # following backfills the posts written so far
+        u1.follow(u2)
+        db.session.commit()
+        self.assertEqual(u1.followed_posts.all(), [old])
+        # new posts are fanned out to the followers
+        new = Post(title='new', body='body', author=u2)
+        db.session.add(new)
+        db.session.commit()
+        self.assertEqual(Timeline.query.filter_by(post_id=new.id).count(), 2)
+        self.assertEqual(set(u1.followed_posts), {old, new})
+        # deleting a post removes it from the timelines
+        old.deleted = True
+        db.session.commit()
+        self.assertEqual(u1.followed_posts.all(), [new])
+        # authors with many followers are merged in at read time
+        self.app.config['FLASKY_TIMELINE_FANOUT_LIMIT'] = 1
+        u1.follow(u3)
+        db.session.commit()
+        popular = Post(title='popular', body='body', author=u3)
+        db.session.add(popular)
+        db.session.commit()
+        self.assertEqual(Timeline.query.filter_by(post_id=popular.id).count(), 0)
+        self.assertEqual(set(u1.followed_posts), {new, popular})
+        # pages of the timeline merge both, newest first
+        keys = (Post.timestamp, Post.id)
+        page = KeysetPagination(u1.timeline(), keys, 1)
+        self.assertEqual((page.items, page.has_next), ([popular], True))
+        page = KeysetPagination(u1.timeline(), keys, 1, [popular.timestamp, popular.id])
+        self.assertEqual((page.items, page.has_next), ([new], False))
+        # dropping back to the limit fans out what was written meanwhile
+        u3.unfollow(u3)
+        db.session.commit()
+        self.assertEqual(Timeline.query.filter_by(post_id=popular.id).count(), 1)
+        self.assertEqual(set(u1.followed_posts), {new, popular})
+        # unfollowing prunes the timeline
+        u1.unfollow(u2)
+        u1.unfollow(u3)
+        db.session.commit()
+        self.assertEqual(u1.followed_posts.all(), [])
+        self.assertEqual(Timeline.query.filter_by(user_id=u1.id).count(), 0)
+
+    def test_vote_engine(self):
+        u1 = User(email='john@example.com', password='cat')
+        u2 = User(email='sara@example.com', password='dog')
+        p = Post(title='test title', body='test body', author=u1)
+        db.session.add_all([u1, u2, p])
+        db.session.commit()
+        # toggling the same vote twice takes it back
+        self.assertEqual(Vote.toggle(u2, p, 'UP'), 'UP')
+        self.assertEqual(p.vote_count, 2)
+        self.assertEqual(Vote.toggle(u2, p, 'UP'), None)
+        self.assertEqual(p.vote_count, 1)
+        # flipping a vote moves the count by two and keeps a single row
+        self.assertEqual(Vote.toggle(u2, p, 'DOWN'), 'DOWN')
+        self.assertEqual(Vote.toggle(u2, p, 'UP'), 'UP')
+        self.assertEqual(p.vote_count, 2)
+        self.assertEqual(Vote.cast(u2, p, 'UP'), 0)
+        self.assertEqual(p.votes.filter_by(user_id=u2.id).count(), 1)
+        db.session.commit()
+        # a second vote row for the same user and post is rejected
+        db.session.add(Vote(user_id=u2.id, post_id=p.id, upvote=True))
+        with self.assertRaises(IntegrityError):
+            db.session.commit()
+        db.session.rollback()
+        # reconciling recomputes vote_count from the votes
+        Post.query.filter_by(id=p.id).update({'vote_count': 10})
+        reconcile_counters()
+        self.assertEqual(p.vote_count, 2)